@@ -0,0 +1,468 @@
+""" Benchmark the IATI pipeline on a synthetic workload
+Generates deterministic IATI XML (the same parameters and seed always give the
+same bytes), then times each stage of the pipeline separately, plus an
+end-to-end run, and records the wall time and peak memory of each one as JSON,
+so that runs before and after a change can be compared.
+
+Usage:
+
+    python3 benchmark.py [--activities N] [--transactions N] [--countries N] [--sectors N]
+        [--currencies N] [--narrative-words N] [--seed N] [--repeat N] [--workers N] [--parser NAME]
+        [--only NAME ...] [--output FILE] [--compare FILE]
+
+Wall times are the best of --repeat runs. Peak memory is measured with tracemalloc
+in one extra run, so it counts Python allocations in this process only (not the
+workers in an end-to-end run with --workers).
+
+"""
+
+import argparse, datetime, gc, importlib.util, json, os, pathlib, platform, random, sys, tempfile, time, tracemalloc
+from xml.sax.saxutils import escape
+
+#
+# Constants
+#
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+""" Directory containing this script and the pipeline scripts (the reference data paths are relative to it) """
+
+COUNTRY_CODES = [
+    "AF", "BD", "BF", "BO", "CD", "CF", "CM", "CO", "ET", "HT", "IQ", "JO", "KE", "LB", "ML",
+    "MM", "MZ", "NE", "NG", "PK", "PS", "SD", "SN", "SO", "SS", "SY", "TD", "UA", "VE", "YE",
+]
+""" Recipient countries to draw from """
+
+SECTOR_CODES = [
+    "12264", "12220", "12240", "12250", "72010", "72040", "72050", "15110", "15160",
+    "31120", "11110", "11220", "14030", "16010", "43010", "52010", "73010", "74020",
+]
+""" Five-digit DAC sector codes to draw from """
+
+CURRENCIES = ["USD", "EUR", "GBP", "CAD", "CHF", "SEK", "NOK", "DKK", "JPY", "AUD", "XOF", "KES"]
+""" Currencies to draw from, in order (--currencies takes the first N) """
+
+ORGS = [("XM-DAC-41114", "UNDP"), ("GB-GOV-1", "FCDO"), ("XI-IATI-EC_ECHO", "ECHO"), ("XM-DAC-41122", "UNICEF"), ("XM-DAC-41140", "WFP")] + [
+    ("XM-BENCH-{:04d}".format(i), "Benchmark Organisation {}".format(i)) for i in range(200)
+]
+""" Reporting, provider, and receiver organisations to draw from """
+
+WORDS = "water health food support emergency response programme community district services local supply training".split()
+""" Vocabulary for narratives """
+
+TRANSACTION_TYPES = ["1", "2", "2", "3", "3", "4", "11"]
+""" Transaction types to draw from (weighted towards outgoing) """
+
+BENCHMARKS = [
+    "generate",
+    "reference",
+    "parse-diterator",
+    "parse-streaming",
+    "lookups",
+    "split",
+    "process",
+    "merge-sort",
+    "write",
+    "save-page",
+    "dump-filter",
+    "end-to-end",
+]
+""" Benchmark names, in the order they run """
+
+
+#
+# Workload generator
+#
+
+def generate_workload (output_dir, activities=1000, transactions=5, countries=2, sectors=2, currencies=3, narrative_words=20, c19_share=0.05, seed=1, activities_per_file=1000):
+    """ Write a deterministic set of synthetic iati-activities-NNN.xml files
+    Each activity has the number of transactions, and the number of recipient countries
+    and sectors (split by percentage), provided. Only c19_share of the activities mention
+    COVID-19 (as in a full bulk dump), which matters only for the dump-filter benchmark.
+    Returns the list of filenames.
+
+    """
+    rnd = random.Random(seed)
+    currency_codes = CURRENCIES[:max(1, currencies)]
+    filenames = []
+    for file_number, start in enumerate(range(0, activities, activities_per_file), start=1):
+        pieces = ['<?xml version="1.0" encoding="UTF-8"?>\n<iati-activities version="2.03" generated-datetime="2021-06-01T00:00:00Z">\n']
+        for i in range(start, min(activities, start + activities_per_file)):
+            pieces.append(make_activity(rnd, i, transactions, countries, sectors, currency_codes, narrative_words, rnd.random() < c19_share))
+        pieces.append("</iati-activities>\n")
+        filename = os.path.join(output_dir, "iati-activities-{:0>3d}.xml".format(file_number))
+        with open(filename, "w") as output:
+            output.write("".join(pieces))
+        filenames.append(filename)
+    return filenames
+
+def make_activity (rnd, n, transactions, countries, sectors, currency_codes, narrative_words, is_c19):
+    """ Return the XML for one synthetic activity """
+    ref, name = rnd.choice(ORGS[:5])
+    x = '<iati-activity last-updated-datetime="2021-{:02d}-{:02d}T00:00:00Z" humanitarian="{}" default-currency="{}">'.format(
+        rnd.randint(1, 12), rnd.randint(1, 28), rnd.randint(0, 1), rnd.choice(currency_codes)
+    )
+    x += "<iati-identifier>XM-BENCH-{:07d}</iati-identifier>".format(n)
+    x += '<reporting-org ref="{}" type="{}"><narrative>{}</narrative></reporting-org>'.format(ref, rnd.choice(["10", "21", "40"]), escape(name))
+    x += "<title><narrative>{}</narrative></title>".format("COVID-19 response" if is_c19 else make_narrative(rnd, 4))
+    x += "<description><narrative>{}</narrative></description>".format(make_narrative(rnd, narrative_words))
+    x += make_splits(rnd, "recipient-country", COUNTRY_CODES, countries, "")
+    x += make_splits(rnd, "sector", SECTOR_CODES, sectors, ' vocabulary="1"')
+    if is_c19:
+        x += '<tag vocabulary="99" code="COVID-19"/>'
+    for i in range(transactions):
+        date = "{}-{:02d}-{:02d}".format(rnd.choice([2020, 2021]), rnd.randint(1, 12), rnd.randint(1, 28))
+        x += "<transaction>"
+        x += '<transaction-type code="{}"/><transaction-date iso-date="{}"/>'.format(rnd.choice(TRANSACTION_TYPES), date)
+        x += '<value currency="{}" value-date="{}">{}</value>'.format(rnd.choice(currency_codes), date, rnd.randint(1000, 5000000))
+        x += "<description><narrative>{}</narrative></description>".format(make_narrative(rnd, max(1, narrative_words // 4)))
+        provider_ref, provider_name = rnd.choice(ORGS)
+        receiver_ref, receiver_name = rnd.choice(ORGS)
+        x += '<provider-org ref="{}"><narrative>{}</narrative></provider-org>'.format(provider_ref, escape(provider_name))
+        x += '<receiver-org ref="{}"><narrative>{}</narrative></receiver-org>'.format(receiver_ref, escape(receiver_name))
+        x += "</transaction>"
+    x += "</iati-activity>\n"
+    return x
+
+def make_splits (rnd, tag, codes, count, attributes):
+    """ Return XML for count coded elements, with percentages adding up to 100 """
+    if count <= 0:
+        return ""
+    chosen = rnd.sample(codes, min(count, len(codes)))
+    percentages = [100 // len(chosen)] * len(chosen)
+    percentages[0] += 100 - sum(percentages)
+    return "".join('<{} code="{}"{} percentage="{}"/>'.format(tag, code, attributes, percentage) for code, percentage in zip(chosen, percentages))
+
+def make_narrative (rnd, words):
+    """ Return a narrative with the number of words provided """
+    return " ".join(rnd.choice(WORDS) for i in range(words))
+
+
+#
+# Loading the pipeline scripts
+#
+
+def load_script (name, filename):
+    """ Load one of the pipeline scripts as a module (they have hyphens in their names, so they can't be imported)
+    Registers the module in sys.modules, so that worker processes can unpickle its functions.
+
+    """
+    spec = importlib.util.spec_from_file_location(name, os.path.join(SCRIPT_DIR, filename))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+#
+# Benchmarks
+#
+
+class Benchmarks:
+    """ The benchmarks, sharing one workload
+    Each benchmark is a setup_<name>() method (not timed), which returns the argument
+    for the run_<name>() method (timed), which returns the number of items it handled.
+    Names use underscores here for hyphens in BENCHMARKS.
+
+    """
+
+    def __init__ (self, args, work_dir):
+        self.args = args
+        self.work_dir = work_dir
+        self.input_dir = os.path.join(work_dir, "input")
+        os.makedirs(self.input_dir)
+        self.generate = load_script("generate_data", "generate-data.py")
+        self.download = load_script("download_iati", "download-iati.py")
+        self.filenames = self.run_generate(self.input_dir)
+        self.this_month = datetime.datetime.utcnow().isoformat()[:7]
+        self.generate.load_reference_data()
+        self.activities = [activity for filename in self.filenames for activity in self.generate.PARSERS["streaming"](filename)]
+
+    def parameters (self):
+        """ Return the workload parameters, for the results """
+        return {key: getattr(self.args, key) for key in ("activities", "transactions", "countries", "sectors", "currencies", "narrative_words", "c19_share", "seed", "sort_buffer", "workers", "parser",)}
+
+    def fresh_dir (self, name):
+        """ Return an empty directory for a benchmark's output """
+        path = tempfile.mkdtemp(prefix=name + "-", dir=self.work_dir)
+        return path
+
+    def setup_generate (self):
+        return self.fresh_dir("generate")
+
+    def run_generate (self, output_dir):
+        args = self.args
+        return generate_workload(
+            output_dir, args.activities, args.transactions, args.countries, args.sectors,
+            args.currencies, args.narrative_words, args.c19_share, args.seed
+        )
+
+    def setup_reference (self):
+        return None
+
+    def run_reference (self, arg):
+        self.generate.build_reference_data()
+        return 1
+
+    def setup_parse_diterator (self):
+        return "diterator"
+
+    def setup_parse_streaming (self):
+        return "streaming"
+
+    def run_parse (self, parser):
+        count = 0
+        for filename in self.filenames:
+            for activity in self.generate.PARSERS[parser](filename):
+                count += len(activity.transactions)
+        return count
+
+    run_parse_diterator = run_parse
+    run_parse_streaming = run_parse
+
+    def setup_lookups (self):
+        g = self.generate
+        g.lookup_usd_rate.cache_clear()
+        g.clean_string.cache_clear()
+        g.org_names = None
+        lookups = []
+        for activity in self.activities:
+            for transaction in activity.transactions:
+                lookups.append((
+                    g.get_org_key(transaction.receiver_org),
+                    [country.code for country in transaction.recipient_countries],
+                    [sector.code for sector in transaction.sectors],
+                    transaction.currency,
+                    transaction.value_date or transaction.date,
+                ))
+        return lookups
+
+    def run_lookups (self, lookups):
+        g = self.generate
+        for org_key, countries, sectors, currency, date in lookups:
+            g.lookup_org_name(*org_key)
+            for code in countries:
+                g.get_country_name(code)
+            for code in sectors:
+                g.get_sector_group_name(code)
+            g.get_usd_rate(currency, date)
+        return len(lookups)
+
+    def setup_split (self):
+        g = self.generate
+        splits = []
+        for activity in self.activities:
+            activity_countries = g.make_country_splits(activity)
+            activity_sectors = g.make_sector_splits(activity)
+            for transaction in activity.transactions:
+                splits.append((transaction.value, transaction.value * 0.5, g.make_country_splits(transaction, activity_countries), g.make_sector_splits(transaction, activity_sectors),))
+        return splits
+
+    def run_split (self, splits):
+        count = 0
+        for value, net_value, country_splits, sector_splits in splits:
+            count += len(self.generate.split_values(value, net_value, country_splits, sector_splits)[1])
+        return count
+
+    def setup_process (self):
+        return self.activities
+
+    def run_process (self, activities):
+        for activity in activities:
+            self.generate.process_activity(activity, self.this_month)
+        return len(activities)
+
+    def setup_merge_sort (self):
+        self.generate.org_names = None
+        return [self.generate.process_activity(activity, self.this_month) for activity in self.activities]
+
+    def run_merge_sort (self, results):
+        g = self.generate
+        transactions = g.TransactionSink(self.args.sort_buffer)
+        flows = g.FlowAggregator()
+        for result in results:
+            if result is not None:
+                g.merge_activity(result, transactions, flows)
+        count = sum(1 for row in transactions.sorted_rows())
+        transactions.close()
+        return count
+
+    def setup_write (self):
+        g = self.generate
+        g.org_names = None
+        transactions = g.TransactionSink(self.args.sort_buffer)
+        flows = g.FlowAggregator()
+        for activity in self.activities:
+            result = g.process_activity(activity, self.this_month)
+            if result is not None:
+                g.merge_activity(result, transactions, flows)
+        return (transactions, flows, self.fresh_dir("write"),)
+
+    def run_write (self, arg):
+        g = self.generate
+        transactions, flows, output_dir = arg
+        rollups = g.make_rollups()
+        count = g.write_transactions(output_dir, transactions, rollups)
+        g.write_rollups(output_dir, rollups, transactions.values())
+        g.write_flows(output_dir, flows)
+        transactions.close()
+        return count
+
+    def setup_save_page (self):
+        pages = []
+        for filename in self.filenames:
+            with open(filename, "rb") as input:
+                data = input.read()
+            pages.append([data[i:i+self.download.CHUNK_BYTES] for i in range(0, len(data), self.download.CHUNK_BYTES)])
+        return (pages, pathlib.Path(self.fresh_dir("save-page")),)
+
+    def run_save_page (self, arg):
+        pages, output_dir = arg
+        for page, chunks in enumerate(pages, start=1):
+            self.download.save_page(output_dir, page, chunks)
+        return len(pages)
+
+    def setup_dump_filter (self):
+        return None
+
+    def run_dump_filter (self, arg):
+        count = 0
+        for filename in self.filenames:
+            count += sum(1 for activity in self.download.scan_dump_file(pathlib.Path(filename)))
+        return count
+
+    def setup_end_to_end (self):
+        self.generate.org_names = None
+        return self.fresh_dir("end-to-end")
+
+    def run_end_to_end (self, output_dir):
+        g = self.generate
+        transactions, flows = g.process_activities(self.filenames, workers=self.args.workers, parser=self.args.parser, sort_buffer=self.args.sort_buffer)
+        rollups = g.make_rollups()
+        count = g.write_transactions(output_dir, transactions, rollups)
+        g.write_rollups(output_dir, rollups, transactions.values())
+        g.write_flows(output_dir, flows)
+        transactions.close()
+        return count
+
+    def measure (self, name, repeat):
+        """ Run a benchmark repeat times for timing, then once more under tracemalloc for peak memory
+        Returns a dict of results.
+
+        """
+        method_name = name.replace("-", "_")
+        setup = getattr(self, "setup_" + method_name)
+        run = getattr(self, "run_" + method_name)
+
+        times = []
+        for i in range(repeat):
+            arg = setup()
+            gc.collect()
+            start = time.perf_counter()
+            items = run(arg)
+            if isinstance(items, list):
+                items = len(items)
+            times.append(time.perf_counter() - start)
+            del arg
+
+        arg = setup()
+        gc.collect()
+        tracemalloc.start()
+        run(arg)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del arg
+
+        return {
+            "name": name,
+            "items": items,
+            "wall_seconds": min(times),
+            "wall_seconds_mean": sum(times) / len(times),
+            "items_per_second": items / min(times) if min(times) > 0 else None,
+            "peak_memory_bytes": peak,
+        }
+
+
+#
+# Reporting
+#
+
+def get_environment ():
+    """ Describe the environment, so that results from different machines aren't compared by mistake """
+    environment = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+    for module in ("lxml", "numpy", "brotli",):
+        environment[module] = importlib.util.find_spec(module) is not None
+    return environment
+
+def print_comparison (results, baseline, file=sys.stderr):
+    """ Print the wall time and peak memory of each benchmark against an earlier run """
+    old_results = {result["name"]: result for result in baseline["results"]}
+    if baseline.get("parameters") != results["parameters"]:
+        print("Warning: the baseline used different workload parameters", file=file)
+    print("{:<16} {:>10} {:>10} {:>7} {:>12} {:>12} {:>7}".format("benchmark", "old (s)", "new (s)", "ratio", "old (MB)", "new (MB)", "ratio"), file=file)
+    for result in results["results"]:
+        old = old_results.get(result["name"])
+        if old is None:
+            continue
+        print("{:<16} {:>10.4f} {:>10.4f} {:>7.2f} {:>12.1f} {:>12.1f} {:>7.2f}".format(
+            result["name"],
+            old["wall_seconds"], result["wall_seconds"], result["wall_seconds"] / old["wall_seconds"] if old["wall_seconds"] else 0,
+            old["peak_memory_bytes"] / 1e6, result["peak_memory_bytes"] / 1e6, result["peak_memory_bytes"] / old["peak_memory_bytes"] if old["peak_memory_bytes"] else 0,
+        ), file=file)
+
+
+#
+# Script entry point
+#
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Benchmark the IATI pipeline on a synthetic workload")
+    argparser.add_argument("--activities", type=int, default=2000, metavar="N", help="Number of activities (default: 2000)")
+    argparser.add_argument("--transactions", type=int, default=5, metavar="N", help="Transactions per activity (default: 5)")
+    argparser.add_argument("--countries", type=int, default=2, metavar="N", help="Recipient countries per activity (default: 2)")
+    argparser.add_argument("--sectors", type=int, default=2, metavar="N", help="Sectors per activity (default: 2)")
+    argparser.add_argument("--currencies", type=int, default=3, metavar="N", help="Number of different currencies, up to {} (default: 3)".format(len(CURRENCIES)))
+    argparser.add_argument("--narrative-words", type=int, default=20, metavar="N", help="Words in each activity description (default: 20)")
+    argparser.add_argument("--c19-share", type=float, default=0.05, metavar="FRACTION", help="Share of activities that mention COVID-19 (default: 0.05)")
+    argparser.add_argument("--seed", type=int, default=1, metavar="N", help="Random seed for the workload (default: 1)")
+    argparser.add_argument("--sort-buffer", type=int, default=1000000, metavar="ROWS", help="Transaction rows to sort in memory before spilling (default: 1000000)")
+    argparser.add_argument("--workers", type=int, default=1, metavar="N", help="Worker processes for the end-to-end benchmark (default: 1)")
+    argparser.add_argument("--parser", choices=["diterator", "streaming"], default="diterator", help="Parser for the end-to-end benchmark (default: diterator)")
+    argparser.add_argument("--repeat", type=int, default=3, metavar="N", help="Timed runs of each benchmark (default: 3)")
+    argparser.add_argument("--only", nargs="+", choices=BENCHMARKS, metavar="NAME", help="Run only these benchmarks (default: all of {})".format(", ".join(BENCHMARKS)))
+    argparser.add_argument("--output", metavar="FILE", help="Write the results to a JSON file (default: standard output)")
+    argparser.add_argument("--compare", metavar="FILE", help="Compare with the results of an earlier run")
+    args = argparser.parse_args()
+
+    # The pipeline scripts look for the reference data relative to the working directory
+    os.chdir(SCRIPT_DIR)
+
+    with tempfile.TemporaryDirectory(prefix="iati-benchmark-") as work_dir:
+        benchmarks = Benchmarks(args, work_dir)
+        results = {
+            "parameters": benchmarks.parameters(),
+            "environment": get_environment(),
+            "results": [],
+        }
+        for name in BENCHMARKS:
+            if args.only and name not in args.only:
+                continue
+            print("Running {} ...".format(name), file=sys.stderr)
+            results["results"].append(benchmarks.measure(name, args.repeat))
+        results["max_rss_bytes"] = benchmarks.generate.get_peak_rss()
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare, "r") as input:
+            print_comparison(results, json.load(input))
+
+# end
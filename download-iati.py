@@ -1,13 +1,29 @@
 """ Download IATI files from D-Portal
-Produces multiple output files, each containing up to 1,000 IATI activities
+Produces multiple gzipped output files, each containing up to 1,000 IATI activities
 
 Usage:
 
-    python3 download-iati.py <output_dir>
+    python3 download-iati.py [--concurrency N] [--retries N] [--url URL] [--full] <output_dir>
+    python3 download-iati.py --dump DIR <output_dir>
+
+Progress is recorded in download-manifest.json in the output directory. If a
+download fails part-way through, running the script again will resume from the
+pages it already has.
+
+Once a download completes, the script records the last-updated-datetime of each
+activity in download-state.json. The next run fetches only activities updated
+since then, and merges them into the existing files, replacing the older
+versions. Use --full to download everything again (e.g. to drop activities that
+no longer match the query).
+
+With --dump, the script reads a local directory of full IATI publisher XML
+files instead of querying D-Portal, and applies the same COVID-19 criteria
+itself (see is_c19_activity()), writing the matches in the same layout.
 
 """
 
-import pathlib, requests, sys, urllib.parse
+import argparse, concurrent.futures, datetime, gzip, hashlib, iatifiles, json, mmap, os, pathlib, re, requests, requests.adapters, shutil, sys, time, urllib.parse
+import xml.etree.ElementTree as etree
 
 #
 # Constants
@@ -16,6 +32,54 @@ import pathlib, requests, sys, urllib.parse
 LIMIT = 1000
 """ Maximum activities in each output file """
 
+CONCURRENCY = 4
+""" Default maximum number of pages to download at once """
+
+RETRIES = 5
+""" Default number of times to retry a failed page """
+
+BACKOFF = 2.0
+""" Seconds to wait before the first retry (doubling for each retry after that) """
+
+TIMEOUT = 300
+""" Seconds to wait for D-Portal to respond to a query """
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504,)
+""" HTTP status codes that are worth retrying """
+
+FILE_TEMPLATE = "iati-activities-{:0>3d}.xml.gz"
+""" Template for output filenames, numbered by page (gzip-compressed) """
+
+FILE_GLOBS = ["iati-activities-*.xml", "iati-activities-*.xml.gz"]
+""" Glob patterns matching all the output files (including uncompressed ones from older versions) """
+
+CHUNK_BYTES = 64 * 1024
+""" Bytes to read at a time when streaming a page to disk """
+
+ACTIVITY_MARKER = b"<iati-activity"
+""" Bytes that show that a page contains at least one activity """
+
+MANIFEST_FILE = "download-manifest.json"
+""" Record of the pages downloaded so far, for resuming an interrupted download """
+
+STATE_FILE = "download-state.json"
+""" Last-updated timestamps and locations for every activity in the output directory """
+
+DELTA_DIR = "delta"
+""" Subdirectory for new and changed activities, before they're merged into the output directory """
+
+SINCE_CLAUSE = """ AND aid IN (
+        SELECT aid FROM xson WHERE root='/iati-activities/iati-activity' AND xson->>'@last-updated-datetime' >= '{}'
+    )"""
+""" Extra condition for DPORTAL_QUERY to fetch only activities updated since a timestamp
+This goes into the paged subquery, so that a page comes back empty only when we're past
+the end of the results (not just when none of the activities on it have changed).
+
+"""
+
+TIMESTAMP_PATTERN = re.compile(r'^[0-9T:.+Z-]+$')
+""" Timestamps must match this pattern before we'll put them into a query """
+
 DPORTAL_URL = "http://d-portal.org/dquery?form=xml&sql="
 """ URL base for API queries """
 
@@ -23,8 +87,7 @@ DPORTAL_QUERY = """
 SELECT * FROM xson WHERE root = '/iati-activities/iati-activity' AND
     (xson->>'/reporting-org@secondary-reporter'='0' OR xson->>'/reporting-org@secondary-reporter'='' OR
     xson->>'/reporting-org@secondary-reporter' IS NULL) AND aid IN (
-    SELECT aid FROM xson WHERE
-    (
+    SELECT aid FROM xson WHERE ((
         root='/iati-activities/iati-activity/humanitarian-scope' AND
         xson->>'@type'='1' AND
         xson->>'@vocabulary'='1-2' AND
@@ -56,47 +119,512 @@ SELECT * FROM xson WHERE root = '/iati-activities/iati-activity' AND
         root='/iati-activities/iati-activity/transaction/sector' AND
         xson->>'@code'='12264' AND
         (xson->>'@vocabulary'='1' OR xson->>'@vocabulary'='' OR xson->>'@vocabulary' IS NULL)  
-    ) GROUP BY aid ORDER BY max(xson->>'@iati-activities:generated-datetime'), max(xson->>'@last-updated-datetime'), aid LIMIT {limit} OFFSET {offset}
+    )){since} GROUP BY aid ORDER BY max(xson->>'@iati-activities:generated-datetime'), max(xson->>'@last-updated-datetime'), aid LIMIT {limit} OFFSET {offset}
 )
 
 """
 """ Query in D-Portal's SQL-like language - see https://d-portal.org/dquery/ """
 
+DUMP_GLOB = "**/*.xml"
+""" Glob pattern for IATI XML files in a bulk-dump directory (searched recursively) """
+
+PREFILTER_PATTERN = re.compile(rb'covid|coronavirus|EP-2020-000012-001|HCOVD20|12264', re.IGNORECASE)
+""" Cheap byte-level test for activities that might match the criteria (any that don't match this can't match DPORTAL_QUERY) """
+
+NARRATIVE_PATTERN = re.compile(r'\b(?:covid|coronavirus)\b', re.IGNORECASE)
+""" Whole-word match for narratives, like D-Portal's to_tsquery('simple','COVID | CORONAVIRUS') """
+
+C19_SCOPES = (
+    ("1", "1-2", "EP-2020-000012-001",),
+    ("2", "2-1", "HCOVD20",),
+)
+""" (type, vocabulary, code) for the COVID-19 GLIDE number and HRP code in humanitarian-scope """
+
+C19_NARRATIVE_PATHS = ("title/narrative", "description/narrative", "transaction/description/narrative",)
+""" Paths (from iati-activity) to narratives to check for COVID-19 keywords """
+
+GENERATED_PATTERN = re.compile(rb'\sgenerated-datetime\s*=\s*["\']([^"\']*)["\']')
+""" Regular expression matching the generated-datetime attribute (search in the iati-activities start tag only) """
+
+VERSION_PATTERN = re.compile(rb'\sversion\s*=\s*["\']([^"\']*)["\']')
+""" Regular expression matching the IATI version attribute (search in the iati-activities start tag only) """
+
+NAMESPACE_PATTERN = re.compile(rb'\sxmlns:([\w.-]+)\s*=\s*(?:"[^"]*"|\'[^\']*\')')
+""" Regular expression matching namespace-prefix declarations (search in the iati-activities start tag only) """
+
+DUMP_HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<iati-activities{version} generated-datetime="{generated}">
+"""
+""" Start of each output file written from a bulk dump (version is DUMP_VERSION_ATTRIBUTE, or empty) """
+
+DUMP_VERSION_ATTRIBUTE = ' version="{}"'
+""" IATI version attribute for DUMP_HEADER, when all the activities in an output file come from the same version """
+
+DUMP_FOOTER = "</iati-activities>\n"
+""" End of each output file written from a bulk dump """
+
+
 #
-# Main function
+# Download functions
 #
 
-def main (output_dir):
-    """ Download IATI into the specified output directory """
-    output_dir = pathlib.Path(output_dir) # wrap as a pathlib object
-    offset = 0
-    file_template = "iati-activities-{:0>3d}.xml"
+def make_session (concurrency):
+    """ Create a requests session with a connection pool big enough for the concurrent downloads """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def make_query (offset, since=None):
+    """ Make the D-Portal query for a page of results
+    If since is provided, include only activities updated at or after that timestamp.
 
+    """
+    if since is None:
+        since_clause = ""
+    elif TIMESTAMP_PATTERN.match(since):
+        since_clause = SINCE_CLAUSE.format(since)
+    else:
+        raise ValueError("Malformed timestamp: {}".format(since))
+    return DPORTAL_QUERY.format(limit=LIMIT, offset=offset, since=since_clause)
+
+def fetch_page (session, url_base, output_dir, page, retries=RETRIES, since=None):
+    """ Fetch a single page of results from D-Portal and stream it to disk, retrying with exponential backoff
+    Pages are numbered from 1.
+    Returns the filename, or None if the page was empty (see save_page()).
+    Raises an exception if the page still fails after the last retry.
+
+    """
+    offset = (page - 1) * LIMIT
+    url = url_base + format(urllib.parse.quote(make_query(offset, since)))
+    attempt = 0
     while True:
-        url = DPORTAL_URL + format(urllib.parse.quote(DPORTAL_QUERY.format(limit=LIMIT, offset=offset)))
-        response = requests.get(url)
-        # print(response.status_code, response.text, file=sys.stderr)
-        response.raise_for_status()
-        if "<iati-activity" not in response.text:
-            # If the result doesn't contain any IATI activities, we're done
+        try:
+            with session.get(url, timeout=TIMEOUT, stream=True) as response:
+                if response.status_code not in RETRY_STATUS_CODES:
+                    response.raise_for_status()
+                    return save_page(output_dir, page, response.iter_content(CHUNK_BYTES))
+                error = "HTTP status {}".format(response.status_code)
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,) as e:
+            error = str(e)
+        if attempt >= retries:
+            raise Exception("Giving up on page {} after {} attempts: {}".format(page, attempt + 1, error))
+        delay = BACKOFF * (2 ** attempt)
+        print("Page {} failed ({}), retrying in {:.1f}s ...".format(page, error, delay), file=sys.stderr)
+        time.sleep(delay)
+        attempt += 1
+
+def save_page (output_dir, page, chunks):
+    """ Stream a page of results to a gzipped file, if it contains any activities
+    The chunks are bytes, e.g. from response.iter_content(). Checks for activities
+    as the chunks go by, so the page is never all in memory at once.
+    Writes to a temporary file first, so that an interrupted run never leaves a partial page behind.
+    Returns the filename, or None if the page was empty (meaning that we're past the end of the results).
+
+    """
+    filename = output_dir / FILE_TEMPLATE.format(page)
+    temp_path = get_temp_path(filename)
+    found = False
+    tail = b""
+    try:
+        with gzip.open(temp_path, "wb", compresslevel=iatifiles.GZIP_LEVEL) as output:
+            for chunk in chunks:
+                if not found:
+                    # keep the end of the last chunk, in case the marker is split between chunks
+                    text = tail + chunk
+                    found = ACTIVITY_MARKER in text
+                    tail = text[-(len(ACTIVITY_MARKER) - 1):]
+                output.write(chunk)
+    except:
+        temp_path.unlink(missing_ok=True)
+        raise
+    if not found:
+        # If the result doesn't contain any IATI activities, we're done
+        temp_path.unlink()
+        return None
+    os.replace(temp_path, filename)
+    return filename
+
+def save_file (path, data):
+    """ Save the bytes of an output file atomically, gzipped if the name ends with .gz """
+    temp_path = get_temp_path(path)
+    iatifiles.write_file(temp_path, data, compressed=path.name.endswith(".gz"))
+    os.replace(temp_path, path)
+
+def get_temp_path (path):
+    """ Return a temporary path for writing an output file (hidden, so that it never matches FILE_GLOBS) """
+    return path.parent / ".{}.tmp".format(path.name)
+
+
+#
+# Manifest functions
+#
+
+def query_signature (url_base, since=None):
+    """ Return a signature for the query, so that we don't resume a download made with different settings """
+    return hashlib.sha1("{}\n{}\n{}".format(url_base, LIMIT, make_query(0, since)).encode("utf-8")).hexdigest()
+
+def load_manifest (output_dir, signature):
+    """ Load the download manifest, or start a new one
+    Starts a new manifest if the last download used a different query.
+
+    """
+    path = output_dir / MANIFEST_FILE
+    if path.exists():
+        with open(path, "r") as input:
+            manifest = json.load(input)
+        if manifest.get("signature") == signature:
+            return manifest
+        # Start over, and remove the pages from the old download
+        remove_pages(output_dir)
+    return {
+        "signature": signature,
+        "complete": False,
+        "pages": {},
+    }
+
+def save_manifest (output_dir, manifest):
+    """ Save the download manifest atomically """
+    path = output_dir / MANIFEST_FILE
+    with open(str(path) + ".tmp", "w") as output:
+        json.dump(manifest, output, indent=2)
+    os.replace(str(path) + ".tmp", path)
+
+
+#
+# Activity-store functions
+#
+
+def list_pages (output_dir):
+    """ Return a sorted list of the output files in a directory """
+    return sorted(path for pattern in FILE_GLOBS for path in output_dir.glob(pattern))
+
+def remove_pages (output_dir):
+    """ Remove all the output files and the download manifest from a directory """
+    for path in list_pages(output_dir):
+        path.unlink()
+    (output_dir / MANIFEST_FILE).unlink(missing_ok=True)
+
+def scan_store (output_dir):
+    """ Build the download state by scanning the output files
+    Returns a dict with the latest last-updated-datetime in the store, and the
+    last-updated-datetime and filename for each activity.
+
+    """
+    activities = {}
+    for path in list_pages(output_dir):
+        for identifier, last_updated, start, end in iatifiles.scan_activities(iatifiles.read_file(path)):
+            activities[identifier] = {
+                "updated": last_updated,
+                "file": path.name,
+            }
+    timestamps = [info["updated"] for info in activities.values() if info["updated"]]
+    return {
+        "last_updated": max(timestamps) if timestamps else None,
+        "activities": activities,
+    }
+
+def load_state (output_dir):
+    """ Load the download state, or return None if there isn't one """
+    path = output_dir / STATE_FILE
+    if not path.exists():
+        return None
+    with open(path, "r") as input:
+        return json.load(input)
+
+def save_state (output_dir, state):
+    """ Save the download state atomically """
+    path = output_dir / STATE_FILE
+    with open(str(path) + ".tmp", "w") as output:
+        json.dump(state, output)
+    os.replace(str(path) + ".tmp", path)
+
+def merge_delta (output_dir, delta_dir, state):
+    """ Merge newly-downloaded pages into the output directory
+    Removes the older versions of any changed activities from the existing files,
+    then moves the new pages in after the existing ones.
+    Safe to run again if interrupted.
+
+    """
+
+    # Find which new or changed activities are in the delta pages
+    delta_paths = list_pages(delta_dir)
+    changed = set()
+    for path in delta_paths:
+        changed.update(identifier for identifier, last_updated, start, end in iatifiles.scan_activities(iatifiles.read_file(path)))
+
+    # Remove their older versions from the existing files
+    affected_files = set(state["activities"][identifier]["file"] for identifier in changed if identifier in state["activities"])
+    for filename in sorted(affected_files):
+        path = output_dir / filename
+        if not path.exists():
+            continue
+        data = iatifiles.remove_activities(iatifiles.read_file(path), changed)
+        if next(iatifiles.find_activities(data), None) is None:
+            # nothing left in the file
+            path.unlink()
+        else:
+            save_file(path, data)
+        print(path, "updated ...", file=sys.stderr)
+
+    # Move the new pages in, numbering them after the existing files
+    existing_numbers = [int(re.sub(r'\D', '', path.name)) for path in list_pages(output_dir)]
+    next_number = max(existing_numbers, default=0) + 1
+    for path in delta_paths:
+        filename = output_dir / FILE_TEMPLATE.format(next_number)
+        if path.name.endswith(".gz"):
+            os.replace(path, filename)
+        else:
+            # left over from an older version
+            save_file(filename, iatifiles.read_file(path))
+            path.unlink()
+        print(filename, "added ...", file=sys.stderr)
+        next_number += 1
+
+    print(len(changed), "new or changed activities,", len(affected_files), "existing files updated", file=sys.stderr)
+
+
+#
+# Bulk-dump functions
+#
+
+def scan_dump_file (path):
+    """ Yield the activities in a bulk-dump file that pass the byte-level prefilter, then the precise criteria
+    Yields a dict for each activity with the identifier, timestamps, IATI version, and bytes (with the file's namespace
+    declarations copied into the iati-activity start tag, so it can stand alone in another file).
+    Uses mmap, so the file is never all in memory at once.
+
+    """
+    if path.stat().st_size == 0:
+        return
+    with open(path, "rb") as input, mmap.mmap(input.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        first = next(iatifiles.find_activities(data), None)
+        if first is None:
             return
-        offset += LIMIT
-        filename = output_dir / file_template.format(int(offset/LIMIT))
-        with open(filename, "w") as output:
-            print(response.text, file=output)
+        header = data[:first[0]]
+        root_tag = header[header.rfind(b"<iati-activities"):]
+        root_tag = root_tag[:root_tag.find(b">") + 1]
+        match = GENERATED_PATTERN.search(root_tag)
+        generated = match.group(1).decode("utf-8").strip() if match else None
+        match = VERSION_PATTERN.search(root_tag)
+        version = match.group(1).decode("utf-8").strip() if match else None
+        namespaces = [(match.group(1), match.group(0),) for match in NAMESPACE_PATTERN.finditer(root_tag)]
+
+        for start, end in iatifiles.find_activities(data):
+            snippet = data[start:end]
+            if not PREFILTER_PATTERN.search(snippet):
+                continue
+            try:
+                activity = etree.fromstring(header + snippet + b"</iati-activities>").find("iati-activity")
+            except etree.ParseError as e:
+                print("Skipping malformed activity in {}: {}".format(path, e), file=sys.stderr)
+                continue
+            if not is_c19_activity(activity):
+                continue
+            if namespaces:
+                snippet = add_namespaces(snippet, namespaces)
+            yield {
+                "identifier": iatifiles.get_identifier(snippet),
+                "generated": generated,
+                "updated": iatifiles.get_last_updated(snippet),
+                "version": version,
+                "data": snippet,
+            }
+
+def add_namespaces (snippet, namespaces):
+    """ Copy namespace declarations from a file's iati-activities start tag into an activity's start tag
+    The namespaces are (prefix, declaration) tuples. Skips any prefix that the activity declares itself.
+
+    """
+    start_tag = snippet[:snippet.find(b">")]
+    declared = set(match.group(1) for match in NAMESPACE_PATTERN.finditer(start_tag))
+    declarations = b"".join(declaration for prefix, declaration in namespaces if prefix not in declared)
+    return snippet[:len(b"<iati-activity")] + declarations + snippet[len(b"<iati-activity"):]
+
+def is_c19_activity (activity):
+    """ Check a parsed iati-activity element against the same criteria as DPORTAL_QUERY """
+
+    # Skip secondary reporters
+    reporting_org = activity.find("reporting-org")
+    if reporting_org is not None and reporting_org.get("secondary-reporter") not in (None, "", "0",):
+        return False
+
+    for scope in activity.findall("humanitarian-scope"):
+        if (scope.get("type"), scope.get("vocabulary"), scope.get("code"),) in C19_SCOPES:
+            return True
+
+    for tag in activity.findall("tag"):
+        if tag.get("vocabulary") == "99" and tag.get("vocabulary-uri") is None and (tag.get("code") or "").upper() == "COVID-19":
+            return True
+
+    for path in C19_NARRATIVE_PATHS:
+        for narrative in activity.findall(path):
+            if NARRATIVE_PATTERN.search("".join(narrative.itertext())):
+                return True
+
+    for sector in activity.findall("sector") + activity.findall("transaction/sector"):
+        if sector.get("code") == "12264" and sector.get("vocabulary") in (None, "", "1",):
+            return True
+
+    return False
 
-        # could replace with a proper logging function
-        print(filename, "...", file=sys.stderr)    
+def dump_sort_key (activity):
+    """ Sort like DPORTAL_QUERY: by generated-datetime, then last-updated-datetime, then identifier (missing timestamps last) """
+    return (
+        activity["generated"] is None, activity["generated"] or "",
+        activity["updated"] is None, activity["updated"] or "",
+        activity["identifier"] or "",
+    )
+
+def ingest_dump (dump_dir, output_dir):
+    """ Write the COVID-19 activities from a directory of bulk-dump files into the output directory
+    Replaces any existing output files. When an activity appears in more than one
+    dump file, keeps the copy with the latest last-updated-datetime.
+    Each output file has the IATI version of its source files, if they all agree,
+    and no version otherwise.
+
+    """
+    activities = {}
+    total = 0
+    paths = sorted(pathlib.Path(dump_dir).glob(DUMP_GLOB))
+    for path in paths:
+        for activity in scan_dump_file(path):
+            total += 1
+            previous = activities.get(activity["identifier"])
+            if previous is None or (activity["updated"] or "") > (previous["updated"] or ""):
+                activities[activity["identifier"]] = activity
+        print(path, "...", file=sys.stderr)
+
+    remove_pages(output_dir)
+    (output_dir / STATE_FILE).unlink(missing_ok=True)
+
+    matches = sorted(activities.values(), key=dump_sort_key)
+    generated = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+    for page, i in enumerate(range(0, len(matches), LIMIT), start=1):
+        filename = output_dir / FILE_TEMPLATE.format(page)
+        temp_path = get_temp_path(filename)
+        versions = set(activity["version"] for activity in matches[i:i+LIMIT])
+        version = DUMP_VERSION_ATTRIBUTE.format(versions.pop()) if len(versions) == 1 and None not in versions else ""
+        with gzip.open(temp_path, "wb", compresslevel=iatifiles.GZIP_LEVEL) as output:
+            output.write(DUMP_HEADER.format(version=version, generated=generated).encode("utf-8"))
+            for activity in matches[i:i+LIMIT]:
+                output.write(activity["data"])
+            output.write(DUMP_FOOTER.encode("utf-8"))
+        os.replace(temp_path, filename)
+        print(filename, "...", file=sys.stderr)
+
+    print("{} matching activities ({} unique) in {} files".format(total, len(matches), len(paths)), file=sys.stderr)
+
+
+#
+# Main functions
+#
+
+def download_pages (output_dir, concurrency=CONCURRENCY, retries=RETRIES, url_base=DPORTAL_URL, since=None):
+    """ Download pages of IATI activities into the specified directory
+    Fetches up to concurrency pages at once, and resumes an interrupted download
+    from the pages recorded in the manifest (doing nothing if it's already complete).
+    If since is provided, fetch only activities updated at or after that timestamp.
+
+    """
+    manifest = load_manifest(output_dir, query_signature(url_base, since))
+    if manifest["complete"]:
+        return
+
+    # Pages recorded in the manifest are already done; None means an empty page (end of results)
+    pages_done = {int(page): filename for page, filename in manifest["pages"].items()}
+    empty_pages = [page for page, filename in pages_done.items() if filename is None]
+    end_page = min(empty_pages) if empty_pages else None
+
+    session = make_session(concurrency)
+    next_page = 1
+    futures = {}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        try:
+            while True:
+
+                # Keep up to concurrency pages in flight, stopping at the end of the results
+                while len(futures) < concurrency and (end_page is None or next_page < end_page):
+                    if next_page not in pages_done:
+                        future = executor.submit(fetch_page, session, url_base, output_dir, next_page, retries, since)
+                        futures[future] = next_page
+                    next_page += 1
+
+                if not futures:
+                    break
+
+                done, pending = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    page = futures.pop(future)
+                    filename = future.result()
+                    manifest["pages"][str(page)] = None if filename is None else filename.name
+                    save_manifest(output_dir, manifest)
+                    if filename is None:
+                        if end_page is None or page < end_page:
+                            end_page = page
+                    else:
+                        # could replace with a proper logging function
+                        print(filename, "...", file=sys.stderr)
+
+        except:
+            # Don't start any more pages; the manifest lets the next run resume from here
+            for future in futures:
+                future.cancel()
+            raise
+
+    # Discard any pages fetched past the end of the results (shouldn't normally happen)
+    for page, filename in list(manifest["pages"].items()):
+        if int(page) > end_page:
+            if filename:
+                (output_dir / filename).unlink(missing_ok=True)
+            del manifest["pages"][page]
+
+    manifest["complete"] = True
+    save_manifest(output_dir, manifest)
+
+def main (output_dir, concurrency=CONCURRENCY, retries=RETRIES, url_base=DPORTAL_URL, full=False, dump_dir=None):
+    """ Download or update IATI activities in the specified output directory
+    If there's a state file from an earlier download, fetch only the activities
+    updated since then, and merge them in. Otherwise (or if full is True), download
+    everything from scratch.
+    If dump_dir is provided, read the activities from local bulk-dump files instead.
+
+    """
+    output_dir = pathlib.Path(output_dir) # wrap as a pathlib object
+    state = load_state(output_dir)
+
+    if dump_dir is not None:
+        ingest_dump(dump_dir, output_dir)
+    elif full or state is None or state["last_updated"] is None:
+        if state is not None:
+            # Start a new full download; the state gets saved again only when it's complete
+            remove_pages(output_dir)
+            (output_dir / STATE_FILE).unlink()
+        download_pages(output_dir, concurrency, retries, url_base)
+    else:
+        delta_dir = output_dir / DELTA_DIR
+        delta_dir.mkdir(exist_ok=True)
+        download_pages(delta_dir, concurrency, retries, url_base, since=state["last_updated"])
+        merge_delta(output_dir, delta_dir, state)
+        shutil.rmtree(delta_dir)
+
+    save_state(output_dir, scan_store(output_dir))
 
 #
 # Script entry point
 #
 if __name__ == "__main__":
-    if len(sys.argv) == 2:
-        main(sys.argv[1])
-        exit(0)
-    else:
-        print("Usage: python3 download-iati.py <output_dir>", file=sys.stderr)
-        exit(2)
+    argparser = argparse.ArgumentParser(description="Download COVID-19 IATI activities from D-Portal")
+    argparser.add_argument("--concurrency", type=int, default=CONCURRENCY, metavar="N", help="Maximum number of pages to download at once (default: {})".format(CONCURRENCY))
+    argparser.add_argument("--retries", type=int, default=RETRIES, metavar="N", help="Number of times to retry a failed page (default: {})".format(RETRIES))
+    argparser.add_argument("--url", default=DPORTAL_URL, help="URL base for D-Portal queries (e.g. for a local test server)")
+    argparser.add_argument("--full", action="store_true", help="Download everything again, instead of only activities updated since the last run")
+    argparser.add_argument("--dump", metavar="DIR", help="Read activities from a directory of IATI XML dumps instead of D-Portal, filtering them locally")
+    argparser.add_argument("output_dir", help="Directory for the downloaded files")
+    args = argparser.parse_args()
+    main(args.output_dir, concurrency=args.concurrency, retries=args.retries, url_base=args.url, full=args.full, dump_dir=args.dump)
+    exit(0)
 
 # end
@@ -1,9 +1,26 @@
 """ Compile total values by month, org, sector, and country for IATI activities
 Also disaggregate by strict vs loose C19, and humanitarian status
 
+Usage:
+
+    python3 generate-data.py [--workers N] [--parser diterator|streaming] [--sort-buffer ROWS] [--cache-dir DIR] [--latest] [--resolve-orgs] [--shards] [--sqlite FILE] [--max-memory MB] [--metrics FILE] [--profile FILE] <output_dir> <xml_file ...>
+    python3 generate-data.py [options] --watch <download_dir> [--interval SECONDS] <output_dir>
+
+XML files can be gzipped (with names ending in .gz), as download-iati.py saves them.
+
 """
 
-import datetime, diterator, hxl, logging, re, sys
+import argparse, array, bisect, collections, contextlib, cProfile, csv, datetime, diterator, diterator.wrappers, functools, glob, gzip, hashlib, heapq, iatifiles, iatiparser, io, itertools, json, logging, multiprocessing, operator, os, os.path, pickle, re, resource, shutil, sqlite3, sys, tempfile, time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 logger = logging.getLogger(__name__)
 
@@ -77,6 +94,96 @@ FLOW_HEADERS = [
     ],
 ]
 
+ROLLUP_FILE_TEMPLATE = "rollup-{}.{}"
+""" Filename template for the pre-aggregated rollups, with the rollup name and the extension ("json" or "csv") """
+
+ROLLUPS = [
+    ("total", []),
+    ("month", [0]),
+    ("org", [1]),
+    ("sector", [3]),
+    ("country", [4]),
+    ("country-month", [4, 0]),
+]
+""" Pre-aggregated rollups of the transactions, as (name, columns) tuples
+Each rollup groups the transactions by its columns from TRANSACTION_HEADERS plus
+ROLLUP_FLAG_COLUMNS, and sums the net and total money.
+
+"""
+
+ROLLUP_FLAG_COLUMNS = [5, 6, 7]
+""" Columns that every rollup groups by (humanitarian, strict, and transaction type), so the viz can still filter on them """
+
+ROLLUP_VALUE_COLUMNS = [9, 10]
+""" Columns that the rollups sum (net money and total money) """
+
+SHARDS_DIR = "shards"
+""" Subdirectory of the output directory for partitioned transaction shards """
+
+SHARD_INDEX_FILE = "index.json"
+""" Filename for the manifest of shards, in SHARDS_DIR """
+
+SHARD_PARTITIONS = [
+    ("country", 4),
+    ("month", 0),
+]
+""" Ways to partition the transactions into shards, as (name, column) tuples; each name is a subdirectory of SHARDS_DIR """
+
+SHARD_BUFFER_ROWS = 10000
+""" Maximum number of rows to buffer for a shard before appending them to its files """
+
+SLUG_PATTERN = re.compile(r'[^a-z0-9]+')
+""" Regular expression for characters to replace in shard filenames (see make_slug()) """
+
+MANIFEST_FILE = "manifest.json"
+""" Filename for the hashes of the output (see make_manifest()), in the output directory """
+
+CHANGES_FILE = "changes.json"
+""" Filename for the report of what changed since the previous run (see compare_manifests()), in the output directory """
+
+MANIFEST_PARTITION_COLUMNS = (4, 0,)
+""" Columns that partition the transactions for the manifest hashes (country and month) """
+
+TRANSACTION_COLUMNS = [
+    "month",
+    "reporting_org",
+    "reporting_org_type",
+    "sector",
+    "country",
+    "humanitarian",
+    "strict",
+    "transaction_type",
+    "activity_id",
+    "net_money",
+    "total_money",
+]
+""" SQL column names for the transactions table (same order as TRANSACTION_HEADERS) """
+
+FLOW_COLUMNS = [
+    "reporting_org",
+    "reporting_org_type",
+    "provider_org",
+    "receiver_org",
+    "humanitarian",
+    "strict",
+    "transaction_type",
+    "transaction_direction",
+    "total_money",
+]
+""" SQL column names for the flows table (same order as FLOW_HEADERS) """
+
+SQLITE_INDEXED_COLUMNS = ["activity_id", "reporting_org", "country", "sector", "month"]
+""" Transaction columns to index in the SQLite export """
+
+SQLITE_TRANSACTION_INTEGER_COLUMNS = [5, 6, 9, 10]
+""" Transaction columns to store as integers in the SQLite export (the rest are text) """
+
+SQLITE_FLOW_INTEGER_COLUMNS = [4, 5, 8]
+""" Flow columns to store as integers in the SQLite export (the rest are text) """
+
+SQLITE_BATCH_ROWS = 10000
+""" Number of rows to insert at a time in the SQLite export """
+
 TRANSACTION_TYPE_INFO = {
     "1": {
         "label": "Incoming Funds",
@@ -105,6 +212,99 @@ TRANSACTION_TYPE_INFO = {
     },
 }    
 
+ORG_IDENTIFIERS_JSON = "data/IATIOrganisationIdentifier.json"
+""" Org identifiers and names from code4iati """
+
+COUNTRIES_JSON = "data/countries.json"
+""" Country codes and names """
+
+SECTOR_MAP_JSON = "data/dac3-sector-map.json"
+""" Map from DAC3 purpose codes to DAC groups """
+
+FALLBACK_RATES_JSON = "data/fallbackrates.json"
+""" Exchange rates from USD """
+
+HISTORICAL_RATES_GLOB = "data/rates/*.json"
+""" Optional historical exchange rates from USD, daily or monthly (see load_historical_rates()) """
+
+REFERENCE_SNAPSHOT_FILE = "reference-data.pickle"
+""" Filename for the snapshot of reference-data indexes, in the cache directory """
+
+PARSERS = {
+    "diterator": diterator.XMLIterator,
+    "streaming": iatiparser.ActivityIterator,
+}
+""" Activity iterators to choose from: the full diterator object model, or the faster streaming parser (same results) """
+
+SORT_BUFFER_ROWS = 1000000
+""" Default maximum number of transaction rows to keep in memory before spilling a sorted run to disk """
+
+SORT_RUN_CHUNK_ROWS = 10000
+""" Number of rows to pickle at a time in a sorted run """
+
+MEMORY_CHECK_ACTIVITIES = 1000
+""" With --max-memory, the number of activities to merge between checks of the memory use """
+
+MEMORY_MIN_SPILL_ROWS = 10000
+""" With --max-memory, the fewest transaction rows or distinct flows worth spilling to disk (so that memory that Python doesn't give back doesn't cause lots of tiny spills) """
+
+TRANSACTION_COLUMN_TYPES = [
+    "code", # month
+    "code", # reporting org
+    "code", # reporting org type
+    "code", # sector
+    "code", # recipient country
+    "b",    # humanitarian (0 or 1)
+    "b",    # strict (0 or 1)
+    "code", # transaction type
+    "code", # activity id
+    "q",    # net money
+    "q",    # total money
+]
+""" How TransactionSink stores each column: "code" for a dictionary-encoded string, or an array typecode """
+
+CODE_TYPECODE = "I"
+""" Array typecode for dictionary codes """
+
+REFERENCE_DATA_GLOBS = ["data/*.json", HISTORICAL_RATES_GLOB]
+""" Reference data that the results depend on (for cache invalidation) """
+
+PUNCTUATION_PATTERN = re.compile(r'^\W*(\w.*)\W*$')
+""" Regular expression for stripping punctuation from the start/end of a string (see clean_string()) """
+
+WHITESPACE_PATTERN = re.compile(r'\s+')
+""" Regular expression for normalising whitespace (see clean_string()) """
+
+C19_NARRATIVE_PATTERN = re.compile(r'(COVID-19)|\b(?:COVID|CORONAVIRUS)\b')
+""" Regular expression for upper-case narrative text: group 1 is the strict "COVID-19" test, and the rest are the looser D-Portal keywords (see classify_narratives()) """
+
+C19_NARRATIVE_CACHE_SIZE = 4096
+""" Number of narrative texts to remember the classification for (transactions often repeat a description), see narrative_classes """
+
+MONTH_PATTERN = re.compile(r'^\d{4}-\d{2}')
+""" Regular expression for the start of an ISO 8601 date, up to the month """
+
+SPLIT_ARRAY_MIN_ROWS = 32
+""" Minimum number of country × sector rows for a split to use NumPy arrays instead of Python arithmetic (see split_values()) """
+
+RESULT_CACHE_FILE = "activity-results.sqlite"
+""" Filename for the cache of per-activity results, in the cache directory """
+
+ACTIVITY_INDEX_FILE = "activity-index.sqlite"
+""" Filename for the byte-offset index of activities (see iatifiles.ActivityIndex), in the cache directory """
+
+CHUNK_BYTES = 8 * 1024 * 1024
+""" Approximate bytes of activity XML in each unit of work, when working from the activity index """
+
+ORG_NAME_INDEX_FILE = "org-names.sqlite"
+""" Filename for the counts of the names used for each org ref (see OrgNameIndex), in the cache directory """
+
+WATCH_GLOB = "iati-activities-*.xml*"
+""" Filename pattern for the IATI files in a directory watched with --watch (download-iati.py's temporary files start with a dot, so they don't match) """
+
+WATCH_INTERVAL = 5
+""" Default seconds between checks of a directory watched with --watch """
+
 #
 # Global variables
 #
@@ -112,9 +312,24 @@ TRANSACTION_TYPE_INFO = {
 json_files = {}
 """ Cache for loaded JSON files """
 
+reference_data = None
+""" Indexes built from the reference data (see build_reference_data()) """
+
+reference_signature = None
+""" Signature of the reference-data files that reference_data was built from (see get_reference_signature()) """
+
 org_names = None
 """ Map from IATI identifiers to organisation names """
 
+result_caches = {}
+""" Open ResultCache objects for this process, keyed by path """
+
+narrative_classes = {}
+""" Memo of narrative text to classification for classify_narrative_batch() (cleared when it's full) """
+
+activity_counters = collections.Counter()
+""" Counters and timers updated by process_activity() and friends, in whichever process runs them (see snapshot_counters()) """
+
 
 #
 # Utility functions
@@ -128,38 +343,208 @@ def load_json (filename):
             json_files[filename] = json.load(input)
     return json_files[filename]
 
+def name_file_errors (function):
+    """ Decorator for functions that run in worker processes, and take a filename (or a tuple starting with one) first
+    Re-raises any exception as a RuntimeError that names the file. Some parser exceptions
+    (e.g. xml.sax's SAXParseException) can't be unpickled in the parent process, which
+    breaks the multiprocessing pool and leaves it waiting forever.
+
+    """
+    @functools.wraps(function)
+    def wrapper (item, *args, **kwargs):
+        try:
+            return function(item, *args, **kwargs)
+        except Exception as e:
+            filename = item if isinstance(item, str) else item[0]
+            raise RuntimeError("{}: {}".format(filename, e)) from e
+    return wrapper
+
+@functools.lru_cache(maxsize=65536)
 def clean_string (s):
-    """ Normalise whitespace in a single, and remove any punctuation at the start/end """
-    s = re.sub(r'^\W*(\w.*)\W*$', r'\1', s)
-    s = re.sub(r'\s+', ' ', s)
+    """ Normalise whitespace in a single, and remove any punctuation at the start/end
+    Memoised, because we see the same org names and refs over and over.
+
+    """
+    s = PUNCTUATION_PATTERN.sub(r'\1', s)
+    s = WHITESPACE_PATTERN.sub(' ', s)
     return s.strip()
 
+
+#
+# Reference data
+#
+
+def build_reference_data ():
+    """ Build lookup indexes from the reference data files
+    Returns a dict with the following, each a dict for O(1) lookups:
+    countries - ISO2 code to country name (first match wins, like the original linear scan)
+    sector_groups - DAC3 code to DAC group name
+    rates - currency code to exchange rate from USD
+    org_names - normalised org identifier to normalised name
+
+    """
+    countries = {}
+    for info in load_json(COUNTRIES_JSON)["data"]:
+        countries.setdefault(info["iso2"], info["label"]["default"])
+
+    sector_groups = {code: info["dac-group"] for code, info in load_json(SECTOR_MAP_JSON).items()}
+
+    rates = dict(load_json(FALLBACK_RATES_JSON)["rates"])
+
+    historical_rates = load_historical_rates(sorted(glob.glob(HISTORICAL_RATES_GLOB)))
+
+    org_names = {}
+    for entry in load_json(ORG_IDENTIFIERS_JSON)["data"]:
+        org_names[clean_string(entry["code"]).lower()] = clean_string(entry["name"])
+
+    return {
+        "countries": countries,
+        "sector_groups": sector_groups,
+        "rates": rates,
+        "historical_rates": historical_rates,
+        "org_names": org_names,
+    }
+
+def load_historical_rates (filenames):
+    """ Build a monthly index of historical exchange rates from USD
+    Each file may hold a single day's rates, like data/fallbackrates.json, or a
+    time series with a dict of rates for each date. The rates for a month are
+    the mean of all the rates we have for dates in that month, so daily and
+    monthly files both work.
+    Returns a dict with a (months, rates) tuple of parallel sorted lists for each
+    currency, ready for bisecting (see lookup_usd_rate()).
+
+    """
+    daily_rates = {}
+    for filename in filenames:
+        info = load_json(filename)
+        if info.get("base", "USD") != "USD":
+            logger.warning("Skipping exchange rates in %s (base currency is not USD)", filename)
+            continue
+        if "date" in info:
+            dated_rates = {info["date"]: info["rates"]}
+        else:
+            dated_rates = info["rates"]
+        for date, rates in dated_rates.items():
+            for currency, rate in rates.items():
+                if rate:
+                    daily_rates.setdefault(currency.upper(), {})[date] = rate
+
+    historical_rates = {}
+    for currency, rates in daily_rates.items():
+        monthly_rates = {}
+        for date, rate in rates.items():
+            monthly_rates.setdefault(date[:7], []).append(rate)
+        months = sorted(monthly_rates)
+        historical_rates[currency] = (months, [sum(monthly_rates[month]) / len(monthly_rates[month]) for month in months],)
+    return historical_rates
+
+def get_reference_filenames ():
+    """ Return a list of all the reference-data files that the results depend on """
+    filenames = []
+    for pattern in REFERENCE_DATA_GLOBS:
+        filenames += sorted(glob.glob(pattern))
+    return filenames
+
+def get_reference_signature ():
+    """ Return a signature of the reference-data files as they are on disk now """
+    hash = hashlib.sha1()
+    for filename in get_reference_filenames():
+        with open(filename, "rb") as input:
+            hash.update(input.read())
+    return hash.hexdigest()
+
+@functools.lru_cache(maxsize=None)
+def get_code_signature ():
+    """ Return a signature of the processing code (this script and the modules it uses)
+    Memoised, so a long-running process (--watch) keeps the signature of the code it
+    started with, even if the files change later.
+
+    """
+    hash = hashlib.sha1()
+    for filename in [__file__, iatifiles.__file__, iatiparser.__file__]:
+        with open(filename, "rb") as input:
+            hash.update(input.read())
+    return hash.hexdigest()
+
+def load_reference_data (cache_dir=None):
+    """ Load the reference-data indexes into memory, if they're not already there
+    If cache_dir is provided, load them from a snapshot there, and (re)build the
+    snapshot only if it's missing or the source JSON (or the code) has changed.
+    Records the signature of the files loaded in reference_signature.
+
+    """
+    global reference_data, reference_signature
+
+    if reference_data is not None:
+        return reference_data
+
+    signature = get_reference_signature()
+
+    if cache_dir is None:
+        reference_data = build_reference_data()
+        reference_signature = signature
+        return reference_data
+
+    snapshot_signature = get_code_signature() + signature
+    path = os.path.join(cache_dir, REFERENCE_SNAPSHOT_FILE)
+    if os.path.exists(path):
+        with open(path, "rb") as input:
+            saved_signature, snapshot = pickle.load(input)
+        if saved_signature == snapshot_signature:
+            reference_data = snapshot
+            reference_signature = signature
+            return reference_data
+
+    logger.info("Rebuilding reference-data snapshot %s", path)
+    reference_data = build_reference_data()
+    reference_signature = signature
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(path + ".tmp", "wb") as output:
+        pickle.dump((snapshot_signature, reference_data,), output, pickle.HIGHEST_PROTOCOL)
+    os.replace(path + ".tmp", path)
+    return reference_data
+
+def has_reference_data_changed ():
+    """ Check if the reference-data files have changed since they were loaded """
+    return reference_data is not None and get_reference_signature() != reference_signature
+
+def unload_reference_data ():
+    """ Forget the reference data, and everything derived from it, so that the next lookup loads it again """
+    global reference_data, reference_signature, org_names
+    reference_data = None
+    reference_signature = None
+    org_names = None
+    json_files.clear()
+    lookup_usd_rate.cache_clear()
+    clean_string.cache_clear()
+
 #
 # Lookup functions
 #
 
-def get_org_name (org):
+def get_org_key (org):
+    """ Return a normalised (name, ref) tuple for an organisation, to use with lookup_org_name() """
+    name = None if org is None or org.name is None else clean_string(str(org.name))
+    ref = None if org is None or org.ref is None else clean_string(str(org.ref)).lower()
+    return (name, ref,)
+
+def lookup_org_name (name, ref):
     """ Standardise organisation names
-    For now, use the first name found for an identifier.
-    Later, we can reference the registry.
+    Use the name from code4iati for an identifier if there is one. Otherwise, use the
+    first name found for the identifier, unless resolve_org_names() has already chosen one.
 
     """
     global org_names
 
     # Prime with org identifiers from code4iati
     if org_names is None:
-        map = load_json("data/IATIOrganisationIdentifier.json")
-        org_names = {}
-        for entry in map["data"]:
-            code = clean_string(entry["code"]).lower()
-            org_names[code] = clean_string(entry["name"])
-
-    name = None if org is None or org.name is None else clean_string(str(org.name))
-    ref = None if org is None or org.ref is None else clean_string(str(org.ref)).lower()
+        org_names = dict(load_reference_data()["org_names"])
 
     # We have a ref and an existing match
     if ref and ref in org_names:
         # existing match
+        metrics.count("org_names.matched")
         return org_names[ref]
 
     # No existing match, but we have a name
@@ -167,39 +552,206 @@ def get_org_name (org):
         if ref is not None:
             # if there's a ref, save it for future matching
             org_names[ref] = name
+        metrics.count("org_names.new")
         return name
 
     # We can't figure out anything
+    metrics.count("org_names.unknown")
     return DEFAULT_ORG
 
+def get_org_name (org):
+    """ Standardise the name of an organisation object (see lookup_org_name()) """
+    return lookup_org_name(*get_org_key(org))
+
 def get_sector_group_name (code):
     """ Look up a group name for a 3- or 5-digit sector code.
 
     """
-    sector_info = load_json("data/dac3-sector-map.json")
-    code = code[:3]
-    if code in sector_info:
-        return sector_info.get(code)["dac-group"]
-    else:
-        return "(Unspecified sector)"
+    return load_reference_data()["sector_groups"].get(code[:3], "(Unspecified sector)")
 
 def get_country_name (code):
-    country_info = load_json("data/countries.json")
-    for info in country_info["data"]:
-        if info["iso2"] == code:
-            return info["label"]["default"]
-    return "(Unspecified country)"
+    """ Look up a country name for an ISO2 code """
+    return load_reference_data()["countries"].get(code, "(Unspecified country)")
+
+def get_usd_rate (currency, isodate):
+    """ Look up the exchange rate from USD to a currency for a date
+    Fallback policy:
+    1. If we have historical rates for the currency, use the rate for the date's
+       month, or the nearest month we have if the date is outside the range.
+    2. If the date is missing or malformed, or there are no historical rates for
+       the currency, use the rate from data/fallbackrates.json.
+    3. If the currency isn't there either, return None.
+
+    """
+    return lookup_usd_rate(currency, get_rate_month(isodate))
+
+def get_rate_month (isodate):
+    """ Return the YYYY-MM month of a date for looking up exchange rates, or None if it's missing or malformed """
+    return isodate[:7] if isodate and MONTH_PATTERN.match(isodate) else None
+
+@functools.lru_cache(maxsize=None)
+def lookup_usd_rate (currency, month):
+    """ Look up the exchange rate from USD to a currency for a YYYY-MM month (or None) - see get_usd_rate()
+    Memoised, since most transactions share a handful of currencies and months.
+
+    """
+    reference = load_reference_data()
+    if month is not None and currency in reference["historical_rates"]:
+        months, rates = reference["historical_rates"][currency]
+        i = bisect.bisect_right(months, month)
+        return rates[i - 1] if i > 0 else rates[0]
+    return reference["rates"].get(currency)
 
 def convert_to_usd (value, source_currency, isodate):
-    # FIXME not using date
-    source_currency = source_currency.upper().strip()
-    if value != 0.0 and source_currency != "USD":
-        rates = load_json("data/fallbackrates.json")
-        if source_currency in rates["rates"]:
-            value /= rates["rates"][source_currency]
+    """ Convert a value to USD, using the exchange rate for the date (see get_usd_rate())
+    Returns 0 if we can't find an exchange rate for the currency.
+
+    """
+    return convert_all_to_usd([(value, source_currency, isodate,)])[0]
+
+def convert_all_to_usd (items):
+    """ Convert a batch of (value, currency, isodate) tuples to USD, returning a list of ints
+    Looks up the exchange rate (see get_usd_rate()) only once for each currency and
+    month in the batch. Values in a currency without an exchange rate convert to 0.
+
+    """
+    rates = {}
+    usd_values = []
+    for value, currency, isodate in items:
+        currency = currency.upper().strip()
+        if value != 0.0 and currency != "USD":
+            key = (currency, get_rate_month(isodate),)
+            if key not in rates:
+                rates[key] = lookup_usd_rate(*key)
+            rate = rates[key]
+            if rate is not None:
+                value /= rate
+            else:
+                activity_counters["transactions.unknown_currency"] += 1
+                value = 0
+        usd_values.append(int(round(value)))
+    return usd_values
+
+
+#
+# Organisation names
+#
+
+class OrgNameIndex:
+    """ Count how often each name appears with each org ref, in a set of IATI XML files
+    Stored in SQLite (use ":memory:" for a throwaway index). Like iatifiles.ActivityIndex,
+    update() rescans only the files whose size or modification time has changed.
+
+    """
+
+    def __init__ (self, path=":memory:"):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS files (filename TEXT PRIMARY KEY, size INTEGER, mtime INTEGER)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS names (filename TEXT, ref TEXT, name TEXT, count INTEGER)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS names_filename ON names (filename)")
+        self.connection.commit()
+
+    def update (self, filenames, workers=1):
+        """ Bring the counts up to date for a list of files, dropping any other files
+        Scans the changed files in a pool of worker processes if workers is greater than 1.
+        Returns the number of files (re)scanned.
+
+        """
+        known = {filename: (size, mtime,) for filename, size, mtime in self.connection.execute("SELECT filename, size, mtime FROM files")}
+        stats = {filename: os.stat(filename) for filename in filenames}
+        changed = [filename for filename in filenames if known.get(filename) != (stats[filename].st_size, stats[filename].st_mtime_ns,)]
+
+        if workers > 1 and len(changed) > 1:
+            pool = multiprocessing.Pool(workers)
+            file_counts = pool.imap(count_org_names, changed)
         else:
-            value = 0
-    return int(round(value))
+            pool = None
+            file_counts = map(count_org_names, changed)
+
+        try:
+            for filename, counts in zip(changed, file_counts):
+                self.remove(filename)
+                self.connection.executemany("INSERT INTO names VALUES (?, ?, ?, ?)", ((filename, ref, name, count,) for (ref, name), count in counts.items()))
+                self.connection.execute("INSERT INTO files VALUES (?, ?, ?)", (filename, stats[filename].st_size, stats[filename].st_mtime_ns,))
+        except BaseException:
+            if pool is not None:
+                # don't wait for the rest of the files
+                pool.terminate()
+                pool = None
+            raise
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        for filename in set(known).difference(filenames):
+            self.remove(filename)
+        self.connection.commit()
+        return len(changed)
+
+    def remove (self, filename):
+        """ Drop a file from the index (doesn't commit) """
+        self.connection.execute("DELETE FROM names WHERE filename=?", (filename,))
+        self.connection.execute("DELETE FROM files WHERE filename=?", (filename,))
+
+    def resolve (self):
+        """ Return a dict with the canonical name for each ref
+        That's the name used most often with the ref across all the files, and the
+        first in alphabetical order if there's a tie, so it doesn't depend on file order.
+
+        """
+        names = {}
+        for ref, name, count in self.connection.execute("SELECT ref, name, SUM(count) FROM names GROUP BY ref, name ORDER BY ref, SUM(count) DESC, name"):
+            if ref not in names:
+                names[ref] = name
+        return names
+
+
+@name_file_errors
+def count_org_names (filename):
+    """ Count the (ref, name) pairs of all the reporting, provider, and receiver orgs in an IATI XML file
+    Uses get_org_key() to normalise them, and counts only orgs with both a ref and a name.
+    Returns a Counter.
+
+    """
+    counts = collections.Counter()
+    input = iatifiles.open_file(filename)
+    try:
+        for activity in iatiparser.ActivityIterator(input):
+            orgs = [activity.reporting_org]
+            for transaction in activity.transactions:
+                orgs.append(transaction.provider_org)
+                orgs.append(transaction.receiver_org)
+            for org in orgs:
+                if org is not None:
+                    name, ref = get_org_key(org)
+                    if name and ref:
+                        counts[(ref, name,)] += 1
+    finally:
+        input.close()
+    return counts
+
+def resolve_org_names (filenames, workers=1, cache_dir=None, memo=None):
+    """ Choose a canonical name for every org ref in a list of files, before merging any activities
+    Primes the org-name map used by lookup_org_name() with the code4iati names,
+    then the most common name for each other ref (see OrgNameIndex.resolve()),
+    so that the names don't depend on the order of the files or activities.
+    The counts are kept in cache_dir (or in memo, for --watch) between runs.
+
+    """
+    global org_names
+
+    if memo is not None and "org_index" in memo:
+        index = memo["org_index"]
+    else:
+        index = OrgNameIndex(":memory:" if cache_dir is None else os.path.join(cache_dir, ORG_NAME_INDEX_FILE))
+        if memo is not None:
+            memo["org_index"] = index
+    logger.info("Counted org names in %d changed files", index.update(filenames, workers))
+
+    org_names = dict(load_reference_data()["org_names"])
+    for ref, name in index.resolve().items():
+        org_names.setdefault(ref, name)
 
 
 #
@@ -260,6 +812,33 @@ def make_sector_splits(entity, default_splits=None, default_sector="99999"):
         return { default_sector: 1.0 }
 
 
+def split_values (value, net_value, country_splits, sector_splits):
+    """ Apply country and sector percentage splits to a transaction's total and net values
+    Returns a tuple of (net_moneys, total_moneys), two lists of ints with one entry for each
+    country × sector pair, countries outer and sectors inner (the order of the splits dicts).
+    Each entry is exactly int(round(value * country_percentage * sector_percentage)):
+    the array version multiplies in the same order, and rint() rounds half to even like round().
+    Uses NumPy for large splits, if it's installed.
+
+    """
+    country_percentages = list(country_splits.values())
+    sector_percentages = list(sector_splits.values())
+
+    if numpy is not None and len(country_percentages) * len(sector_percentages) >= SPLIT_ARRAY_MIN_ROWS:
+        countries = numpy.array(country_percentages)
+        sectors = numpy.array(sector_percentages)
+        # go through Python floats rather than int64, so huge values can't overflow
+        return (
+            [int(n) for n in numpy.rint(numpy.multiply.outer(net_value * countries, sectors)).ravel().tolist()],
+            [int(n) for n in numpy.rint(numpy.multiply.outer(value * countries, sectors)).ravel().tolist()],
+        )
+    else:
+        return (
+            [int(round(net_value * c * s)) for c in country_percentages for s in sector_percentages],
+            [int(round(value * c * s)) for c in country_percentages for s in sector_percentages],
+        )
+
+
 def has_c19_scope (scopes):
     """ Check if the COVID-19 GLIDE number or HRP code is present """
     for scope in scopes:
@@ -283,261 +862,1976 @@ def has_c19_sector (sectors):
             return True
     return False
 
-def is_c19_narrative (narratives):
-    """ Check a dict of different-language text for the string "COVID-19" (case-insensitive) """
-    for lang, text in narratives.items():
-        if "COVID-19" in text.upper():
+def classify_narratives (narratives):
+    """ Classify a dict of different-language text in a single pass over all the languages
+    Returns "strict" if any of them contains the string "COVID-19" (case-insensitive),
+    "loose" if any contains only the whole words COVID or CORONAVIRUS (the D-Portal
+    keywords), or None.
+
+    """
+    return classify_narrative_batch([narratives])[0]
+
+def classify_narrative_batch (narratives_list):
+    """ Classify a list of dicts of different-language text (or None) at once - see classify_narratives()
+    Returns a list with "strict", "loose", or None for each. The texts that aren't in
+    narrative_classes already are upper-cased and joined, and C19_NARRATIVE_PATTERN
+    scans them all in one go. None of its matches can cross the newlines between them.
+
+    """
+    texts = [None if narratives is None else "\n".join(narratives.values()) for narratives in narratives_list]
+    new_texts = list(dict.fromkeys(text for text in texts if text is not None and text not in narrative_classes))
+    activity_counters["cache.c19_narrative.misses"] += len(new_texts)
+    activity_counters["cache.c19_narrative.hits"] += len(texts) - texts.count(None) - len(new_texts)
+
+    if new_texts:
+        if len(narrative_classes) + len(new_texts) > C19_NARRATIVE_CACHE_SIZE:
+            narrative_classes.clear()
+        pieces = [text.upper() for text in new_texts]
+        # offset of the start of each piece in the joined text
+        starts = list(itertools.accumulate((len(piece) + 1 for piece in pieces[:-1]), initial=0))
+        classes = [None] * len(pieces)
+        for match in C19_NARRATIVE_PATTERN.finditer("\n".join(pieces)):
+            i = bisect.bisect_right(starts, match.start()) - 1
+            if match.group(1):
+                classes[i] = "strict"
+            elif classes[i] is None:
+                classes[i] = "loose"
+        narrative_classes.update(zip(new_texts, classes))
+
+    return [None if text is None else narrative_classes[text] for text in texts]
+
+def get_descriptions (activity):
+    """ Return a NarrativeText object for each of an activity's descriptions (of any type)
+    diterator's description property has only the first one, so use its nodes directly.
+
+    """
+    if isinstance(activity, iatiparser.Activity):
+        return activity.descriptions
+    return [diterator.wrappers.NarrativeText(node, activity) for node in activity.get_nodes("description")]
+
+def get_own_sectors (transaction):
+    """ Return the sectors that a transaction has itself, without falling back on its activity's
+    diterator's sectors property falls back, so use its nodes directly.
+
+    """
+    if isinstance(transaction, iatiparser.Transaction):
+        return transaction.own_sectors
+    return [diterator.wrappers.CodedItem(node, transaction.activity) for node in transaction.get_nodes("sector")]
+
+def classify_activity (activity, counters=None):
+    """ Return the name of the first strict COVID-19 rule that an activity matches, or None
+    The rules are "scope", "tag", "sector", and "title", checked in that order.
+    Counts the rule in counters (default: activity_counters) as c19.activity.*. For activities that
+    don't match, also counts titles that match only the looser D-Portal keywords
+    (as c19.loose.title), or failing that, descriptions that match the keywords
+    (as c19.loose.activity_description) - D-Portal checks both, but only the title
+    counts for the strict rules. The title and descriptions are classified in one batch.
+
+    """
+    if counters is None:
+        counters = activity_counters
+    if has_c19_scope(activity.humanitarian_scopes):
+        rule = "scope"
+    elif has_c19_tag(activity.tags):
+        rule = "tag"
+    elif has_c19_sector(activity.sectors):
+        rule = "sector"
+    else:
+        narratives = [None if activity.title is None else activity.title.narratives]
+        narratives += [description.narratives for description in get_descriptions(activity)]
+        title, *descriptions = classify_narrative_batch(narratives)
+        if title == "strict":
+            rule = "title"
+        else:
+            rule = None
+            if title == "loose":
+                counters["c19.loose.title"] += 1
+            elif any(descriptions):
+                counters["c19.loose.activity_description"] += 1
+    counters["c19.activity.{}".format(rule if rule else "none")] += 1
+    return rule
+
+def classify_transaction (transaction, description, counters=None):
+    """ Return the name of the first strict COVID-19 rule that a transaction of a non-strict activity matches, or None
+    The rules are "sector" and "description". The description is the classification of
+    the transaction's description, from classify_transaction_descriptions().
+    Only the transaction's own sectors count, since classify_activity() has
+    already ruled out the activity's.
+    Counts the rule in counters (default: activity_counters) as c19.transaction.*, along
+    with descriptions that only match the looser D-Portal keywords (as c19.loose.description).
+
+    """
+    if counters is None:
+        counters = activity_counters
+    if has_c19_sector(get_own_sectors(transaction)):
+        rule = "sector"
+    elif description == "strict":
+        rule = "description"
+    else:
+        rule = None
+        if description == "loose":
+            counters["c19.loose.description"] += 1
+    counters["c19.transaction.{}".format(rule if rule else "none")] += 1
+    return rule
+
+def classify_transaction_descriptions (transactions):
+    """ Classify the descriptions of a list of transactions in one batch, for classify_transaction() """
+    return classify_narrative_batch([None if transaction.description is None else transaction.description.narratives for transaction in transactions])
+
+def summarise_transactions (transactions):
+    """ Convert and total an activity's transactions
+    Reads each transaction's fields only once, and converts the values of all the
+    transactions we use to USD in one batch (see convert_all_to_usd()).
+    Returns a dict with the following:
+    totals - the total USD value for each transaction type we use
+    commitment_factor - factor to apply to outgoing commitments for net new money
+    spending_factor - factor to apply to spending for net new money
+    transactions - a list of (transaction, type, date, value, usd_value) tuples in the
+    original order, where usd_value is None for transaction types we don't use
+    See METHODOLOGY.md for how the net factors work.
+
+    """
+    totals = {type: 0 for type in TRANSACTION_TYPE_INFO}
+    summaries = []
+
+    fields = [(transaction, transaction.type, transaction.date, transaction.value,) for transaction in transactions]
+    usd_values = iter(convert_all_to_usd([
+        (value, transaction.currency, transaction.value_date or date,) for transaction, type, date, value in fields if type in totals
+    ]))
+
+    for transaction, type, date, value in fields:
+        if type in totals:
+            usd_value = next(usd_values)
+            totals[type] += usd_value
+        else:
+            usd_value = None
+        summaries.append((transaction, type, date, value, usd_value,))
+
+    # Total up the 4 kinds of transactions
+    incoming_funds = totals["1"]
+    outgoing_commitments = totals["2"]
+    spending = totals["3"] + totals["4"]
+    incoming_commitments = totals["11"]
+
+    # Figure out total incoming money (never less than zero)
+    incoming = max(incoming_commitments, incoming_funds)
+    if incoming < 0:
+        incoming = 0
+
+    # Factor to apply to outgoing commitments for net new money
+    if incoming == 0:
+        commitment_factor = 1.0
+    elif outgoing_commitments > incoming:
+        commitment_factor = (outgoing_commitments - incoming) / outgoing_commitments
+    else:
+        commitment_factor = 0.0
+
+    # Factor to apply to outgoing spending for net new money
+    if incoming == 0:
+        spending_factor = 1.0
+    elif spending > incoming:
+        spending_factor = (spending - incoming) / spending
+    else:
+        spending_factor = 0.0
+
+    return {
+        "totals": totals,
+        "commitment_factor": commitment_factor,
+        "spending_factor": spending_factor,
+        "transactions": summaries,
+    }
+
+
+#
+# Result cache
+#
+
+class ResultCache:
+    """ Disk cache of process_activity() results, keyed by content hashes
+    Activity keys are hashes of the activity XML, and file keys are hashes of
+    the whole file, both combined with a signature of the code and reference
+    data (see make_cache_signature()), so a change to any of those is a miss.
+    Uses SQLite in WAL mode, so worker processes can read while the main
+    process writes.
+
+    """
+
+    def __init__ (self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS files (key TEXT PRIMARY KEY, activity_keys TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS activities (key TEXT PRIMARY KEY, result BLOB)")
+        self.connection.commit()
+
+    def get_file (self, file_key):
+        """ Return the list of activity keys for a file, or None if it's not cached """
+        row = self.connection.execute("SELECT activity_keys FROM files WHERE key=?", (file_key,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def get_activities (self, activity_keys):
+        """ Return a dict of cached (identifier, result) tuples for whichever of the activity keys are in the cache """
+        results = {}
+        keys = list(set(activity_keys))
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i+500]
+            query = "SELECT key, result FROM activities WHERE key IN ({})".format(",".join("?" * len(batch)))
+            for key, result in self.connection.execute(query, batch):
+                results[key] = pickle.loads(result)
+        return results
+
+    def put (self, file_key, activity_keys, new_results):
+        """ Save the activity keys for a file, plus any newly-computed (key, identifier, result) tuples """
+        self.connection.execute("INSERT OR REPLACE INTO files (key, activity_keys) VALUES (?, ?)", (file_key, json.dumps(activity_keys),))
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO activities (key, result) VALUES (?, ?)",
+            [(key, pickle.dumps((identifier, result,), pickle.HIGHEST_PROTOCOL),) for key, identifier, result in new_results]
+        )
+        self.connection.commit()
+
+    def prune (self, file_keys):
+        """ Remove everything not used by the files provided """
+        self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS used_files (key TEXT PRIMARY KEY)")
+        self.connection.execute("DELETE FROM used_files")
+        self.connection.executemany("INSERT OR IGNORE INTO used_files (key) VALUES (?)", [(key,) for key in file_keys])
+        used_activities = set()
+        for key in file_keys:
+            used_activities.update(self.get_file(key) or [])
+        self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS used_activities (key TEXT PRIMARY KEY)")
+        self.connection.execute("DELETE FROM used_activities")
+        self.connection.executemany("INSERT INTO used_activities (key) VALUES (?)", [(key,) for key in used_activities])
+        self.connection.execute("DELETE FROM files WHERE key NOT IN (SELECT key FROM used_files)")
+        self.connection.execute("DELETE FROM activities WHERE key NOT IN (SELECT key FROM used_activities)")
+        self.connection.commit()
+
+
+def get_result_cache (cache_dir):
+    """ Open the result cache in a directory, or reuse this process's existing connection """
+    path = os.path.join(cache_dir, RESULT_CACHE_FILE)
+    pid, cache = result_caches.get(path, (None, None,))
+    if pid != os.getpid():
+        # never share a connection with a forked process
+        cache = ResultCache(path)
+        result_caches[path] = (os.getpid(), cache,)
+    return cache
+
+def make_cache_signature (this_month):
+    """ Make a signature of everything besides the activity XML that the results depend on
+    That's the processing code, the reference data, and the current month. Uses the
+    signature of the reference data that's actually loaded (see load_reference_data()),
+    rather than the files on disk, so call this after loading it.
+
+    """
+    hash = hashlib.sha1(this_month.encode("utf-8"))
+    hash.update(get_code_signature().encode("utf-8"))
+    hash.update(reference_signature.encode("utf-8"))
+    return hash.hexdigest()
+
+def make_cache_key (signature, data):
+    """ Make a cache key for a file or activity from its bytes """
+    return hashlib.sha1(signature.encode("utf-8") + data).hexdigest()
+
+
+#
+# Transaction sorting
+#
+
+class CodeDictionary:
+    """ Intern the distinct values of a column as integer codes
+    Codes are given out in order of first appearance, so they don't sort like
+    the values. Use ranks() to get codes that do.
+
+    """
+
+    def __init__ (self):
+        self.values = []
+        self.codes = {}
+        self.ranks_cache = None
+
+    def __len__ (self):
+        return len(self.values)
+
+    def encode (self, value):
+        """ Return the code for a value, adding it if it's new """
+        code = self.codes.get(value)
+        if code is None:
+            code = len(self.values)
+            self.codes[value] = code
+            self.values.append(value)
+            self.ranks_cache = None
+        return code
+
+    def ranks (self):
+        """ Return a tuple of (ranks, sorted_values), where ranks[code] is the position of the code's value in sorted_values
+        Adding more values later can change the ranks, but never the relative order of
+        the values already here, so anything sorted by earlier ranks is still sorted.
+        The result is cached until the next new value.
+
+        """
+        if self.ranks_cache is None:
+            order = sorted(range(len(self.values)), key=lambda code: sort_key(self.values[code]))
+            ranks = [0] * len(order)
+            for rank, code in enumerate(order):
+                ranks[code] = rank
+            self.ranks_cache = (ranks, [self.values[code] for code in order],)
+        return self.ranks_cache
+
+
+class TransactionSink:
+    """ Collect transaction rows in a compact columnar store, and give them back in sorted order
+    String columns are stored as codes into a CodeDictionary, and numbers in arrays
+    (see TRANSACTION_COLUMN_TYPES), so each row takes a few dozen bytes instead of a
+    Python list of 11 objects. Rows are sorted by the ranks of their codes, which
+    gives the same order as sorted() on the original rows.
+    Keeps up to buffer_rows rows in memory. Past that, it sorts the buffer and
+    spills it to a temporary file as a sorted run, then k-way merges the runs
+    at the end.
+
+    """
+
+    def __init__ (self, buffer_rows=SORT_BUFFER_ROWS):
+        self.buffer_rows = buffer_rows
+        self.dictionaries = [CodeDictionary() if column_type == "code" else None for column_type in TRANSACTION_COLUMN_TYPES]
+        self.columns = self.make_columns()
+        self.run_files = []
+        self.temp_dir = None
+        self.count = 0
+
+    def __len__ (self):
+        return self.count
+
+    def make_columns (self):
+        """ Return a list of empty column arrays """
+        return [array.array(CODE_TYPECODE if column_type == "code" else column_type) for column_type in TRANSACTION_COLUMN_TYPES]
+
+    def append (self, row):
+        """ Add a row, spilling the buffer to disk if it's full """
+        for i, value in enumerate(row):
+            dictionary = self.dictionaries[i]
+            if dictionary is not None:
+                value = dictionary.encode(value)
+            try:
+                self.columns[i].append(value)
+            except OverflowError:
+                # too big for the array (e.g. a bogus value), so fall back to a list for this column
+                self.columns[i] = list(self.columns[i])
+                self.columns[i].append(value)
+        self.count += 1
+        if len(self.columns[0]) >= self.buffer_rows:
+            self.spill()
+
+    def sort_buffer (self):
+        """ Sort the rows in the buffer by the current ranks (timed as the "sort" stage) """
+        with metrics.stage("sort"):
+            self.sort_rows()
+
+    def sort_rows (self):
+        """ Sort the rows in the buffer for sort_buffer() """
+        if numpy is not None and all(isinstance(column, array.array) for column in self.columns):
+            # lexsort() takes the primary key last
+            keys = [self.get_sort_keys(i) for i in reversed(range(len(self.columns)))]
+            order = numpy.lexsort([numpy.frombuffer(key, dtype=key.typecode) for key in keys]).tolist()
+        else:
+            # one stable sort per column, from the last to the primary, so we never build a tuple for each row
+            order = list(range(len(self.columns[0])))
+            for i in reversed(range(len(self.columns))):
+                order.sort(key=self.get_sort_keys(i).__getitem__)
+
+        self.columns = [
+            array.array(column.typecode, [column[i] for i in order]) if isinstance(column, array.array) else [column[i] for i in order]
+            for column in self.columns
+        ]
+
+    def get_sort_keys (self, i):
+        """ Return the sort keys for column i of the buffer: the current ranks for a string column, or the numbers themselves """
+        column = self.columns[i]
+        dictionary = self.dictionaries[i]
+        if dictionary is None:
+            return column
+        ranks = dictionary.ranks()[0]
+        return array.array(CODE_TYPECODE, [ranks[code] for code in column])
+
+    def spill (self):
+        """ Sort the buffer and write it to disk as a run """
+        size = len(self.columns[0])
+        if size == 0:
+            return
+        if self.temp_dir is None:
+            self.temp_dir = tempfile.TemporaryDirectory(prefix="transactions-")
+        self.sort_buffer()
+        filename = os.path.join(self.temp_dir.name, "run-{:04d}.pickle".format(len(self.run_files)))
+        with open(filename, "wb") as output:
+            for i in range(0, size, SORT_RUN_CHUNK_ROWS):
+                pickle.dump([column[i:i+SORT_RUN_CHUNK_ROWS] for column in self.columns], output, pickle.HIGHEST_PROTOCOL)
+        logger.debug("Spilled %d transaction rows to %s", size, filename)
+        self.run_files.append(filename)
+        self.columns = self.make_columns()
+
+    def sorted_codes (self):
+        """ Yield all the rows in sorted order, as tuples of ranks (for strings) and numbers
+        Use the list returned by values() to decode the ranks.
+
+        """
+        self.sort_buffer()
+        ranks = [None if dictionary is None else dictionary.ranks()[0] for dictionary in self.dictionaries]
+        runs = [read_run(self.columns)] + [read_run(filename) for filename in self.run_files]
+        runs = [map(functools.partial(rank_row, ranks), run) for run in runs]
+        if len(runs) == 1:
+            yield from runs[0]
+        else:
+            yield from heapq.merge(*runs)
+
+    def values (self):
+        """ Return a list with the sorted values for each string column (None for other columns), to decode sorted_codes() """
+        return [None if dictionary is None else dictionary.ranks()[1] for dictionary in self.dictionaries]
+
+    def sorted_rows (self):
+        """ Yield all the rows in sorted order, as lists of values """
+        values = self.values()
+        for row in self.sorted_codes():
+            yield [value if column_values is None else column_values[value] for value, column_values in zip(row, values)]
+
+    def close (self):
+        """ Remove any temporary files """
+        self.columns = self.make_columns()
+        if self.temp_dir is not None:
+            self.temp_dir.cleanup()
+            self.temp_dir = None
+        self.run_files = []
+
+
+def read_run (filename_or_columns):
+    """ Yield the rows from a sorted run written by TransactionSink.spill(), or from a list of columns in memory, as tuples of codes """
+    if not isinstance(filename_or_columns, str):
+        yield from zip(*filename_or_columns)
+        return
+    with open(filename_or_columns, "rb") as input:
+        while True:
+            try:
+                columns = pickle.load(input)
+            except EOFError:
+                return
+            yield from zip(*columns)
+
+def rank_row (ranks, row):
+    """ Replace the codes in a row with ranks (ranks has a list for each coded column, and None for the others) """
+    return tuple(value if column_ranks is None else column_ranks[value] for value, column_ranks in zip(row, ranks))
+
+def sort_key (value):
+    """ Sort key for column values that puts None first instead of failing """
+    return (value is not None, value,)
+
+
+#
+# Rollups
+#
+
+class Rollup:
+    """ Sum the net and total money in transaction rows, grouped by some of the columns
+    Works on the ranked rows from TransactionSink.sorted_codes(), so the grouping keys are
+    small ints, and sorting the keys gives the same order as sorting the values.
+
+    """
+
+    def __init__ (self, name, columns):
+        self.name = name
+        self.columns = columns + ROLLUP_FLAG_COLUMNS
+        self.totals = {}
+
+    def add (self, row):
+        """ Add a ranked transaction row """
+        key = tuple(row[i] for i in self.columns)
+        totals = self.totals.get(key)
+        if totals is None:
+            self.totals[key] = [row[i] for i in ROLLUP_VALUE_COLUMNS]
+        else:
+            for j, i in enumerate(ROLLUP_VALUE_COLUMNS):
+                totals[j] += row[i]
+
+    def headers (self):
+        """ Return the two header rows (text headers and HXL hashtags) """
+        return [[header_row[i] for i in self.columns + ROLLUP_VALUE_COLUMNS] for header_row in TRANSACTION_HEADERS]
+
+    def rows (self, values):
+        """ Return the sorted rows, decoded with the lists from TransactionSink.values() """
+        rows = []
+        for key in sorted(self.totals):
+            row = [value if values[i] is None else values[i][value] for i, value in zip(self.columns, key)]
+            rows.append(row + self.totals[key])
+        return rows
+
+
+def make_rollups ():
+    """ Return a new list of Rollup objects, one for each entry in ROLLUPS """
+    return [Rollup(name, columns) for name, columns in ROLLUPS]
+
+
+#
+# Partitioned shards
+#
+
+class ShardWriter:
+    """ Write ranked transaction rows into shards partitioned by column (see SHARD_PARTITIONS)
+    Each shard has the same JSON and CSV layout as transactions.json and transactions.csv,
+    with rows in the same order, plus gzip (and brotli, if installed) copies next to
+    the plain files. Rows are buffered per shard and appended to its files in batches,
+    so there's never more than one file open, however many shards there are.
+    Shards whose (name, value) is in unchanged, and that have the same filename in the
+    previous run's index, keep their existing files instead of being written again.
+    close() finishes the files, compresses them, and writes the manifest.
+
+    """
+
+    def __init__ (self, output_dir, values, unchanged=set()):
+        self.shards_dir = os.path.join(output_dir, SHARDS_DIR)
+        self.values = values
+        self.json_values = encode_json_values(values)
+        self.shards = {name: {} for name, column in SHARD_PARTITIONS}
+        self.unchanged = {}
+
+        if unchanged:
+            # Find the files for the unchanged shards from the previous run
+            try:
+                with open(os.path.join(self.shards_dir, SHARD_INDEX_FILE), "r") as input:
+                    previous = json.load(input)
+                for name, entries in previous["partitions"].items():
+                    for entry in entries:
+                        if (name, entry["value"],) in unchanged:
+                            self.unchanged[(name, entry["value"],)] = entry["json"][len(name) + 1:-len(".json")]
+            except (FileNotFoundError, KeyError, ValueError):
+                logger.warning("Can't read the previous shard index, so rewriting all shards")
+                self.unchanged = {}
+
+        if not self.unchanged:
+            # Start afresh, so that shards from earlier runs don't linger
+            shutil.rmtree(self.shards_dir, ignore_errors=True)
+        for name, column in SHARD_PARTITIONS:
+            os.makedirs(os.path.join(self.shards_dir, name), exist_ok=True)
+
+    def add (self, row):
+        """ Add a ranked transaction row to each of its shards """
+        row_json = None
+        for name, column in SHARD_PARTITIONS:
+            shard = self.shards[name].get(row[column])
+            if shard is None:
+                shard = self.make_shard(name, row[column])
+            if shard["keep"]:
+                shard["rows"] += 1
+                continue
+            if row_json is None:
+                row_json = encode_row_json(row, self.json_values)
+                row_csv = encode_row_csv(decode_row(row, self.values))
+            shard["json"].append(", " + row_json)
+            shard["csv"].append(row_csv)
+            shard["rows"] += 1
+            if len(shard["csv"]) >= SHARD_BUFFER_ROWS:
+                self.flush(shard)
+
+    def make_shard (self, name, rank):
+        """ Set up a new shard for a partition value """
+        value = self.values[dict(SHARD_PARTITIONS)[name]][rank]
+        slug = make_slug(value)
+        filenames = set(shard["filename"] for shard in self.shards[name].values())
+        filename = slug
+        i = 1
+        while filename in filenames:
+            # two values with the same slug
+            i += 1
+            filename = "{}-{}".format(slug, i)
+        shard = {
+            "partition": name,
+            "value": value,
+            "filename": filename,
+            "rows": 0,
+            "keep": self.unchanged.get((name, value,)) == filename,
+            "started": False,
+            "json": ["[" + ", ".join(json.dumps(header_row) for header_row in TRANSACTION_HEADERS)],
+            "csv": [encode_row_csv(header_row) for header_row in TRANSACTION_HEADERS],
+        }
+        self.shards[name][rank] = shard
+        return shard
+
+    def get_path (self, shard, extension):
+        """ Return the path of one of a shard's files """
+        return os.path.join(self.shards_dir, shard["partition"], shard["filename"] + extension)
+
+    def flush (self, shard):
+        """ Append a shard's buffered text to its files """
+        mode = "a" if shard["started"] else "w"
+        with open(self.get_path(shard, ".json"), mode) as output:
+            output.write("".join(shard["json"]))
+        with open(self.get_path(shard, ".csv"), mode, newline="") as output:
+            output.write("".join(shard["csv"]))
+        shard["started"] = True
+        shard["json"] = []
+        shard["csv"] = []
+
+    def close (self):
+        """ Finish and compress all the shards, and write the manifest
+        Returns the manifest (also written to SHARD_INDEX_FILE).
+
+        """
+        formats = ["gz"] + (["br"] if brotli is not None else [])
+        index = {
+            "compressed": formats,
+            "partitions": {},
+        }
+        kept = 0
+        for name, column in SHARD_PARTITIONS:
+            entries = []
+            filenames = set()
+            for rank in sorted(self.shards[name]):
+                shard = self.shards[name][rank]
+                if shard["keep"]:
+                    kept += 1
+                else:
+                    shard["json"].append("]")
+                    self.flush(shard)
+                    for extension in (".json", ".csv",):
+                        compress_file(self.get_path(shard, extension))
+                for extension in (".json", ".csv",):
+                    filenames.add(shard["filename"] + extension)
+                entries.append({
+                    "value": shard["value"],
+                    "json": "{}/{}.json".format(name, shard["filename"]),
+                    "csv": "{}/{}.csv".format(name, shard["filename"]),
+                    "rows": shard["rows"],
+                })
+            index["partitions"][name] = entries
+            if self.unchanged:
+                # Remove the files of shards that are gone since the previous run
+                for filename in os.listdir(os.path.join(self.shards_dir, name)):
+                    if re.sub(r'\.(gz|br)$', '', filename) not in filenames:
+                        os.remove(os.path.join(self.shards_dir, name, filename))
+        if kept:
+            logger.info("Kept %d unchanged shards", kept)
+        with open(os.path.join(self.shards_dir, SHARD_INDEX_FILE), "w") as output:
+            json.dump(index, output, indent=1)
+        return index
+
+
+def compress_file (filename):
+    """ Write compressed copies of a file next to it (.gz, and .br if brotli is installed)
+    The gzip copies have no timestamp, so unchanged shards give identical bytes.
+
+    """
+    with open(filename, "rb") as input:
+        data = input.read()
+    with open(filename + ".gz", "wb") as output:
+        output.write(gzip.compress(data, 9, mtime=0))
+    if brotli is not None:
+        with open(filename + ".br", "wb") as output:
+            output.write(brotli.compress(data))
+
+def make_slug (value):
+    """ Make a filename-safe version of a partition value """
+    slug = SLUG_PATTERN.sub("-", str(value).lower()).strip("-")
+    return slug if slug else "unspecified"
+
+
+#
+# SQLite export
+#
+
+class SqliteExport:
+    """ Write the transactions and flows to a SQLite database for local querying
+    Add ranked transaction rows with add() (as a consumer for write_transactions()),
+    then call close() with the FlowAggregator to finish. Everything is inserted in
+    batches inside a single transaction, and the indexes are built at the end.
+    The database is built in a temporary file next to the destination, and only
+    replaces it once it's complete.
+    There's a view for each of the ROLLUPS, with net and total money summed the
+    same way as in the rollup files (see METHODOLOGY.md for when to use which).
+
+    """
+
+    def __init__ (self, filename, values):
+        self.filename = filename
+        self.temp_filename = filename + ".tmp"
+        self.values = values
+        self.batch = []
+        if os.path.exists(self.temp_filename):
+            os.remove(self.temp_filename)
+        self.connection = sqlite3.connect(self.temp_filename, isolation_level=None)
+        # nothing to protect until the file is complete, so skip the journal
+        self.connection.execute("PRAGMA journal_mode=OFF")
+        self.connection.execute("PRAGMA synchronous=OFF")
+        self.connection.execute("BEGIN")
+        self.connection.execute("CREATE TABLE transactions ({})".format(", ".join(
+            "{} {}".format(column, "INTEGER" if i in SQLITE_TRANSACTION_INTEGER_COLUMNS else "TEXT") for i, column in enumerate(TRANSACTION_COLUMNS)
+        )))
+        self.connection.execute("CREATE TABLE flows ({})".format(", ".join(
+            "{} {}".format(column, "INTEGER" if i in SQLITE_FLOW_INTEGER_COLUMNS else "TEXT") for i, column in enumerate(FLOW_COLUMNS)
+        )))
+
+    def add (self, row):
+        """ Add a ranked transaction row """
+        self.batch.append(decode_row(row, self.values))
+        if len(self.batch) >= SQLITE_BATCH_ROWS:
+            self.flush()
+
+    def flush (self):
+        """ Insert the batch of transaction rows """
+        self.connection.executemany(
+            "INSERT INTO transactions VALUES ({})".format(", ".join("?" * len(TRANSACTION_COLUMNS))),
+            self.batch
+        )
+        self.batch = []
+
+    def close (self, flows):
+        """ Add the aggregated flows, build the indexes and views, and move the database into place """
+        self.flush()
+        self.connection.executemany(
+            "INSERT INTO flows VALUES ({})".format(", ".join("?" * len(FLOW_COLUMNS))),
+            ([decode_flow_value(value, i in SQLITE_FLOW_INTEGER_COLUMNS) for i, value in enumerate(row)] for row in flows.rows())
+        )
+        for column in SQLITE_INDEXED_COLUMNS:
+            self.connection.execute("CREATE INDEX transactions_{0} ON transactions ({0})".format(column))
+        for name, columns in ROLLUPS:
+            group_columns = [TRANSACTION_COLUMNS[i] for i in columns + ROLLUP_FLAG_COLUMNS]
+            self.connection.execute(
+                "CREATE VIEW {} AS SELECT {}, SUM(net_money) AS net_money, SUM(total_money) AS total_money FROM transactions GROUP BY {}".format(
+                    "rollup_" + name.replace("-", "_"),
+                    ", ".join(group_columns),
+                    ", ".join(group_columns),
+                )
+            )
+        self.connection.execute("COMMIT")
+        self.connection.close()
+        os.replace(self.temp_filename, self.filename)
+
+
+def decode_flow_value (value, is_integer):
+    """ Convert a value from FlowAggregator.rows() for SQL
+    The aggregator leaves empty strings for 0 and None, like libhxl did, so turn
+    those back into 0 for integer columns and NULL for text columns.
+
+    """
+    if value == "":
+        return 0 if is_integer else None
+    return int(value) if is_integer else value
+
+
+#
+# Change detection
+#
+
+class PartitionHasher:
+    """ Hash the transaction rows in each partition (see MANIFEST_PARTITION_COLUMNS), for the manifest
+    Add ranked rows in sorted order (it works as a consumer for write_transactions()).
+    The hashes are of the rows' JSON, so a partition's hash changes only when its rows do.
+
+    """
+
+    def __init__ (self, values):
+        self.values = values
+        self.json_values = encode_json_values(values)
+        self.hashes = {}
+
+    def add (self, row):
+        """ Add a ranked transaction row to the hash for its partition """
+        key = tuple(row[column] for column in MANIFEST_PARTITION_COLUMNS)
+        hash = self.hashes.get(key)
+        if hash is None:
+            hash = self.hashes[key] = hashlib.sha1()
+        hash.update(encode_row_json(row, self.json_values).encode("utf-8"))
+        hash.update(b"\n")
+
+    def partitions (self):
+        """ Return the hashes as a dict of dicts (country, then month) """
+        country_column, month_column = MANIFEST_PARTITION_COLUMNS
+        partitions = {}
+        for (country, month), hash in sorted(self.hashes.items()):
+            country = self.values[country_column][country]
+            month = self.values[month_column][month]
+            partitions.setdefault(str(country), {})[str(month)] = hash.hexdigest()
+        return partitions
+
+
+def make_manifest (partitions, flows):
+    """ Make the manifest of the output, from PartitionHasher.partitions() and the FlowAggregator
+    It also has the signature of the processing code (see get_code_signature()), since
+    that decides how the output is written.
+
+    """
+    flows_hash = hashlib.sha1()
+    for row in flows.rows():
+        flows_hash.update(json.dumps(row).encode("utf-8"))
+        flows_hash.update(b"\n")
+    return {
+        "signature": get_code_signature(),
+        "flows": flows_hash.hexdigest(),
+        "transactions": partitions,
+    }
+
+def load_manifest (output_dir):
+    """ Return the manifest from the previous run in an output directory, or None if there isn't one """
+    try:
+        with open(os.path.join(output_dir, MANIFEST_FILE), "r") as input:
+            return json.load(input)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def save_manifest (output_dir, manifest):
+    """ Write the manifest to an output directory """
+    path = os.path.join(output_dir, MANIFEST_FILE)
+    with open(path + ".tmp", "w") as output:
+        json.dump(manifest, output, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+def compare_manifests (previous, manifest):
+    """ Report the differences between the previous manifest (or None) and the new one
+    Partitions are [country, month] pairs. Everything counts as changed if there's no
+    previous manifest (an initial build, marked "initial"), or if the script has changed.
+    "changed" is always the last key, so that it ends the JSON that save_changes() writes
+    (make publish-output looks for "changed": false} there).
+
+    """
+    old = {} if previous is None else previous.get("transactions", {})
+    new = manifest["transactions"]
+    old_cells = {(country, month,): hash for country, months in old.items() for month, hash in months.items()}
+    new_cells = {(country, month,): hash for country, months in new.items() for month, hash in months.items()}
+    same_signature = previous is not None and previous.get("signature") == manifest["signature"]
+    changes = {
+        "initial": previous is None,
+        "previous": previous is not None,
+        "signature_changed": not same_signature,
+        "flows_changed": previous is None or previous.get("flows") != manifest["flows"],
+        "partitions": {
+            "added": sorted([list(cell) for cell in set(new_cells).difference(old_cells)]),
+            "removed": sorted([list(cell) for cell in set(old_cells).difference(new_cells)]),
+            "changed": sorted([list(cell) for cell in new_cells if cell in old_cells and new_cells[cell] != old_cells[cell]]),
+        },
+    }
+    changes["partitions"]["unchanged"] = len(new_cells) - len(changes["partitions"]["added"]) - len(changes["partitions"]["changed"])
+    changes["changed"] = changes["signature_changed"] or changes["flows_changed"] or any(changes["partitions"][key] for key in ("added", "removed", "changed",))
+    return changes
+
+def get_unchanged_shards (changes, manifest):
+    """ Return the set of shards, as (name, value) tuples, whose rows haven't changed since the previous run """
+    if changes["signature_changed"]:
+        return set()
+    touched = changes["partitions"]["added"] + changes["partitions"]["removed"] + changes["partitions"]["changed"]
+    changed_countries = set(country for country, month in touched)
+    changed_months = set(month for country, month in touched)
+    countries = set(manifest["transactions"])
+    months = set(month for country_months in manifest["transactions"].values() for month in country_months)
+    return set(("country", country,) for country in countries.difference(changed_countries)) | set(("month", month,) for month in months.difference(changed_months))
+
+def save_changes (output_dir, changes):
+    """ Write the report from compare_manifests() to an output directory """
+    with open(os.path.join(output_dir, CHANGES_FILE), "w") as output:
+        json.dump(changes, output)
+
+
+#
+# Flow aggregation
+#
+
+class FlowAggregator:
+    """ Aggregate flow rows as they arrive, summing the total money for each distinct flow
+    Memory use is proportional to the number of distinct flows, not the number of rows.
+    The results are the same as the libhxl count() filter that we used to use:
+    grouping values are whitespace-normalised strings (with empty strings for
+    falsy values like 0 or None), and a group whose values are all 0 has an
+    empty total.
+    spill() moves the totals so far to a sorted run on disk, and rows() merges the
+    runs back together, like TransactionSink.
+
+    """
+
+    def __init__ (self):
+        self.totals = {}
+        self.count = 0
+        self.temp_dir = None
+        self.run_files = []
+
+    def __len__ (self):
+        """ Return the number of flow rows added (not the number of distinct flows) """
+        return self.count
+
+    def append (self, row):
+        """ Add a flow row (the grouping columns from FLOW_HEADERS, followed by the total money) """
+        self.count += 1
+        key = tuple(normalise_flow_value(value) for value in row[:-1])
+        total = self.totals.get(key)
+        value = row[-1]
+        if value:
+            # hxl normalises numbers through float
+            value = float(value)
+            value = int(value) if value == int(value) else value
+            total = value if total is None else total + value
+        self.totals[key] = total
+
+    def spill (self):
+        """ Write the totals so far to disk as a sorted run, and start again with an empty dict """
+        if not self.totals:
+            return
+        if self.temp_dir is None:
+            self.temp_dir = tempfile.TemporaryDirectory(prefix="flows-")
+        items = sorted(self.totals.items())
+        filename = os.path.join(self.temp_dir.name, "run-{:04d}.pickle".format(len(self.run_files)))
+        with open(filename, "wb") as output:
+            for i in range(0, len(items), SORT_RUN_CHUNK_ROWS):
+                # same layout as TransactionSink runs, so read_run() can read it
+                pickle.dump([[key for key, total in items[i:i+SORT_RUN_CHUNK_ROWS]], [total for key, total in items[i:i+SORT_RUN_CHUNK_ROWS]]], output, pickle.HIGHEST_PROTOCOL)
+        logger.debug("Spilled %d flows to %s", len(items), filename)
+        self.run_files.append(filename)
+        self.totals = {}
+
+    def rows (self):
+        """ Yield the aggregated rows, sorted by the grouping columns """
+        # earlier runs first, so that totals are added up in the same order as append()
+        runs = [read_run(filename) for filename in self.run_files] + [sorted(self.totals.items())]
+        key = None
+        total = None
+        for run_key, run_total in heapq.merge(*runs, key=operator.itemgetter(0)):
+            if run_key != key:
+                if key is not None:
+                    yield list(key) + ["" if total is None else total]
+                key = run_key
+                total = run_total
+            elif run_total is not None:
+                total = run_total if total is None else total + run_total
+        if key is not None:
+            yield list(key) + ["" if total is None else total]
+
+    def close (self):
+        """ Remove any temporary files """
+        self.totals = {}
+        if self.temp_dir is not None:
+            self.temp_dir.cleanup()
+            self.temp_dir = None
+        self.run_files = []
+
+
+def normalise_flow_value (value):
+    """ Normalise a grouping value for flows, like hxl's normalise_space() """
+    if not value or str(value).isspace():
+        return ""
+    return WHITESPACE_PATTERN.sub(" ", str(value).strip())
+
+
+#
+# Memory budget
+#
+
+class SeenSet:
+    """ A set of activity identifiers that can move from memory to a SQLite table on disk
+    Supports only the "in" test and add(), which is all that process_activities() needs.
+
+    """
+
+    def __init__ (self):
+        self.identifiers = set()
+        self.temp_dir = None
+        self.connection = None
+
+    def __contains__ (self, identifier):
+        if identifier in self.identifiers:
             return True
-    return False
+        elif self.connection is None or identifier is None:
+            return False
+        else:
+            return self.connection.execute("SELECT 1 FROM seen WHERE identifier=?", (identifier,)).fetchone() is not None
 
-def is_activity_strict (activity):
-    return True if (
-        has_c19_scope(activity.humanitarian_scopes) or
-        has_c19_tag(activity.tags) or
-        has_c19_sector(activity.sectors) or
-        is_c19_narrative(activity.title.narratives)
-    ) else False
-
-def is_transaction_strict (transaction):
-    return True if (
-        has_c19_sector(transaction.sectors) or
-        (transaction.description and is_c19_narrative(transaction.description.narratives))
-    ) else False
-
-def sum_transactions (transactions, types):
-    total = 0
-    for transaction in transactions:
-        if transaction.value is None:
-            continue
-        elif transaction.type in types:
-            total += convert_to_usd(transaction.value, transaction.currency, transaction.date)
-    return total
+    def add (self, identifier):
+        """ Add an identifier """
+        if self.connection is None or identifier is None:
+            # SQLite won't take NULL as a key, so a missing identifier always stays in memory
+            self.identifiers.add(identifier)
+        else:
+            self.connection.execute("INSERT OR IGNORE INTO seen VALUES (?)", (identifier,))
+
+    def spill (self):
+        """ Move the identifiers to disk, and add any new ones there from now on """
+        if self.connection is None:
+            self.temp_dir = tempfile.TemporaryDirectory(prefix="seen-")
+            self.connection = sqlite3.connect(os.path.join(self.temp_dir.name, "seen.sqlite"))
+            self.connection.execute("PRAGMA journal_mode=OFF")
+            self.connection.execute("PRAGMA synchronous=OFF")
+            self.connection.execute("CREATE TABLE seen (identifier TEXT PRIMARY KEY) WITHOUT ROWID")
+        self.connection.executemany("INSERT OR IGNORE INTO seen VALUES (?)", ((identifier,) for identifier in self.identifiers if identifier is not None))
+        self.identifiers = set([None]) if None in self.identifiers else set()
+
+    def close (self):
+        """ Remove the temporary database, if any """
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+            self.temp_dir.cleanup()
+            self.temp_dir = None
+        self.identifiers = set()
+
+
+def get_rss ():
+    """ Return the current resident set size of this process in bytes
+    Reads /proc/self/statm where there is one (Linux); otherwise, falls back to the peak size.
+
+    """
+    try:
+        with open("/proc/self/statm", "r") as input:
+            return int(input.read().split()[1]) * resource.getpagesize()
+    except (OSError, ValueError, IndexError):
+        return get_peak_rss()
+
+def get_peak_rss (who=resource.RUSAGE_SELF):
+    """ Return the peak resident set size in bytes of this process (or of its finished children, with resource.RUSAGE_CHILDREN) """
+    # ru_maxrss is in kilobytes on Linux, and bytes on macOS
+    maxrss = resource.getrusage(who).ru_maxrss
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+def enforce_memory_budget (max_memory, transactions, flows, activities_seen):
+    """ If this process is using more than max_memory bytes, move the big structures to disk
+    Spills the transaction rows and the flow totals (if there are enough of them to be worth
+    it), and moves the seen identifiers (a SeenSet) to disk for good.
+
+    """
+    rss = get_rss()
+    if rss <= max_memory:
+        return
+    logger.debug("Using %d bytes, over the budget of %d", rss, max_memory)
+    if activities_seen.connection is None:
+        logger.info("Over the memory budget, so keeping the seen activity identifiers on disk")
+    activities_seen.spill()
+    if len(transactions.columns[0]) >= MEMORY_MIN_SPILL_ROWS:
+        transactions.spill()
+        metrics.count("memory.transaction_spills")
+    if len(flows.totals) >= MEMORY_MIN_SPILL_ROWS:
+        flows.spill()
+        metrics.count("memory.flow_spills")
+
+
+#
+# Output functions
+#
+
+def write_transactions (output_dir, transactions, consumers=[]):
+    """ Write the rows from a TransactionSink to the JSON and CSV files in sorted order, in a single pass
+    The JSON is the same as json.dump() would produce for the headers plus all the rows.
+    It's built from the JSON for each dictionary value, encoded once, rather than row by row.
+    Also passes each ranked row to the add() method of each consumer (e.g. a Rollup or ShardWriter).
+    Returns the number of rows written (not counting headers).
+
+    """
+    values = transactions.values()
+    json_values = encode_json_values(values)
+
+    count = 0
+    with open(os.path.join(output_dir, TRANSACTIONS_JSON), "w") as json_output, open(os.path.join(output_dir, TRANSACTIONS_CSV), "w") as csv_output:
+        writer = csv.writer(csv_output)
+        json_output.write("[")
+        json_output.write(", ".join(json.dumps(row) for row in TRANSACTION_HEADERS))
+        for row in TRANSACTION_HEADERS:
+            writer.writerow(row)
+        for row in transactions.sorted_codes():
+            json_output.write(", ")
+            json_output.write(encode_row_json(row, json_values))
+            writer.writerow(decode_row(row, values))
+            for consumer in consumers:
+                consumer.add(row)
+            count += 1
+        json_output.write("]")
+    return count
+
+def encode_json_values (values):
+    """ JSON-encode the lists from TransactionSink.values(), once for each value """
+    return [None if column_values is None else [json.dumps(value) for value in column_values] for column_values in values]
+
+def encode_row_json (row, json_values):
+    """ Return the JSON for a ranked transaction row, using the lists from encode_json_values() """
+    return "[" + ", ".join(str(value) if column_json is None else column_json[value] for value, column_json in zip(row, json_values)) + "]"
+
+def decode_row (row, values):
+    """ Return the values for a ranked transaction row, using the lists from TransactionSink.values() """
+    return [value if column_values is None else column_values[value] for value, column_values in zip(row, values)]
+
+def encode_row_csv (row):
+    """ Return a row as a line of CSV, the same as csv.writer would write it """
+    output = io.StringIO()
+    csv.writer(output).writerow(row)
+    return output.getvalue()
+
+def write_rollups (output_dir, rollups, values):
+    """ Write each Rollup to its own JSON and CSV files (see ROLLUP_FILE_TEMPLATE)
+    The JSON has the same layout as transactions.json: headers, then rows.
+    The values are the lists from TransactionSink.values().
+
+    """
+    for rollup in rollups:
+        rows = rollup.headers() + rollup.rows(values)
+        with open(os.path.join(output_dir, ROLLUP_FILE_TEMPLATE.format(rollup.name, "json")), "w") as output:
+            json.dump(rows, output)
+        with open(os.path.join(output_dir, ROLLUP_FILE_TEMPLATE.format(rollup.name, "csv")), "w") as output:
+            writer = csv.writer(output)
+            for row in rows:
+                writer.writerow(row)
+        logger.debug("Wrote %d rows for the %s rollup", len(rows) - 2, rollup.name)
+
+def write_flows (output_dir, flows):
+    """ Write aggregated flows from a FlowAggregator to the JSON and CSV files
+    The JSON has one row per line, as libhxl used to produce.
+
+    """
+    # Write the JSON and the CSV in the same pass
+    with open(os.path.join(output_dir, FLOWS_JSON), "w") as json_output, open(os.path.join(output_dir, FLOWS_CSV), "w") as csv_output:
+        writer = csv.writer(csv_output)
+        json_output.write("[")
+        separator = "\n"
+        for row in itertools.chain(FLOW_HEADERS, flows.rows()):
+            json_output.write(separator)
+            json_output.write(json.dumps(row))
+            separator = ",\n"
+            writer.writerow(row)
+        json_output.write("\n]\n")
 
 
 #
-# Main processing function
+# Main processing functions
 #
 
-def process_activities (filenames):
+def process_activity (activity, this_month):
+    """ Compute the order-independent results for a single activity
+    Doesn't touch the org-name map, so it's safe to run in a worker process.
+    Returns None for activities that should be skipped; otherwise, returns a tuple of
+    (org_key, org_type, transactions, flows, rules). The reporting-org slot in each transaction
+    and flow row is left as None, and the provider/receiver slots in each flow row hold
+    org keys (see get_org_key()), to be resolved later in input order by merge_activity().
+    The rules are the c19.* counts from classify_activity() and classify_transaction() for
+    this activity, so that they can be counted again when the result is reused (from the
+    result cache, or remembered by --watch).
 
-    transactions = list()
+    """
+
+    # Skip activities from a secondary reporter (should have been filtered out already)
+    if activity.secondary_reporter:
+        activity_counters["activities.skipped.secondary_reporter"] += 1
+        return None
+
+    start_time = time.perf_counter()
+
+    transactions = []
 
     flows = []
 
-    activities_seen = set()
+    identifier = activity.identifier
 
-    this_month = datetime.datetime.utcnow().isoformat()[:7]
+    # Get the reporting-org key and C19 strictness at activity level
+    org_key = get_org_key(activity.reporting_org)
+    org_type = str(activity.reporting_org.type)
+    rules = collections.Counter()
+    activity_strict = classify_activity(activity, rules) is not None
 
-    for filename in filenames:
-        for activity in diterator.XMLIterator(filename):
+    # Figure out default country/sector percentage splits at the activity level
+    activity_country_splits = make_country_splits(activity)
+    activity_sector_splits = make_sector_splits(activity)
 
-            # Don't use the same activity twice
-            identifier = activity.identifier
-            if identifier in activities_seen:
-                continue
-            activities_seen.add(identifier)
+    #
+    # Figure out how to factor new money (converting all the transactions to USD along the way)
+    #
 
-            # Skip activities from a secondary reporter (should have been filtered out already)
-            if activity.secondary_reporter:
-                continue
+    convert_start_time = time.perf_counter()
+    summary = summarise_transactions(activity.transactions)
+    convert_seconds = time.perf_counter() - convert_start_time
+    split_seconds = 0.0
+    commitment_factor = summary["commitment_factor"]
+    spending_factor = summary["spending_factor"]
 
-            # Get the reporting-org name and C19 strictness at activity level
-            org = get_org_name(activity.reporting_org)
-            org_type = str(activity.reporting_org.type)
-            activity_strict = is_activity_strict(activity)
+    activity_humanitarian = activity.humanitarian
 
-            # Figure out default country/sector percentage splits at the activity level
-            activity_country_splits = make_country_splits(activity)
-            activity_sector_splits = make_sector_splits(activity)
 
-            #
-            # Figure out how to factor new money
-            #
+    #
+    # Walk through the activity's transactions one-by-one, and split by country/sector
+    #
 
-            # Total up the 4 kinds of transactions (with currency conversion to USD)
-            incoming_funds = sum_transactions(activity.transactions, ["1"])
-            outgoing_commitments = sum_transactions(activity.transactions, ["2"])
-            spending = sum_transactions(activity.transactions, ["3", "4"])
-            incoming_commitments = sum_transactions(activity.transactions, ["11"])
-
-            # Figure out total incoming money (never less than zero)
-            incoming = max(incoming_commitments, incoming_funds)
-            if incoming < 0:
-                incoming = 0
-
-            # Factor to apply to outgoing commitments for net new money
-            if incoming == 0:
-                commitment_factor = 1.0
-            elif outgoing_commitments > incoming:
-                commitment_factor = (outgoing_commitments - incoming) / outgoing_commitments
-            else:
-                commitment_factor = 0.0
+    # Classify the transaction descriptions in one batch (only needed if the activity isn't strict)
+    if activity_strict:
+        descriptions = None
+    else:
+        descriptions = classify_transaction_descriptions([transaction for transaction, type, date, original_value, value in summary["transactions"]])
+
+    for i, (transaction, type, date, original_value, value) in enumerate(summary["transactions"]):
+
+        month = date[:7]
+        if month < "2020-01" or month > this_month:
+            # Skip transactions with out-of-range months
+            activity_counters["transactions.skipped.out_of_range_month"] += 1
+            continue
+        elif not original_value:
+            # Skip transactions with no values
+            activity_counters["transactions.skipped.no_value"] += 1
+            continue
+
+        if type in TRANSACTION_TYPE_INFO:
+            type_info = TRANSACTION_TYPE_INFO[type]
+        else:
+            # skip transaction types that don't interest us
+            activity_counters["transactions.skipped.unknown_type"] += 1
+            continue
 
-            # Factor to apply to outgoing spending for net new money
-            if incoming == 0:
-                spending_factor = 1.0
-            elif spending > incoming:
-                spending_factor = (spending - incoming) / spending
+        # Set the net (new money) factors based on the type (commitments or spending)
+        # (incoming transactions never produce transaction rows, so they have no net value)
+        if type_info["direction"] == "outgoing":
+            if type_info["classification"] == "commitments":
+                net_value = value * commitment_factor
             else:
-                spending_factor = 0.0
+                net_value = value * spending_factor
+        else:
+            net_value = 0.0
 
+        # transaction status defaults to activity
+        is_humanitarian = transaction.humanitarian
+        if is_humanitarian is None:
+            is_humanitarian = activity_humanitarian
+        is_strict = activity_strict or classify_transaction(transaction, descriptions[i], rules) is not None
 
-            #
-            # Walk through the activity's transactions one-by-one, and split by country/sector
-            #
+        # Make the splits for the transaction (default to activity splits)
+        country_splits = make_country_splits(transaction, activity_country_splits)
+        sector_splits = make_sector_splits(transaction, activity_sector_splits)
 
-            for transaction in activity.transactions:
 
-                month = transaction.date[:7]
-                if month < "2020-01" or month > this_month or not transaction.value:
-                    # Skip transactions with no values or with out-of-range months
-                    continue
+        # Look up the names once per transaction, not once per country × sector pair
+        country_names = [get_country_name(country) for country in country_splits]
+        sector_names = [get_sector_group_name(sector) for sector in sector_splits]
 
-                type = transaction.type
-                if type in TRANSACTION_TYPE_INFO:
-                    type_info = TRANSACTION_TYPE_INFO[type]
-                else:
-                    # skip transaction types that don't interest us
-                    continue
+        # Apply the country and sector percentage splits to the transaction
+        # generate multiple split transactions
+        split_start_time = time.perf_counter()
+        net_moneys, total_moneys = split_values(value, net_value, country_splits, sector_splits)
+        split_seconds += time.perf_counter() - split_start_time
+        sector_count = len(sector_names)
 
-                # Convert the transaction value to USD
-                value = convert_to_usd(transaction.value, transaction.currency, transaction.date)
+        for k, country_name in enumerate(country_names):
+            row_start = k * sector_count
 
-                # Set the net (new money) factors based on the type (commitments or spending)
-                if type_info["direction"] == "outgoing":
-                    if type_info["classification"] == "commitments":
-                        net_value = value * commitment_factor
-                    else:
-                        net_value = value * spending_factor
+            #
+            # Add to transactions
+            #
 
-                # transaction status defaults to activity
-                if transaction.humanitarian is None:
-                    is_humanitarian = activity.humanitarian
-                else:
-                    is_humanitarian = transaction.humanitarian
-                is_strict = activity_strict or is_transaction_strict(transaction)
-
-                # Make the splits for the transaction (default to activity splits)
-                country_splits = make_country_splits(transaction, activity_country_splits)
-                sector_splits = make_sector_splits(transaction, activity_sector_splits)
-
-
-                # Apply the country and sector percentage splits to the transaction
-                # generate multiple split transactions
-                for country, country_percentage in country_splits.items():
-                    for sector, sector_percentage in sector_splits.items():
-
-                        sector_name = get_sector_group_name(sector)
-                        country_name = get_country_name(country)
-
-                        #
-                        # Add to transactions
-                        #
-
-                        net_money = int(round(net_value * country_percentage * sector_percentage))
-                        total_money = int(round(value * country_percentage * sector_percentage))
-
-                        # Fill in only if we end up with a non-zero value
-                        if type_info["direction"] == "outgoing" and (net_money != 0 or total_money != 0):
-
-                            # add to transactions
-                            transactions.append([
-                                month,
-                                org,
-                                org_type,
-                                sector_name,
-                                country_name,
-                                1 if is_humanitarian else 0,
-                                1 if is_strict else 0,
-                                type_info["classification"],
-                                identifier,
-                                net_money,
-                                total_money,
-                            ])
-
-                    #
-                    # Add to flows
-                    #
-                    if type_info["direction"] == "incoming":
-                        provider = get_org_name(transaction.provider_org)
-                        receiver = None
-                    else:
-                        provider = None
-                        receiver = get_org_name(transaction.receiver_org)
-                    if org != provider and org != receiver and org != DEFAULT_ORG:
-                        # ignore internal transactions or unknown reporting orgs
-                        flows.append([
-                            org,
+            # Fill in only if we end up with a non-zero value
+            if type_info["direction"] == "outgoing":
+                for j, sector_name in enumerate(sector_names):
+                    net_money = net_moneys[row_start + j]
+                    total_money = total_moneys[row_start + j]
+                    if net_money != 0 or total_money != 0:
+
+                        # add to transactions (reporting org filled in by merge_activity())
+                        transactions.append([
+                            month,
+                            None,
                             org_type,
-                            provider,
-                            receiver,
+                            sector_name,
+                            country_name,
                             1 if is_humanitarian else 0,
                             1 if is_strict else 0,
                             type_info["classification"],
-                            type_info["direction"],
-                            total_money
+                            identifier,
+                            net_money,
+                            total_money,
                         ])
 
+            #
+            # Add to flows (org names resolved by merge_activity())
+            # (the total is the country's share for the last sector)
+            #
+            if type_info["direction"] == "incoming":
+                provider_key = get_org_key(transaction.provider_org)
+                receiver_key = None
+            else:
+                provider_key = None
+                receiver_key = get_org_key(transaction.receiver_org)
+            flows.append([
+                None,
+                org_type,
+                provider_key,
+                receiver_key,
+                1 if is_humanitarian else 0,
+                1 if is_strict else 0,
+                type_info["classification"],
+                type_info["direction"],
+                total_moneys[row_start + sector_count - 1]
+            ])
+
+    activity_counters.update(rules)
+    activity_counters["activities.processed"] += 1
+    activity_counters["transactions.read"] += len(summary["transactions"])
+    activity_counters["time.convert"] += convert_seconds
+    activity_counters["time.split"] += split_seconds
+    activity_counters["time.process"] += time.perf_counter() - start_time - convert_seconds - split_seconds
+
+    return (org_key, org_type, transactions, flows, dict(rules),)
+
+
+@name_file_errors
+def process_file (filename, this_month, cache_dir=None, signature=None, parser="diterator"):
+    """ Run process_activity() over every activity in an IATI XML file (optionally gzipped)
+    The parser is a key from PARSERS.
+    Activities repeated within the file are dropped here, but the caller still
+    needs to check for activities repeated across files.
+    If cache_dir is provided, reuse cached results for unchanged activities,
+    and parse only the ones that aren't in the cache (see process_file_cached()).
+    Returns a tuple of (results, cache_update, counters), where results is a list of
+    (identifier, result) tuples in file order, cache_update is for
+    save_cache_update() (or None if not using the cache), and counters are the
+    metrics for the file (see counters_since()).
+
+    """
+    load_reference_data(cache_dir)
+    counters_before = snapshot_counters()
+
+    if cache_dir is None:
+        cache_update = None
+        input = iatifiles.open_file(filename)
+        activity_results = ((activity.identifier, process_activity(activity, this_month),) for activity in timed_iterator(PARSERS[parser](input), "time.parse"))
+    else:
+        input = None
+        activity_results, cache_update = process_file_cached(filename, this_month, cache_dir, signature, parser)
+
+    results = []
+    identifiers_seen = set()
+    try:
+        for identifier, result in activity_results:
+            if identifier in identifiers_seen:
+                activity_counters["activities.skipped.duplicate_id"] += 1
+                continue
+            identifiers_seen.add(identifier)
+            results.append((identifier, result,))
+    finally:
+        if input is not None:
+            input.close()
+    return (results, cache_update, counters_since(counters_before),)
+
+
+def process_file_cached (filename, this_month, cache_dir, signature, parser):
+    """ Process a file using the result cache
+    Finds the activities by scanning the bytes (see iatifiles), and parses only
+    the ones whose content hash isn't already in the cache.
+    Returns a tuple of (activity_results, cache_update). Doesn't write to the
+    cache itself, so it's safe to run in a worker process.
+
+    """
+    cache = get_result_cache(cache_dir)
+
+    data = iatifiles.read_file(filename)
+    file_key = make_cache_key(signature, data)
+
+    # Try the file-level cache first, so an unchanged file needs no scanning
+    activity_keys = cache.get_file(file_key)
+    cached = {} if activity_keys is None else cache.get_activities(activity_keys)
+
+    if activity_keys is None or len(cached) < len(set(activity_keys)):
+        # Split the file into activities, and look them up individually
+        spans = list(iatifiles.find_activities(data))
+        activity_keys = [make_cache_key(signature, data[start:end]) for start, end in spans]
+        cached = cache.get_activities(activity_keys)
+
+        # Parse whatever isn't cached
+        header = data[:spans[0][0]] if spans else b""
+        new_results = []
+        for key, (start, end) in zip(activity_keys, spans):
+            if key not in cached:
+                cached[key] = process_snippet(header, data[start:end], this_month, parser)
+                new_results.append((key, cached[key][0], cached[key][1],))
+    else:
+        new_results = []
+
+    activity_counters["activities.cached"] += len(activity_keys) - len(new_results)
+    count_cached_rules(cached, activity_keys, new_results)
+    return ([cached[key] for key in activity_keys], (file_key, activity_keys, new_results,),)
+
+
+@name_file_errors
+def process_chunk (chunk, this_month, cache_dir=None, signature=None, parser="diterator"):
+    """ Run process_activity() over some of the activities in an IATI XML file, using the activity index
+    The chunk is a (filename, header_length, spans) tuple, where spans is a list of (offset, length)
+    tuples from iatifiles.ActivityIndex.latest() and iatifiles.make_chunks(). Reads just those
+    activities, without scanning or parsing the rest of the file.
+    If cache_dir is provided, reuse cached results for unchanged activities.
+    Returns the same (results, cache_update, counters) tuple as process_file().
+
+    """
+    load_reference_data(cache_dir)
+    counters_before = snapshot_counters()
+
+    filename, header_length, spans = chunk
+    with iatifiles.open_file(filename) as input:
+        header = input.read(header_length)
+        snippets = []
+        for offset, length in spans:
+            input.seek(offset)
+            snippets.append(input.read(length))
+
+    if cache_dir is None:
+        return ([process_snippet(header, snippet, this_month, parser) for snippet in snippets], None, counters_since(counters_before),)
+
+    activity_keys = [make_cache_key(signature, snippet) for snippet in snippets]
+    cached = get_result_cache(cache_dir).get_activities(activity_keys)
+    results = []
+    new_results = []
+    for key, snippet in zip(activity_keys, snippets):
+        if key not in cached:
+            cached[key] = process_snippet(header, snippet, this_month, parser)
+            new_results.append((key, cached[key][0], cached[key][1],))
+        results.append(cached[key])
+
+    # there's no file-level entry to reuse, but prune() needs one to know which activities are still used
+    chunk_key = make_cache_key(signature, "".join(activity_keys).encode("utf-8"))
+    activity_counters["activities.cached"] += len(activity_keys) - len(new_results)
+    count_cached_rules(cached, activity_keys, new_results)
+    return (results, (chunk_key, activity_keys, new_results,), counters_since(counters_before),)
+
+
+def count_cached_rules (cached, activity_keys, new_results):
+    """ Count the c19.* rules (see process_activity()) for the activities whose results came from the cache
+    The new results were counted when they were processed.
+
+    """
+    new_keys = set(key for key, identifier, result in new_results)
+    for key in activity_keys:
+        if key not in new_keys and cached[key][1] is not None:
+            activity_counters.update(cached[key][1][4])
+
+
+def process_snippet (header, snippet, this_month, parser):
+    """ Parse and process the bytes of a single activity
+    Wraps the activity in its file's own header, so that namespaces etc. still work.
+    Returns an (identifier, result) tuple.
+
+    """
+    start_time = time.perf_counter()
+    stream = io.BytesIO(header + snippet + b"</iati-activities>")
+    activity = next(iter(PARSERS[parser](stream)))
+    activity_counters["time.parse"] += time.perf_counter() - start_time
+    return (activity.identifier, process_activity(activity, this_month),)
+
+
+def save_cache_update (cache_dir, cache_update):
+    """ Save the cache update from process_file() (in the main process only) """
+    file_key, activity_keys, new_results = cache_update
+    get_result_cache(cache_dir).put(file_key, activity_keys, new_results)
+
+
+def merge_activity (result, transactions, flows):
+    """ Resolve org names for an activity's results, and add its rows to the accumulators
+    Must be called in input order, because get_org_name() learns names as it goes.
+
+    """
+    org_key, org_type, activity_transactions, activity_flows, rules = result
+
+    org = lookup_org_name(*org_key)
+
+    for row in activity_transactions:
+        row[1] = org
+        transactions.append(row)
+
+    for row in activity_flows:
+        provider = None if row[2] is None else lookup_org_name(*row[2])
+        receiver = None if row[3] is None else lookup_org_name(*row[3])
+        if org != provider and org != receiver and org != DEFAULT_ORG:
+            # ignore internal transactions or unknown reporting orgs
+            row[0] = org
+            row[2] = provider
+            row[3] = receiver
+            flows.append(row)
+
+
+def copy_result (result):
+    """ Copy the result of process_activity() (or None), so that merge_activity() can fill in the org names without changing the original """
+    if result is None:
+        return None
+    org_key, org_type, activity_transactions, activity_flows, rules = result
+    return (org_key, org_type, [list(row) for row in activity_transactions], [list(row) for row in activity_flows], rules,)
+
+def get_work_key (item, this_month):
+    """ Return a key for a work item (a filename, or a chunk from --latest) that changes whenever its results could """
+    if isinstance(item, str):
+        filename, spans = item, None
+    else:
+        filename, spans = item[0], tuple(item[2])
+    stat = os.stat(filename)
+    return (filename, stat.st_size, stat.st_mtime_ns, spans, this_month,)
+
+def process_activities (filenames, workers=1, cache_dir=None, parser="diterator", sort_buffer=SORT_BUFFER_ROWS, latest=False, memo=None, max_memory=None, resolve_orgs=False):
+    """ Process all the activities in a list of IATI XML files
+    The parser is a key from PARSERS.
+    Transactions go into a TransactionSink, which spills sorted runs to disk
+    once it has more than sort_buffer rows in memory.
+    If workers is greater than 1, parse the files in a pool of worker processes.
+    The results are merged in the order of the filenames either way, so the
+    output is the same as for a serial run.
+    If cache_dir is provided, reuse the cached results for any activity that
+    hasn't changed since the last run, and update the cache.
+    By default, when an activity appears more than once, the first copy wins. If latest
+    is True, use the activity index (see iatifiles.ActivityIndex) to choose the copy with
+    the most recent last-updated-datetime instead, and to split the work into chunks
+    of about CHUNK_BYTES, reading only the chosen activities.
+    If memo is a dict, keep the results for each file (or chunk) in it between calls, and
+    reuse them for any file whose size and modification time haven't changed, instead of
+    processing it again (for --watch). If the reference data has changed since the last
+    call, reload it and forget all the results.
+    If max_memory is provided, check the memory use of this process every
+    MEMORY_CHECK_ACTIVITIES activities, and move things to disk whenever it's over
+    that many bytes (see enforce_memory_budget()).
+    If resolve_orgs is True, choose the name for each org ref up front, with
+    resolve_org_names(), instead of using the first name found.
+    Returns a tuple of (transactions, flows), where transactions is the TransactionSink
+    and flows is the FlowAggregator.
+
+    """
+
+    transactions = TransactionSink(sort_buffer)
+
+    flows = FlowAggregator()
+
+    activities_seen = set() if max_memory is None else SeenSet()
+
+    merged = 0
+
+    this_month = datetime.datetime.utcnow().isoformat()[:7]
+
+    # Load the reference data before starting any workers, so that forked workers inherit it
+    # (reloading it first for --watch if the files have changed since the last run)
+    with metrics.stage("reference_data"):
+        if memo is not None and has_reference_data_changed():
+            logger.info("The reference data has changed, so reloading it and processing everything again")
+            unload_reference_data()
+            memo.pop("results", None)
+        load_reference_data(cache_dir)
+
+    if cache_dir is None:
+        signature = None
+    else:
+        os.makedirs(cache_dir, exist_ok=True)
+        signature = make_cache_signature(this_month)
+
+    if resolve_orgs:
+        with metrics.stage("resolve_orgs"):
+            resolve_org_names(filenames, workers, cache_dir, memo)
+
+    file_keys = []
+
+    if latest:
+        if memo is not None and "index" in memo:
+            index = memo["index"]
+        else:
+            index = iatifiles.ActivityIndex(":memory:" if cache_dir is None else os.path.join(cache_dir, ACTIVITY_INDEX_FILE))
+            if memo is not None:
+                memo["index"] = index
+        logger.info("Indexed %d changed files", index.update(filenames))
+        work = [(filename, index.get_header_length(filename), spans,) for filename, spans in iatifiles.make_chunks(index.latest(filenames), CHUNK_BYTES)]
+        process = functools.partial(process_chunk, this_month=this_month, cache_dir=cache_dir, signature=signature, parser=parser)
+    else:
+        work = filenames
+        process = functools.partial(process_file, this_month=this_month, cache_dir=cache_dir, signature=signature, parser=parser)
+
+    if memo is None:
+        work_keys = [None] * len(work)
+        remembered = {}
+    else:
+        work_keys = [get_work_key(item, this_month) for item in work]
+        remembered = memo.get("results", {})
+        memo["results"] = {}
+
+    # Process only the work that we don't remember the results for
+    pending = [item for item, work_key in zip(work, work_keys) if work_key not in remembered]
+
+    if workers > 1 and pending:
+        pool = multiprocessing.Pool(workers)
+        file_results = pool.imap(process, pending)
+    else:
+        pool = None
+        file_results = map(process, pending)
+
+    try:
+        for work_key in work_keys:
+
+            if work_key in remembered:
+                results, file_key = remembered[work_key]
+                metrics.count("activities.remembered", len(results))
+                for identifier, result in results:
+                    if result is not None:
+                        metrics.merge(result[4])
+            else:
+                results, cache_update, counters = next(file_results)
+                metrics.merge(counters)
+                if cache_update is None:
+                    file_key = None
+                else:
+                    save_cache_update(cache_dir, cache_update)
+                    file_key = cache_update[0]
+                    logger.debug("%d new activity results for the cache", len(cache_update[2]))
+
+            if file_key is not None:
+                file_keys.append(file_key)
+
+            if memo is not None:
+                memo["results"][work_key] = (results, file_key,)
+                # merge_activity() fills in the org names, so merge a copy
+                results = [(identifier, copy_result(result),) for identifier, result in results]
+
+            for identifier, result in results:
+
+                # Don't use the same activity twice
+                if identifier in activities_seen:
+                    metrics.count("activities.skipped.duplicate_id")
+                    continue
+                activities_seen.add(identifier)
+
+                if result is not None:
+                    with metrics.stage("merge"):
+                        merge_activity(result, transactions, flows)
+
+                merged += 1
+                if max_memory is not None and merged % MEMORY_CHECK_ACTIVITIES == 0:
+                    enforce_memory_budget(max_memory, transactions, flows, activities_seen)
+    except BaseException:
+        if pool is not None:
+            # don't wait for the rest of the queued work (e.g. after a bad file, or Ctrl-C)
+            pool.terminate()
+            pool = None
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if max_memory is not None:
+            activities_seen.close()
+
+    if cache_dir is not None:
+        # Drop anything from the cache that this run didn't use
+        with metrics.stage("cache_prune"):
+            get_result_cache(cache_dir).prune(file_keys)
+
+    metrics.count("rows.transactions", len(transactions))
+    metrics.count("rows.flows", len(flows))
+
     return (transactions, flows,)
 
 
 #
-# Main entry point for script
+# Metrics
 #
 
-if __name__ == "__main__":
+class Metrics:
+    """ Stage timers and counters for a run, for the --metrics report
+    Counters from worker processes come back with each file's results (see
+    snapshot_counters()), and get merged in here in the main process.
 
-    import json, csv, os.path
+    """
 
-    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+    def __init__ (self):
+        self.timers = {}
+        self.counters = collections.Counter()
+        self.active_stages = []
+
+    @contextlib.contextmanager
+    def stage (self, name):
+        """ Time a stage of the run (adds up if the same stage runs more than once)
+        Time spent in a stage inside another one counts only towards the inner stage,
+        so the stage times don't overlap.
+
+        """
+        start_time = time.perf_counter()
+        self.active_stages.append(name)
+        try:
+            yield
+        finally:
+            self.active_stages.pop()
+            seconds = time.perf_counter() - start_time
+            self.timers[name] = self.timers.get(name, 0.0) + seconds
+            if self.active_stages:
+                outer = self.active_stages[-1]
+                self.timers[outer] = self.timers.get(outer, 0.0) - seconds
+
+    def count (self, name, n=1):
+        """ Add to a counter """
+        self.counters[name] += n
+
+    def merge (self, counters):
+        """ Add counters from a worker (or from this process) """
+        self.counters.update(counters)
+
+    def report (self, has_result_cache=False):
+        """ Return the metrics as a dict, for JSON
+        The activity-results hit rate is None unless has_result_cache is True (i.e. with --cache-dir).
+
+        """
+        counters = self.counters
+        seconds = self.timers.get("process_activities")
+        write_seconds = self.timers.get("write_transactions")
+        return {
+            "stages": self.timers,
+            "worker_seconds": {name[5:]: value for name, value in sorted(counters.items()) if name.startswith("time.")},
+            "counters": {name: value for name, value in sorted(counters.items()) if not name.startswith("time.")},
+            "throughput": {
+                "activities_per_second": counters["activities.processed"] / seconds if seconds else None,
+                "transaction_rows_per_second": counters["rows.transactions"] / write_seconds if write_seconds else None,
+            },
+            "cache_hit_rates": {
+                "clean_string": get_hit_rate(counters["cache.clean_string.hits"], counters["cache.clean_string.misses"]),
+                "usd_rate": get_hit_rate(counters["cache.usd_rate.hits"], counters["cache.usd_rate.misses"]),
+                "c19_narrative": get_hit_rate(counters["cache.c19_narrative.hits"], counters["cache.c19_narrative.misses"]),
+                "org_names": get_hit_rate(counters["org_names.matched"], counters["org_names.new"] + counters["org_names.unknown"]),
+                "activity_results": get_hit_rate(counters["activities.cached"], counters["activities.processed"] + counters["activities.skipped.secondary_reporter"]) if has_result_cache else None,
+            },
+            "peak_rss_bytes": {
+                "main": get_peak_rss(resource.RUSAGE_SELF),
+                "workers": get_peak_rss(resource.RUSAGE_CHILDREN),
+            },
+        }
+
+
+metrics = Metrics()
+""" Metrics for this run (main process only) """
+
+
+def snapshot_counters ():
+    """ Return a copy of activity_counters, plus the hit and miss counts of the lookup caches """
+    counters = activity_counters.copy()
+    for name, function in (("clean_string", clean_string,), ("usd_rate", lookup_usd_rate,),):
+        info = function.cache_info()
+        counters["cache.{}.hits".format(name)] = info.hits
+        counters["cache.{}.misses".format(name)] = info.misses
+    return counters
+
+def counters_since (before):
+    """ Return the increases in the counters since a snapshot from snapshot_counters()
+    Leaves out counters that went down (e.g. cache stats after unload_reference_data()).
 
-    if len(sys.argv) < 3:
-        print("Usage: python3 generate-data.py <output-dir> <xml-file ...>", file=sys.stderr)
-        exit(2)
+    """
+    counters = snapshot_counters()
+    counters.subtract(before)
+    return +counters
+
+def timed_iterator (iterator, name):
+    """ Yield from an iterator, adding the time spent waiting for each item to a counter in activity_counters """
+    iterator = iter(iterator)
+    while True:
+        start_time = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            activity_counters[name] += time.perf_counter() - start_time
+        yield item
+
+def get_hit_rate (hits, misses):
+    """ Return hits as a fraction of lookups, or None if there weren't any """
+    return hits / (hits + misses) if hits + misses else None
+
+
+#
+# Main entry point for script
+#
 
-    output_dir = sys.argv[1]
+def generate (args, filenames, memo=None):
+    """ Generate all of the output from a list of IATI XML files, using the command-line options
+    Skips writing anything if nothing has changed since the previous run (see MANIFEST_FILE).
+    See process_activities() for memo.
+    Returns the report from compare_manifests().
+
+    """
+    global metrics, org_names
+
+    # Start each run with fresh metrics and only the org names from the reference data
+    metrics = Metrics()
+    org_names = None
+
+    output_dir = args.output_dir
     logger.info("Writing output to directory %s", output_dir)
 
     # Build the accumulators from the IATI activities and transactions
-    transactions, flows = process_activities(sys.argv[2:])
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    with metrics.stage("process_activities"):
+        transactions, flows = process_activities(filenames, workers=args.workers, cache_dir=args.cache_dir, parser=args.parser, sort_buffer=args.sort_buffer, latest=args.latest, memo=memo, max_memory=None if args.max_memory is None else args.max_memory * 1024 * 1024, resolve_orgs=args.resolve_orgs)
+    if args.profile:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        logger.info("Wrote profile to %s", args.profile)
     logger.info("Processed %d transactions", len(transactions))
     logger.info("Processed %d flows", len(flows))
 
     #
-    # Write transactions
+    # Check what's changed since the previous run
     #
 
-    # Add headers and sort the transactions.
-    transactions = TRANSACTION_HEADERS + sorted(transactions)
+    previous = load_manifest(output_dir)
+    hasher = PartitionHasher(transactions.values())
+    if previous is not None and has_outputs(args):
+        # Hash the partitions first, so that we can skip writing if nothing's changed
+        with metrics.stage("hash_partitions"):
+            for row in transactions.sorted_codes():
+                hasher.add(row)
+            manifest = make_manifest(hasher.partitions(), flows)
+            changes = compare_manifests(previous, manifest)
+        if not changes["changed"]:
+            save_changes(output_dir, changes)
+            transactions.close()
+            flows.close()
+            logger.info("No changes since the previous run, so not writing the output")
+            report_metrics(args)
+            return changes
+    else:
+        manifest = None
+
+    # Remove the manifest until the new output is complete
+    if previous is not None:
+        os.remove(os.path.join(output_dir, MANIFEST_FILE))
 
-    # Write the JSON
-    with open(os.path.join(output_dir, TRANSACTIONS_JSON), "w") as output:
-        json.dump(transactions, output)
+    #
+    # Write transactions
+    #
 
-    # Write the CSV
-    with open(os.path.join(output_dir, TRANSACTIONS_CSV), "w") as output:
-        writer = csv.writer(output)
-        for row in transactions:
-            writer.writerow(row)
+    # Sort the transactions (merging from disk if needed), and write them with headers
+    # (rolling them up for the viz in the same pass)
+    rollups = make_rollups()
+    consumers = list(rollups)
+    if manifest is None:
+        # hash the partitions in the same pass
+        consumers.append(hasher)
+    if args.shards:
+        # partition the transactions into shards in the same pass too
+        # (keeping the shards that haven't changed)
+        unchanged = set() if manifest is None else get_unchanged_shards(changes, manifest)
+        shards = ShardWriter(output_dir, transactions.values(), unchanged)
+        consumers.append(shards)
+    if args.sqlite:
+        # and load them into a database
+        database = SqliteExport(args.sqlite, transactions.values())
+        consumers.append(database)
+    with metrics.stage("write_transactions"):
+        write_transactions(output_dir, transactions, consumers)
+    with metrics.stage("write_rollups"):
+        write_rollups(output_dir, rollups, transactions.values())
+    if args.shards:
+        with metrics.stage("shards"):
+            index = shards.close()
+        logger.info("Wrote %d shards", sum(len(entries) for entries in index["partitions"].values()))
+    transactions.close()
 
     #
-    # Prepare and write flows
+    # Write flows (already aggregated)
     #
 
-    # Add headers and aggregate
-    flows = hxl.data(FLOW_HEADERS + flows).count(
-        FLOW_HEADERS[1][:-1], # make a list of patterns from all but the last column of the hashtag row
-        aggregators="sum(#value+total) as Total money#value+total"
-    ).cache()
-
-    # Write the JSON
-    with open(os.path.join(output_dir, FLOWS_JSON), "w") as output:
-        for line in flows.gen_json():
-            print(line, file=output, end="")
-
-    # Write the CSV
-    with open(os.path.join(output_dir, FLOWS_CSV), "w") as output:
-        for line in flows.gen_csv():
-            print(line, file=output, end="")
+    with metrics.stage("write_flows"):
+        write_flows(output_dir, flows)
+
+    if manifest is None:
+        manifest = make_manifest(hasher.partitions(), flows)
+        changes = compare_manifests(previous, manifest)
+
+    if args.sqlite:
+        with metrics.stage("sqlite"):
+            database.close(flows)
+        logger.info("Wrote SQLite database %s", args.sqlite)
+    flows.close()
+
+    save_changes(output_dir, changes)
+    save_manifest(output_dir, manifest)
+    logger.info("%d partitions added, %d removed, and %d changed since the previous run", *(len(changes["partitions"][key]) for key in ("added", "removed", "changed",)))
+
+    report_metrics(args)
+    return changes
+
+def report_metrics (args):
+    """ Log the stage times, and write the metrics report if requested """
+    for name, seconds in metrics.timers.items():
+        logger.info("Stage %s took %.2f seconds", name, seconds)
+    if args.metrics:
+        with open(args.metrics, "w") as output:
+            json.dump(metrics.report(has_result_cache=args.cache_dir is not None), output, indent=4)
+        logger.info("Wrote metrics to %s", args.metrics)
+
+def has_outputs (args):
+    """ Check that all the output files for the command-line options are already there """
+    filenames = [TRANSACTIONS_JSON, TRANSACTIONS_CSV, FLOWS_JSON, FLOWS_CSV]
+    for name, columns in ROLLUPS:
+        filenames += [ROLLUP_FILE_TEMPLATE.format(name, "json"), ROLLUP_FILE_TEMPLATE.format(name, "csv")]
+    if args.shards:
+        filenames.append(os.path.join(SHARDS_DIR, SHARD_INDEX_FILE))
+    paths = [os.path.join(args.output_dir, filename) for filename in filenames]
+    if args.sqlite:
+        paths.append(args.sqlite)
+    return all(os.path.exists(path) for path in paths)
+
+
+def list_watched_files (dir):
+    """ Return a sorted list of (filename, size, mtime) tuples for the IATI files in a watched directory """
+    return stat_files(sorted(glob.glob(os.path.join(dir, WATCH_GLOB))))
+
+def stat_files (filenames):
+    """ Return a list of (filename, size, mtime) tuples for the files that exist """
+    files = []
+    for filename in filenames:
+        try:
+            stat = os.stat(filename)
+        except FileNotFoundError:
+            # removed since the glob
+            continue
+        files.append((filename, stat.st_size, stat.st_mtime_ns,))
+    return files
+
+def watch (args):
+    """ Regenerate the output whenever the IATI files in a directory (or the reference data) change, until interrupted
+    Runs in a single long-lived process, so the reference data, lookup caches, and the
+    results for unchanged files (see process_activities()) stay in memory between runs.
+    If the reference data changes, process_activities() reloads it and processes everything again.
+    Waits until the files have stopped changing for one interval before regenerating.
+
+    """
+    memo = {}
+    generated = None
+    previous = None
+    logger.info("Watching %s for changes to %s every %s seconds", args.watch, WATCH_GLOB, args.interval)
+    try:
+        while True:
+            files = list_watched_files(args.watch)
+            state = (files, stat_files(get_reference_filenames()),)
+            if files and state != generated and state == previous:
+                logger.info("Generating output from %d files", len(files))
+                try:
+                    generate(args, [filename for filename, size, mtime in files], memo)
+                except Exception:
+                    # keep watching; the next change might fix it
+                    logger.exception("Failed to generate output")
+                    memo.clear()
+                generated = state
+            previous = state
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        logger.info("Stopped watching %s", args.watch)
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+
+    argparser = argparse.ArgumentParser(description="Compile IATI COVID-19 transactions and flows")
+    argparser.add_argument("--workers", type=int, default=1, metavar="N", help="Number of worker processes for parsing (default: 1)")
+    argparser.add_argument("--parser", choices=sorted(PARSERS), default="diterator", help="How to parse the activities: the full diterator object model, or a faster streaming parser (default: diterator)")
+    argparser.add_argument("--sort-buffer", type=int, default=SORT_BUFFER_ROWS, metavar="ROWS", help="Maximum transaction rows to sort in memory before spilling to disk (default: {})".format(SORT_BUFFER_ROWS))
+    argparser.add_argument("--cache-dir", metavar="DIR", help="Directory for caching results between runs (default: no caching)")
+    argparser.add_argument("--latest", action="store_true", help="When an activity appears more than once, use the copy with the latest last-updated-datetime (default: the first copy)")
+    argparser.add_argument("--shards", action="store_true", help="Also write the transactions partitioned by country and by month, with compressed copies, under <output_dir>/{}".format(SHARDS_DIR))
+    argparser.add_argument("--sqlite", metavar="FILE", help="Also write the transactions and flows to a SQLite database, with indexes and aggregate views")
+    argparser.add_argument("--resolve-orgs", action="store_true", help="Use the most common name for each org ref across all the files, instead of the first one found (the counts are kept in the --cache-dir)")
+    argparser.add_argument("--max-memory", type=int, metavar="MB", help="Memory budget for the main process: when it's using more than this, move the transactions, flows, and seen activity identifiers to disk (default: no limit)")
+    argparser.add_argument("--metrics", metavar="FILE", help="Write stage timings, throughput, skip counts, cache hit rates, and peak memory to a JSON file")
+    argparser.add_argument("--profile", metavar="FILE", help="Profile process_activities() with cProfile and write the stats to a file (use with --workers 1, since workers aren't profiled)")
+    argparser.add_argument("--watch", metavar="DIR", help="Keep running, and regenerate the output whenever the {} files in DIR change (instead of reading the xml_files)".format(WATCH_GLOB))
+    argparser.add_argument("--interval", type=float, default=WATCH_INTERVAL, metavar="SECONDS", help="Seconds between checks for --watch (default: {})".format(WATCH_INTERVAL))
+    argparser.add_argument("output_dir", help="Directory for the output files")
+    argparser.add_argument("xml_files", nargs="*", metavar="xml_file", help="IATI XML files to read (.xml or .xml.gz)")
+    args = argparser.parse_args()
+
+    if args.watch:
+        watch(args)
+    elif args.xml_files:
+        generate(args, args.xml_files)
+    else:
+        argparser.error("provide at least one xml_file, or --watch")
 
 # end
@@ -0,0 +1,242 @@
+""" Byte-level helpers for files of IATI activities
+These work on the raw bytes of an iati-activities document, without parsing
+the XML, so they're fast enough to run over a whole download directory.
+Files whose names end with .gz are decompressed transparently (see open_file()).
+They assume one iati-activity element per activity (no nesting), which is
+always true for valid IATI.
+
+"""
+
+import gzip, os, re, sqlite3, xml.sax.saxutils
+
+#
+# Constants
+#
+
+ACTIVITY_PATTERN = re.compile(rb'<iati-activity[\s>].*?</iati-activity\s*>\s*', re.DOTALL)
+""" Regular expression matching a complete iati-activity element, plus any trailing whitespace """
+
+IDENTIFIER_PATTERN = re.compile(rb'<iati-identifier(?:\s[^>]*)?>(.*?)</iati-identifier\s*>', re.DOTALL)
+""" Regular expression matching an activity's iati-identifier element """
+
+LAST_UPDATED_PATTERN = re.compile(rb'\slast-updated-datetime\s*=\s*["\']([^"\']*)["\']')
+""" Regular expression matching the last-updated-datetime attribute (search in the start tag only) """
+
+GZIP_LEVEL = 6
+""" Compression level for gzipped IATI files (faster than the default 9, and nearly as small) """
+
+INDEX_BATCH_ROWS = 10000
+""" Number of index rows to insert at a time """
+
+
+#
+# Functions
+#
+
+def open_file (filename):
+    """ Open an IATI XML file for reading bytes, decompressing it on the fly if the name ends with .gz """
+    if str(filename).endswith(".gz"):
+        return gzip.open(filename, "rb")
+    else:
+        return open(filename, "rb")
+
+def read_file (filename):
+    """ Return the (decompressed) bytes of an IATI XML file """
+    with open_file(filename) as input:
+        return input.read()
+
+def write_file (filename, data, compressed):
+    """ Write bytes to a file, gzip-compressed or not """
+    if compressed:
+        with gzip.open(filename, "wb", compresslevel=GZIP_LEVEL) as output:
+            output.write(data)
+    else:
+        with open(filename, "wb") as output:
+            output.write(data)
+
+def find_activities (data):
+    """ Yield a (start, end) tuple for each iati-activity element in a bytes object
+    The end offset includes any whitespace after the element.
+
+    """
+    for match in ACTIVITY_PATTERN.finditer(data):
+        yield match.span()
+
+def get_identifier (snippet):
+    """ Return the IATI identifier from the bytes of a single activity, or None if there isn't one
+    Like diterator, doesn't strip whitespace.
+
+    """
+    match = IDENTIFIER_PATTERN.search(snippet)
+    if match is None:
+        return None
+    return xml.sax.saxutils.unescape(match.group(1).decode("utf-8"), {"&quot;": '"', "&apos;": "'"})
+
+def get_last_updated (snippet):
+    """ Return the last-updated-datetime from the bytes of a single activity, or None if there isn't one """
+    start_tag = snippet[:snippet.find(b">") + 1]
+    match = LAST_UPDATED_PATTERN.search(start_tag)
+    if match is None:
+        return None
+    return match.group(1).decode("utf-8").strip()
+
+def scan_activities (data):
+    """ Yield an (identifier, last_updated, start, end) tuple for each activity in a bytes object """
+    for start, end in find_activities(data):
+        snippet = data[start:end]
+        yield (get_identifier(snippet), get_last_updated(snippet), start, end,)
+
+def remove_activities (data, identifiers):
+    """ Return a copy of a bytes object without the activities whose identifiers are in the set provided
+    The iati-activities wrapper and everything else outside the removed activities stays the same.
+
+    """
+    pieces = []
+    pos = 0
+    for start, end in find_activities(data):
+        if get_identifier(data[start:end]) in identifiers:
+            pieces.append(data[pos:start])
+            pos = end
+    pieces.append(data[pos:])
+    return b"".join(pieces)
+
+
+
+#
+# Index
+#
+
+class ActivityIndex:
+    """ Index of the byte offsets of activities in a set of IATI XML files
+    Records the file, offset, length, and last-updated-datetime of every activity,
+    plus the length of each file's header (everything before the first activity),
+    so that an activity can be read, or wrapped into a complete document, without
+    parsing anything else. Stored in SQLite (use ":memory:" for a throwaway index).
+    update() rescans only the files whose size or modification time has changed.
+
+    Usage:
+
+        index = iatifiles.ActivityIndex("activity-index.sqlite")
+        index.update(filenames)
+        for entry in index.find(identifier):
+            print(index.read(entry))
+
+    """
+
+    def __init__ (self, path=":memory:"):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS files (filename TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, header_length INTEGER)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS activities (identifier TEXT, last_updated TEXT, filename TEXT, offset INTEGER, length INTEGER)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS activities_identifier ON activities (identifier)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS activities_filename ON activities (filename, offset)")
+        self.connection.commit()
+
+    def update (self, filenames):
+        """ Bring the index up to date for a list of files, dropping any other files
+        Returns the number of files (re)scanned.
+
+        """
+        known = {filename: (size, mtime,) for filename, size, mtime in self.connection.execute("SELECT filename, size, mtime FROM files")}
+        scanned = 0
+        for filename in filenames:
+            stat = os.stat(filename)
+            if known.get(filename) == (stat.st_size, stat.st_mtime_ns,):
+                continue
+            data = read_file(filename)
+            self.remove(filename)
+            header_length = None
+            rows = []
+            for identifier, last_updated, start, end in scan_activities(data):
+                if header_length is None:
+                    header_length = start
+                rows.append((identifier, last_updated, filename, start, end - start,))
+                if len(rows) >= INDEX_BATCH_ROWS:
+                    self.connection.executemany("INSERT INTO activities VALUES (?, ?, ?, ?, ?)", rows)
+                    rows = []
+            self.connection.executemany("INSERT INTO activities VALUES (?, ?, ?, ?, ?)", rows)
+            self.connection.execute(
+                "INSERT INTO files VALUES (?, ?, ?, ?)",
+                (filename, stat.st_size, stat.st_mtime_ns, header_length if header_length is not None else len(data),)
+            )
+            scanned += 1
+        for filename in set(known).difference(filenames):
+            self.remove(filename)
+        self.connection.commit()
+        return scanned
+
+    def remove (self, filename):
+        """ Drop a file from the index (doesn't commit) """
+        self.connection.execute("DELETE FROM activities WHERE filename=?", (filename,))
+        self.connection.execute("DELETE FROM files WHERE filename=?", (filename,))
+
+    def find (self, identifier):
+        """ Return a list of (filename, offset, length, last_updated) entries for every copy of an activity, sorted by filename and offset """
+        return [tuple(row) for row in self.connection.execute(
+            "SELECT filename, offset, length, last_updated FROM activities WHERE identifier IS ? ORDER BY filename, offset",
+            (identifier,)
+        )]
+
+    def entries (self, filename):
+        """ Return a list of (identifier, offset, length, last_updated) entries for the activities in a file, in order """
+        return [tuple(row) for row in self.connection.execute(
+            "SELECT identifier, offset, length, last_updated FROM activities WHERE filename=? ORDER BY offset",
+            (filename,)
+        )]
+
+    def get_header_length (self, filename):
+        """ Return the length of a file's header (everything before the first activity) """
+        return self.connection.execute("SELECT header_length FROM files WHERE filename=?", (filename,)).fetchone()[0]
+
+    def read (self, entry):
+        """ Return the bytes of a single activity from an entry returned by find()
+        Offsets are in the decompressed data for a .gz file.
+
+        """
+        filename, offset, length = entry[:3]
+        with open_file(filename) as input:
+            input.seek(offset)
+            return input.read(length)
+
+    def latest (self, filenames):
+        """ Choose the most recent copy of each activity in a list of files
+        The most recent copy has the highest last-updated-datetime (compared as text, as
+        the standard's ISO 8601 timestamps are; no timestamp counts as oldest). Ties go to
+        the first copy, in the order of the filenames and then the offsets in each file.
+        Returns a list of (filename, [(offset, length), ...]) tuples, in the same order as the
+        filenames, with the chosen activities in file order.
+
+        """
+        chosen = {}
+        for filename in filenames:
+            for identifier, offset, length, last_updated in self.entries(filename):
+                previous = chosen.get(identifier)
+                if previous is None or (last_updated or "") > (previous[3] or ""):
+                    chosen[identifier] = (filename, offset, length, last_updated or "",)
+        spans = {filename: [] for filename in filenames}
+        for filename, offset, length, last_updated in chosen.values():
+            spans[filename].append((offset, length,))
+        return [(filename, sorted(spans[filename]),) for filename in filenames]
+
+
+def make_chunks (file_spans, chunk_bytes):
+    """ Split the result of ActivityIndex.latest() into work chunks of about chunk_bytes of activities each
+    A big file can spread over several chunks, but a chunk never mixes files.
+    Returns a list of (filename, spans) tuples, in order.
+
+    """
+    chunks = []
+    for filename, spans in file_spans:
+        chunk = []
+        size = 0
+        for offset, length in spans:
+            chunk.append((offset, length,))
+            size += length
+            if size >= chunk_bytes:
+                chunks.append((filename, chunk,))
+                chunk = []
+                size = 0
+        if chunk:
+            chunks.append((filename, chunk,))
+    return chunks
+
+# end
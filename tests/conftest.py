@@ -0,0 +1,59 @@
+""" Shared fixtures for the tests
+The pipeline scripts have hyphens in their names, so they're loaded as modules
+by filename (registered in sys.modules, so that worker processes can unpickle
+their functions).
+
+"""
+
+import argparse, importlib.util, os, pytest, sys
+
+SCRIPT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+""" Directory containing the pipeline scripts """
+
+sys.path.insert(0, SCRIPT_DIR)
+
+def load_script (name, filename):
+    """ Load one of the pipeline scripts as a module (once per test session) """
+    if name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(name, os.path.join(SCRIPT_DIR, filename))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+    return sys.modules[name]
+
+@pytest.fixture
+def download_iati ():
+    return load_script("download_iati", "download-iati.py")
+
+@pytest.fixture
+def generate_data ():
+    return load_script("generate_data", "generate-data.py")
+
+@pytest.fixture
+def reference_dir (monkeypatch):
+    """ Run in the script directory, so that generate-data.py finds the reference data in data/ """
+    monkeypatch.chdir(SCRIPT_DIR)
+    return SCRIPT_DIR
+
+def make_args (output_dir, **options):
+    """ Return the default command-line options for generate-data.py, with any changes provided """
+    args = argparse.Namespace(
+        output_dir=str(output_dir), workers=1, parser="diterator", sort_buffer=1000000, cache_dir=None,
+        latest=False, shards=False, sqlite=None, resolve_orgs=False, max_memory=None, metrics=None, profile=None,
+    )
+    vars(args).update(options)
+    return args
+
+def read_outputs (output_dir, skip=("manifest.json", "changes.json",)):
+    """ Return a dict of the contents of all the output files under output_dir, by relative path
+    Skips the manifest and changes files by default, since they record the options used.
+
+    """
+    outputs = {}
+    for dirpath, dirnames, filenames in os.walk(output_dir):
+        for filename in filenames:
+            path = os.path.relpath(os.path.join(dirpath, filename), output_dir)
+            if path not in skip:
+                with open(os.path.join(dirpath, filename), "rb") as input:
+                    outputs[path] = input.read()
+    return outputs
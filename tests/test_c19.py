@@ -0,0 +1,37 @@
+""" Tests for COVID-19 classification in generate-data.py """
+
+import pytest
+
+NARRATIVES = [
+    {"en": "Response to covid-19"},
+    {"en": "Coronavirus response"},
+    {"en": "Health systems", "fr": "Riposte COVID-19"},
+    {"en": "Ends with COVID"},
+    {"en": "-19 at the start"},
+    {"en": "Covidiots and coronaviruses"},
+    {},
+    None,
+    {"en": "Response to covid-19"},
+]
+
+EXPECTED = ["strict", "loose", "strict", "loose", None, None, None, None, "strict"]
+
+@pytest.fixture
+def classifier (generate_data, monkeypatch):
+    monkeypatch.setattr(generate_data, "narrative_classes", {})
+    return generate_data
+
+def test_classify_narrative_batch (classifier):
+    assert classifier.classify_narrative_batch(NARRATIVES) == EXPECTED
+    assert [classifier.classify_narratives(narratives) for narratives in NARRATIVES if narratives is not None] == [c for c, n in zip(EXPECTED, NARRATIVES) if n is not None]
+
+def test_classify_narrative_batch_memo (classifier, monkeypatch):
+    before = classifier.activity_counters.copy()
+    classifier.classify_narrative_batch(NARRATIVES)
+    assert classifier.activity_counters["cache.c19_narrative.misses"] - before["cache.c19_narrative.misses"] == 7
+    assert classifier.activity_counters["cache.c19_narrative.hits"] - before["cache.c19_narrative.hits"] == 1
+
+    # Still right when the memo fills up
+    monkeypatch.setattr(classifier, "C19_NARRATIVE_CACHE_SIZE", 3)
+    for i in range(len(NARRATIVES)):
+        assert classifier.classify_narrative_batch(NARRATIVES[i:] + NARRATIVES[:i]) == EXPECTED[i:] + EXPECTED[:i]
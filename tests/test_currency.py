@@ -0,0 +1,74 @@
+""" Tests for currency conversion in generate-data.py """
+
+import json, types, pytest
+
+@pytest.fixture
+def rates (generate_data, tmp_path, monkeypatch):
+    """ Replace the exchange rates with historical EUR rates for March and June 2020 only, and fallback EUR and GBP rates """
+    path = tmp_path / "eur.json"
+    path.write_text(json.dumps({
+        "base": "USD",
+        "rates": {
+            "2020-03-02": {"EUR": 0.90},
+            "2020-03-20": {"EUR": 0.92},
+            "2020-06-15": {"EUR": 0.80},
+        },
+    }))
+    monkeypatch.setattr(generate_data, "reference_data", {
+        "rates": {"EUR": 0.85, "GBP": 0.75},
+        "historical_rates": generate_data.load_historical_rates([str(path)]),
+    })
+    generate_data.lookup_usd_rate.cache_clear()
+    yield generate_data
+    generate_data.lookup_usd_rate.cache_clear()
+
+def test_monthly_average (rates):
+    assert rates.get_usd_rate("EUR", "2020-03-25") == pytest.approx(0.91)
+    assert rates.get_usd_rate("EUR", "2020-06-01") == pytest.approx(0.80)
+
+def test_date_before_first_rate (rates):
+    assert rates.get_usd_rate("EUR", "2019-12-31") == pytest.approx(0.91)
+
+def test_gap_month (rates):
+    assert rates.get_usd_rate("EUR", "2020-04-15") == pytest.approx(0.91)
+    assert rates.get_usd_rate("EUR", "2021-01-01") == pytest.approx(0.80)
+
+@pytest.mark.parametrize("isodate", [None, "", "2020", "unknown"])
+def test_missing_or_invalid_date (rates, isodate):
+    assert rates.get_usd_rate("EUR", isodate) == 0.85
+
+def test_no_historical_rates (rates):
+    assert rates.get_usd_rate("GBP", "2020-03-25") == 0.75
+
+def test_unknown_currency (rates):
+    before = rates.activity_counters["transactions.unknown_currency"]
+    assert rates.get_usd_rate("XYZ", "2020-03-25") is None
+    assert rates.convert_to_usd(1000, "xyz", "2020-03-25") == 0
+    assert rates.activity_counters["transactions.unknown_currency"] == before + 1
+
+def test_convert_all_to_usd (rates):
+    items = [
+        (910, "EUR", "2020-03-25"),
+        (910, " eur ", "2020-03-01"),
+        (800, "EUR", "2020-07-01"),
+        (750, "GBP", None),
+        (123.5, "USD", "2020-03-25"),
+        (0, "XYZ", "2020-03-25"),
+    ]
+    assert rates.convert_all_to_usd(items) == [1000, 1000, 1000, 1000, 124, 0]
+    assert rates.convert_all_to_usd(items) == [rates.convert_to_usd(*item) for item in items]
+
+def test_summarise_transactions (rates):
+    def transaction (type, value, currency="EUR", date="2020-03-25", value_date=None):
+        return types.SimpleNamespace(type=type, value=value, currency=currency, date=date, value_date=value_date)
+    transactions = [
+        transaction("11", 455),
+        transaction("2", 910),
+        transaction("5", 910),
+        transaction("3", 800, value_date="2020-06-01"),
+    ]
+    summary = rates.summarise_transactions(transactions)
+    assert [usd_value for transaction, type, date, value, usd_value in summary["transactions"]] == [500, 1000, None, 1000]
+    assert summary["totals"]["2"] == 1000
+    assert summary["commitment_factor"] == 0.5
+    assert summary["spending_factor"] == 0.5
@@ -0,0 +1,215 @@
+""" Tests for download-iati.py, against a local stand-in for D-Portal """
+
+import gzip, http.server, iatifiles, json, os, re, threading, urllib.parse, pytest
+from conftest import make_args, read_outputs
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "parity.xml")
+
+#
+# Stand-in server
+#
+
+ACTIVITY_TEMPLATE = """  <iati-activity last-updated-datetime="{updated}">
+    <iati-identifier>{identifier}</iati-identifier>
+    <title><narrative>COVID-19 response {identifier}</narrative></title>
+  </iati-activity>
+"""
+
+class StandInDPortal (http.server.ThreadingHTTPServer):
+    """ Just enough of D-Portal to answer DPORTAL_QUERY
+    activities maps identifiers to last-updated-datetimes; results are paged
+    in (last-updated, identifier) order. The last-updated filter is applied
+    where the query puts it: before paging if it's in the paged subquery (the
+    first "aid IN"), and to each page afterwards otherwise, as D-Portal would.
+    failures maps offsets to the number of 503 responses to send before
+    answering, and requests records the (offset, since) of every request.
+
+    """
+
+    def __init__ (self, activities):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.activities = dict(activities)
+        self.failures = {}
+        self.requests = []
+        self.lock = threading.Lock()
+        self.url = "http://127.0.0.1:{}/dquery?form=xml&sql=".format(self.server_address[1])
+
+    def answer (self, sql):
+        """ Return the HTTP status and body for a query """
+        limit = int(re.search(r'LIMIT (\d+)', sql).group(1))
+        offset = int(re.search(r'OFFSET (\d+)', sql).group(1))
+        match = re.search(r"'@last-updated-datetime' >= '([^']*)'", sql)
+        since = match.group(1) if match else None
+        with self.lock:
+            self.requests.append((offset, since,))
+            if self.failures.get(offset):
+                self.failures[offset] -= 1
+                return 503, b""
+            activities = sorted(self.activities.items(), key=lambda item: (item[1], item[0],))
+        is_paged_filter = since is not None and match.start() > sql.index("aid IN (")
+        if is_paged_filter:
+            activities = [item for item in activities if item[1] >= since]
+        activities = activities[offset:offset+limit]
+        if since is not None and not is_paged_filter:
+            activities = [item for item in activities if item[1] >= since]
+        body = "<iati-activities>\n{}</iati-activities>\n".format("".join(
+            ACTIVITY_TEMPLATE.format(identifier=identifier, updated=updated) for identifier, updated in activities
+        ))
+        return 200, body.encode("utf-8")
+
+class StandInHandler (http.server.BaseHTTPRequestHandler):
+
+    def do_GET (self):
+        sql = urllib.parse.unquote(self.path.split("&sql=", 1)[1])
+        status, body = self.server.answer(sql)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message (self, format, *args):
+        pass
+
+@pytest.fixture
+def server ():
+    activities = {"test-{}".format(i): "2021-01-0{}T00:00:00Z".format(i) for i in range(1, 7)}
+    server = StandInDPortal(activities)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def downloader (download_iati, monkeypatch):
+    """ download-iati.py with two activities per page and no delay between retries """
+    monkeypatch.setattr(download_iati, "LIMIT", 2)
+    monkeypatch.setattr(download_iati, "BACKOFF", 0)
+    return download_iati
+
+def read_store (output_dir):
+    """ Return a dict of identifier: last-updated for all the activities in the output files """
+    activities = {}
+    for path in sorted(output_dir.glob("iati-activities-*.xml*")):
+        for identifier, updated, start, end in iatifiles.scan_activities(iatifiles.read_file(path)):
+            assert identifier not in activities
+            activities[identifier] = updated
+    return activities
+
+
+#
+# Tests
+#
+
+def test_download_pages (downloader, server, tmp_path):
+    downloader.download_pages(tmp_path, concurrency=2, url_base=server.url)
+    assert read_store(tmp_path) == server.activities
+    assert len(list(tmp_path.glob("iati-activities-*.xml.gz"))) == 3
+    manifest = json.loads((tmp_path / downloader.MANIFEST_FILE).read_text())
+    assert manifest["complete"]
+    assert manifest["pages"]["4"] is None
+
+def test_retry_on_503 (downloader, server, tmp_path):
+    server.failures[2] = 2
+    downloader.download_pages(tmp_path, concurrency=2, retries=2, url_base=server.url)
+    assert read_store(tmp_path) == server.activities
+    assert [offset for offset, since in server.requests].count(2) == 3
+
+def test_give_up_after_retries (downloader, server, tmp_path):
+    server.failures[2] = 3
+    with pytest.raises(Exception, match="Giving up on page 2 after 3 attempts"):
+        downloader.download_pages(tmp_path, concurrency=1, retries=2, url_base=server.url)
+
+def test_resume_from_manifest (downloader, server, tmp_path):
+    server.failures[2] = 1
+    with pytest.raises(Exception):
+        downloader.download_pages(tmp_path, concurrency=1, retries=0, url_base=server.url)
+    manifest = json.loads((tmp_path / downloader.MANIFEST_FILE).read_text())
+    assert not manifest["complete"]
+    assert list(manifest["pages"]) == ["1"]
+
+    server.requests.clear()
+    downloader.download_pages(tmp_path, concurrency=1, retries=0, url_base=server.url)
+    assert read_store(tmp_path) == server.activities
+    assert 0 not in [offset for offset, since in server.requests]
+
+def test_delta_with_updates_on_a_later_page (downloader, server, tmp_path):
+    downloader.main(tmp_path, concurrency=2, url_base=server.url)
+    assert read_store(tmp_path) == server.activities
+
+    # In last-updated order, the first two pages have no updates
+    server.activities["test-5"] = "2021-02-01T00:00:00Z"
+    server.requests.clear()
+    downloader.main(tmp_path, concurrency=2, url_base=server.url)
+    assert read_store(tmp_path) == server.activities
+    assert all(since == "2021-01-06T00:00:00Z" for offset, since in server.requests)
+    assert not (tmp_path / downloader.DELTA_DIR).exists()
+
+    state = json.loads((tmp_path / downloader.STATE_FILE).read_text())
+    assert state["last_updated"] == "2021-02-01T00:00:00Z"
+
+OTHER_HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<iati-activities version="2.01" generated-datetime="2021-01-01T00:00:00Z">
+"""
+
+OTHER_MATCH = """  <iati-activity last-updated-datetime="2020-12-01T00:00:00Z" default-currency="USD">
+    <iati-identifier>XM-OTHER-1</iati-identifier>
+    <reporting-org ref="XM-OTHER" type="10"><narrative>Other Agency</narrative></reporting-org>
+    <title><narrative>Vaccine delivery</narrative></title>
+    <tag vocabulary="99" code="COVID-19"/>
+    <transaction>
+      <transaction-type code="3"/>
+      <transaction-date iso-date="2020-11-15"/>
+      <value>7000</value>
+    </transaction>
+  </iati-activity>
+"""
+
+OTHER_SKIPPED = """  <iati-activity last-updated-datetime="2020-12-02T00:00:00Z">
+    <iati-identifier>XM-OTHER-2</iati-identifier>
+    <reporting-org ref="XM-OTHER" type="10"><narrative>Other Agency</narrative></reporting-org>
+    <title><narrative>Covidiots awareness campaign</narrative></title>
+    <description><narrative>Coronaviruses in bats</narrative></description>
+  </iati-activity>
+  <iati-activity last-updated-datetime="2020-12-03T00:00:00Z">
+    <iati-identifier>XM-OTHER-3</iati-identifier>
+    <reporting-org ref="XM-OTHER" type="10" secondary-reporter="1"><narrative>Other Agency</narrative></reporting-org>
+    <title><narrative>COVID-19 response</narrative></title>
+  </iati-activity>
+  <iati-activity last-updated-datetime="2020-12-04T00:00:00Z">
+    <iati-identifier>XM-OTHER-4</iati-identifier>
+    <reporting-org ref="XM-OTHER" type="10"><narrative>Other Agency</narrative></reporting-org>
+    <title><narrative>Water and sanitation</narrative></title>
+  </iati-activity>
+"""
+""" Activities that the prefilter lets through, but the precise criteria don't (not whole words, a secondary reporter, no keywords at all) """
+
+def test_ingest_dump (downloader, generate_data, reference_dir, tmp_path):
+    dump_dir = tmp_path / "dump"
+    (dump_dir / "nested").mkdir(parents=True)
+    with open(FIXTURE, "r", encoding="utf-8") as input:
+        (dump_dir / "parity.xml").write_text(input.read(), encoding="utf-8")
+    (dump_dir / "nested" / "other.xml").write_text(OTHER_HEADER + OTHER_SKIPPED + OTHER_MATCH + "</iati-activities>\n", encoding="utf-8")
+    output_dir = tmp_path / "downloads"
+    output_dir.mkdir()
+    downloader.ingest_dump(dump_dir, output_dir)
+
+    # the same results as the matching activities alone
+    expected_path = tmp_path / "expected.xml"
+    expected_path.write_text(OTHER_HEADER + OTHER_MATCH + "</iati-activities>\n", encoding="utf-8")
+    (tmp_path / "expected").mkdir()
+    generate_data.generate(make_args(tmp_path / "expected"), [FIXTURE, str(expected_path)])
+    paths = sorted(output_dir.glob("iati-activities-*.xml.gz"))
+    (tmp_path / "ingested").mkdir()
+    generate_data.generate(make_args(tmp_path / "ingested"), [str(path) for path in paths])
+    assert read_outputs(tmp_path / "ingested") == read_outputs(tmp_path / "expected")
+    assert not set(read_store(output_dir)) & {"XM-OTHER-2", "XM-OTHER-3", "XM-OTHER-4", "XM-TEST-5"}
+
+    # the version is the one from the source files, or none if a file mixes them
+    versions = []
+    for path in paths:
+        with gzip.open(path, "rb") as input:
+            match = downloader.VERSION_PATTERN.search(input.read().split(b">", 2)[1])
+            versions.append(match.group(1) if match else None)
+    assert versions == [None, b"2.03", b"2.03"]
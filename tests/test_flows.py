@@ -0,0 +1,60 @@
+""" Tests for the flows aggregation in generate-data.py """
+
+import csv, json, os, pytest
+from conftest import make_args
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "parity.xml")
+
+ROWS = [
+    ["Org A", "10", "Provider  A", "Receiver A", 1, 0, "Disbursement", "Outgoing", 100],
+    ["Org A", "10", " Provider A ", "Receiver A", 1, 0, "Disbursement", "Outgoing", 50.0],
+    ["Org A", "10", "Provider A", "Receiver A", 1, 0, "Disbursement", "Outgoing", 0.5],
+    ["Org A", "10", None, "Receiver B", 0, 1, "Commitment", "Outgoing", 0],
+    ["Org B", None, "Provider B", "", 1, 1, "Incoming funds", "Incoming", 25],
+    ["Org B", None, "Provider B", "", 1, 1, "Incoming funds", "Incoming", None],
+]
+""" Flow rows as process_activities() makes them, with spacing, 0 and None to normalise """
+
+EXPECTED = [
+    ["Org A", "10", "", "Receiver B", "", "1", "Commitment", "Outgoing", ""],
+    ["Org A", "10", "Provider A", "Receiver A", "1", "", "Disbursement", "Outgoing", 150.5],
+    ["Org B", "", "Provider B", "", "1", "1", "Incoming funds", "Incoming", 25],
+]
+""" The aggregated rows, as libhxl's count() filter produced them """
+
+def aggregate (generate_data, rows, spill_every=None):
+    flows = generate_data.FlowAggregator()
+    for i, row in enumerate(rows):
+        flows.append(row)
+        if spill_every and (i + 1) % spill_every == 0:
+            flows.spill()
+    try:
+        return list(flows.rows())
+    finally:
+        flows.close()
+
+def test_aggregate (generate_data):
+    assert aggregate(generate_data, ROWS) == EXPECTED
+
+def test_aggregate_spill (generate_data):
+    for spill_every in (1, 2, 4):
+        assert aggregate(generate_data, ROWS, spill_every) == EXPECTED
+
+def test_aggregate_hxl (generate_data):
+    hxl = pytest.importorskip("hxl")
+    rows = generate_data.FLOW_HEADERS + ROWS
+    expected = list(hxl.data(rows).count(
+        generate_data.FLOW_HEADERS[1][:-1],
+        aggregators="sum(#value+total) as Total money#value+total"
+    ).gen_json())
+    assert json.loads("".join(expected))[2:] == aggregate(generate_data, ROWS)
+
+def test_write_flows (generate_data, reference_dir, tmp_path):
+    generate_data.generate(make_args(tmp_path), [FIXTURE])
+    json_text = (tmp_path / generate_data.FLOWS_JSON).read_text()
+    rows = json.loads(json_text)
+    assert rows[:2] == generate_data.FLOW_HEADERS and len(rows) > 2
+    # one row per line, like libhxl's gen_json()
+    assert json_text.splitlines()[1:-1] == [json.dumps(row) + ("," if i < len(rows) - 1 else "") for i, row in enumerate(rows)]
+    with open(tmp_path / generate_data.FLOWS_CSV, "r", newline="") as input:
+        assert list(csv.reader(input)) == [[str(value) for value in row] for row in rows]
@@ -0,0 +1,172 @@
+""" Tests for the options of generate-data.py
+Each one runs the whole pipeline on the parity fixture, and compares the output
+with a default (serial, in-memory) run.
+
+"""
+
+import csv, io, json, os, pytest, sqlite3
+from conftest import make_args, read_outputs
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "parity.xml")
+
+@pytest.fixture
+def filenames (tmp_path):
+    """ The parity fixture, plus a copy with different activity identifiers (so that there's more than one file) """
+    with open(FIXTURE, "r", encoding="utf-8") as input:
+        xml = input.read()
+    copy_path = tmp_path / "copy.xml"
+    copy_path.write_text(xml.replace("XM-TEST-", "XM-COPY-"), encoding="utf-8")
+    return [FIXTURE, str(copy_path)]
+
+@pytest.fixture
+def expected (generate_data, reference_dir, tmp_path, filenames):
+    """ The outputs from a default run """
+    return run(generate_data, tmp_path / "expected", filenames)
+
+def run (generate_data, output_dir, filenames, **options):
+    """ Run generate-data.py with the options provided, and return the outputs """
+    output_dir.mkdir()
+    generate_data.generate(make_args(output_dir, **options), filenames)
+    return read_outputs(output_dir)
+
+def test_workers (generate_data, tmp_path, filenames, expected):
+    assert run(generate_data, tmp_path / "out", filenames, workers=2) == expected
+
+def test_workers_malformed_file (generate_data, reference_dir, tmp_path, filenames):
+    malformed_path = tmp_path / "malformed.xml"
+    malformed_path.write_text("<iati-activities><iati-activity>", encoding="utf-8")
+    with pytest.raises(RuntimeError, match="malformed.xml"):
+        generate_data.process_activities([filenames[0], str(malformed_path), filenames[1]], workers=2)
+
+def test_rollups (generate_data, expected):
+    transactions = json.loads(expected[generate_data.TRANSACTIONS_JSON])
+    for name, columns in generate_data.ROLLUPS:
+        group_columns = columns + generate_data.ROLLUP_FLAG_COLUMNS
+        totals = {}
+        for row in transactions[2:]:
+            key = tuple(row[i] for i in group_columns)
+            totals[key] = [a + row[i] for a, i in zip(totals.get(key, [0, 0]), generate_data.ROLLUP_VALUE_COLUMNS)]
+        headers = [[header_row[i] for i in group_columns + generate_data.ROLLUP_VALUE_COLUMNS] for header_row in transactions[:2]]
+        rows = headers + sorted(list(key) + values for key, values in totals.items())
+        assert json.loads(expected[generate_data.ROLLUP_FILE_TEMPLATE.format(name, "json")]) == rows
+        csv_rows = list(csv.reader(io.StringIO(expected[generate_data.ROLLUP_FILE_TEMPLATE.format(name, "csv")].decode("utf-8"))))
+        assert csv_rows == [[str(value) for value in row] for row in rows]
+
+def test_shards_incremental (generate_data, tmp_path, filenames):
+    output_dir = tmp_path / "out"
+    before = run(generate_data, output_dir, filenames, shards=True)
+    kenya_path = output_dir / generate_data.SHARDS_DIR / "country" / "kenya.json"
+    mtime = kenya_path.stat().st_mtime_ns
+
+    # change one value in the copy, which touches only its own country and month
+    copy_path = tmp_path / "copy.xml"
+    copy_path.write_text(copy_path.read_text(encoding="utf-8").replace("<value>-3000</value>", "<value>-5000</value>"), encoding="utf-8")
+    generate_data.generate(make_args(output_dir, shards=True), filenames)
+    assert kenya_path.stat().st_mtime_ns == mtime
+
+    after = read_outputs(output_dir)
+    assert after != before
+    assert after == run(generate_data, tmp_path / "fresh", filenames, shards=True)
+
+def test_sqlite (generate_data, tmp_path, filenames, expected, monkeypatch):
+    monkeypatch.setattr(generate_data, "SQLITE_BATCH_ROWS", 3)
+    database_path = tmp_path / "c19.sqlite"
+    assert run(generate_data, tmp_path / "out", filenames, sqlite=str(database_path)) == expected
+
+    connection = sqlite3.connect(str(database_path))
+    try:
+        transactions = json.loads(expected[generate_data.TRANSACTIONS_JSON])[2:]
+        assert [list(row) for row in connection.execute("SELECT * FROM transactions ORDER BY rowid")] == transactions
+
+        flows = json.loads(expected[generate_data.FLOWS_JSON])[2:]
+        assert [list(row) for row in connection.execute("SELECT * FROM flows ORDER BY rowid")] == [
+            [generate_data.decode_flow_value(value, i in generate_data.SQLITE_FLOW_INTEGER_COLUMNS) for i, value in enumerate(row)] for row in flows
+        ]
+
+        for name, columns in generate_data.ROLLUPS:
+            rollup = json.loads(expected[generate_data.ROLLUP_FILE_TEMPLATE.format(name, "json")])[2:]
+            view = "rollup_" + name.replace("-", "_")
+            assert sorted(list(row) for row in connection.execute("SELECT * FROM {}".format(view))) == rollup
+    finally:
+        connection.close()
+
+@pytest.mark.parametrize("options", [{}, {"workers": 2}, {"cache_dir": True}])
+def test_latest (generate_data, reference_dir, tmp_path, monkeypatch, options):
+    # an older copy of every activity, with a different value
+    with open(FIXTURE, "r", encoding="utf-8") as input:
+        xml = input.read()
+    old_path = tmp_path / "old.xml"
+    old_path.write_text(xml.replace('last-updated-datetime="2021-', 'last-updated-datetime="2019-').replace("<value>-3000</value>", "<value>-5000</value>"), encoding="utf-8")
+
+    # the first copy wins by default
+    expected = run(generate_data, tmp_path / "expected", [FIXTURE, str(old_path)])
+    assert run(generate_data, tmp_path / "first", [str(old_path), FIXTURE]) != expected
+
+    # small chunks, so that each file is split up
+    monkeypatch.setattr(generate_data, "CHUNK_BYTES", 1000)
+    if options.get("cache_dir"):
+        options = dict(options, cache_dir=str(tmp_path / "cache"))
+        os.mkdir(options["cache_dir"])
+    assert run(generate_data, tmp_path / "latest", [str(old_path), FIXTURE], latest=True, **options) == expected
+
+def test_max_memory (generate_data, tmp_path, filenames, expected, monkeypatch):
+    # check after every activity, and spill however little there is
+    monkeypatch.setattr(generate_data, "MEMORY_CHECK_ACTIVITIES", 1)
+    monkeypatch.setattr(generate_data, "MEMORY_MIN_SPILL_ROWS", 1)
+    counters = generate_data.metrics.counters.copy()
+    assert run(generate_data, tmp_path / "out", filenames, max_memory=1) == expected
+    spills = generate_data.metrics.counters - counters
+    assert spills["memory.transaction_spills"] > 1 and spills["memory.flow_spills"] > 1
+
+ALTERNATE_NAME = """<?xml version="1.0" encoding="UTF-8"?>
+<iati-activities version="2.03" generated-datetime="2021-06-01T00:00:00Z">
+  <iati-activity last-updated-datetime="2021-05-01T00:00:00Z" default-currency="USD">
+    <iati-identifier>XM-ALT-1</iati-identifier>
+    <reporting-org ref="XM-TEST" type="10"><narrative>Test Agency (old name)</narrative></reporting-org>
+    <title><narrative>COVID-19 response</narrative></title>
+    <transaction>
+      <transaction-type code="3"/>
+      <transaction-date iso-date="2020-09-01"/>
+      <value>1000</value>
+    </transaction>
+  </iati-activity>
+</iati-activities>
+"""
+""" A file with a less common name for the XM-TEST org """
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_resolve_orgs (generate_data, reference_dir, tmp_path, workers):
+    alternate_path = tmp_path / "alternate.xml"
+    alternate_path.write_text(ALTERNATE_NAME, encoding="utf-8")
+
+    # by default, the first name found wins
+    expected = run(generate_data, tmp_path / "expected", [FIXTURE, str(alternate_path)])
+    assert run(generate_data, tmp_path / "first", [str(alternate_path), FIXTURE]) != expected
+
+    # with --resolve-orgs, the most common one does, in any order
+    assert run(generate_data, tmp_path / "resolved", [str(alternate_path), FIXTURE], resolve_orgs=True, workers=workers) == expected
+
+def test_resolve_orgs_malformed_file (generate_data, reference_dir, tmp_path):
+    malformed_path = tmp_path / "malformed.xml"
+    malformed_path.write_text("<iati-activities><iati-activity>", encoding="utf-8")
+    with pytest.raises(RuntimeError, match="malformed.xml"):
+        generate_data.process_activities([FIXTURE, str(malformed_path)], workers=2, resolve_orgs=True)
+
+@pytest.mark.parametrize("reuse", ["cache_dir", "memo"])
+def test_rules_reused (generate_data, reference_dir, tmp_path, filenames, reuse):
+    """ The c19.* rule counts are the same when the results are reused instead of processed again """
+    if reuse == "cache_dir":
+        options = {"cache_dir": str(tmp_path)}
+    else:
+        options = {"memo": {}}
+
+    def count_rules ():
+        counters = generate_data.metrics.counters.copy()
+        transactions, flows = generate_data.process_activities(filenames, **options)
+        transactions.close()
+        flows.close()
+        return {name: value for name, value in (generate_data.metrics.counters - counters).items() if name.startswith("c19.")}
+
+    expected = count_rules()
+    assert expected["c19.transaction.sector"] == 2
+    assert count_rules() == expected
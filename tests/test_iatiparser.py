@@ -0,0 +1,33 @@
+""" Tests for the streaming parser in iatiparser.py """
+
+import os
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "parity.xml")
+""" Activities covering missing, malformed, and inherited values, and multilingual narratives """
+
+THIS_MONTH = "2021-06"
+
+def test_parity_with_diterator (generate_data, reference_dir):
+    diterator_results, cache_update, diterator_counters = generate_data.process_file(FIXTURE, THIS_MONTH, parser="diterator")
+    streaming_results, cache_update, streaming_counters = generate_data.process_file(FIXTURE, THIS_MONTH, parser="streaming")
+    assert streaming_results == diterator_results
+    c19_counters = {name: value for name, value in diterator_counters.items() if name.startswith("c19.")}
+    assert {name: value for name, value in streaming_counters.items() if name.startswith("c19.")} == c19_counters
+
+    # Make sure the fixture exercises what it's meant to
+    results = dict(diterator_results)
+    assert results["XM-TEST-5"] is None
+    org_key, org_type, transactions, flows, rules = results["XM-TEST-1"]
+    assert org_key == ("Test Agency", "xm-test",)
+    assert len(transactions) == 4 + 1
+    assert set(row[6] for row in results["XM-TEST-2"][2]) == {1}
+    assert results["XM-TEST-2"][4] == {
+        "c19.activity.none": 1,
+        "c19.loose.activity_description": 1,
+        "c19.transaction.sector": 1,
+        "c19.transaction.description": 1,
+    }
+    assert all(row[6] == 1 for identifier in ("XM-TEST-3", "XM-TEST-4",) for row in results[identifier][2])
+    assert c19_counters["c19.loose.title"] == 1
+    assert c19_counters["c19.loose.activity_description"] == 1
+    assert c19_counters["c19.loose.description"] == 1
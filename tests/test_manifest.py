@@ -0,0 +1,39 @@
+""" Tests for change detection in generate-data.py """
+
+import json, os, re
+from conftest import make_args
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "parity.xml")
+
+PUBLISH_PATTERN = re.compile(r'"changed": false}$', re.MULTILINE)
+""" What make publish-output looks for in changes.json to skip the commit """
+
+def test_changes (generate_data, reference_dir, tmp_path):
+    args = make_args(tmp_path)
+    changes_path = tmp_path / generate_data.CHANGES_FILE
+
+    generate_data.generate(args, [FIXTURE])
+    changes = json.loads(changes_path.read_text())
+    assert changes["initial"] and changes["changed"]
+    assert changes["partitions"]["added"] and not changes["partitions"]["changed"]
+    assert not PUBLISH_PATTERN.search(changes_path.read_text())
+
+    mtime = (tmp_path / generate_data.TRANSACTIONS_JSON).stat().st_mtime_ns
+    generate_data.generate(args, [FIXTURE])
+    changes = json.loads(changes_path.read_text())
+    assert not changes["initial"] and not changes["changed"]
+    assert PUBLISH_PATTERN.search(changes_path.read_text())
+    assert (tmp_path / generate_data.TRANSACTIONS_JSON).stat().st_mtime_ns == mtime
+
+def test_code_change (generate_data, reference_dir, tmp_path, monkeypatch):
+    args = make_args(tmp_path)
+    changes_path = tmp_path / generate_data.CHANGES_FILE
+
+    generate_data.generate(args, [FIXTURE])
+    manifest = json.loads((tmp_path / generate_data.MANIFEST_FILE).read_text())
+    assert manifest["signature"] == generate_data.get_code_signature()
+
+    # as if iatiparser.py (say) had changed
+    monkeypatch.setattr(generate_data, "get_code_signature", lambda: "changed")
+    generate_data.generate(args, [FIXTURE])
+    assert json.loads(changes_path.read_text())["changed"]
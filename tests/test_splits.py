@@ -0,0 +1,42 @@
+""" Tests for the NumPy version of the country × sector splits in generate-data.py """
+
+import os, pytest, random
+from conftest import make_args, read_outputs
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "parity.xml")
+
+@pytest.fixture
+def numpy (generate_data):
+    return pytest.importorskip("numpy")
+
+def make_splits (percentages):
+    return {"code-{}".format(i): percentage for i, percentage in enumerate(percentages)}
+
+def test_split_values (generate_data, numpy, monkeypatch):
+    test_random = random.Random(19)
+    cases = [
+        # halves, to check that both versions round them to even
+        (5, 5, make_splits([0.5] * 8), make_splits([0.25] * 4 + [0.5] * 4)),
+        (-3, 1.5, make_splits([0.5] * 6), make_splits([1.0] * 6)),
+        (2 ** 70, -2 ** 70, make_splits([1/3] * 3), make_splits([0.1] * 11)),
+    ]
+    for n in range(50):
+        value = test_random.uniform(-1e9, 1e9)
+        cases.append((value, -value, make_splits([test_random.random() for i in range(test_random.randint(1, 20))]), make_splits([test_random.random() for i in range(test_random.randint(1, 20))])))
+
+    for value, net_value, country_splits, sector_splits in cases:
+        monkeypatch.setattr(generate_data, "numpy", None)
+        expected = generate_data.split_values(value, net_value, country_splits, sector_splits)
+        monkeypatch.setattr(generate_data, "numpy", numpy)
+        monkeypatch.setattr(generate_data, "SPLIT_ARRAY_MIN_ROWS", 1)
+        assert generate_data.split_values(value, net_value, country_splits, sector_splits) == expected
+
+def test_generate (generate_data, numpy, reference_dir, tmp_path, monkeypatch):
+    for name in ("expected", "numpy"):
+        (tmp_path / name).mkdir()
+    monkeypatch.setattr(generate_data, "numpy", None)
+    generate_data.generate(make_args(tmp_path / "expected"), [FIXTURE])
+    monkeypatch.setattr(generate_data, "numpy", numpy)
+    monkeypatch.setattr(generate_data, "SPLIT_ARRAY_MIN_ROWS", 1)
+    generate_data.generate(make_args(tmp_path / "numpy"), [FIXTURE])
+    assert read_outputs(tmp_path / "numpy") == read_outputs(tmp_path / "expected")
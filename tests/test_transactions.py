@@ -0,0 +1,49 @@
+""" Tests for the columnar transaction store in generate-data.py """
+
+import random, pytest
+
+def make_rows (n, seed=1, huge=True):
+    """ Return n random transaction rows, with plenty of ties, some None values, and (if huge) a value too big for the arrays """
+    rnd = random.Random(seed)
+    rows = []
+    for i in range(n):
+        rows.append([
+            "2020-{:02d}".format(rnd.randint(1, 12)),
+            rnd.choice(["Org A", "Org B", "Org C", None]),
+            "10",
+            rnd.choice(["Health", "Education"]),
+            rnd.choice(["Kenya", "Uganda", "(Unspecified country)"]),
+            rnd.randint(0, 1),
+            rnd.randint(0, 1),
+            rnd.choice(["commitments", "spending"]),
+            "XM-TEST-{}".format(rnd.randint(1, 20)),
+            rnd.randint(-1000, 1000),
+            rnd.randint(0, 1000) if i != n // 2 or not huge else 2 ** 70,
+        ])
+    return rows
+
+@pytest.mark.parametrize("buffer_rows", [10000, 97])
+@pytest.mark.parametrize("use_numpy,huge", [(False, True), (True, False), (True, True)])
+def test_sorted_rows (generate_data, monkeypatch, buffer_rows, use_numpy, huge):
+    # without the huge value, all the columns stay arrays, so NumPy can sort them
+    monkeypatch.setattr(generate_data, "numpy", pytest.importorskip("numpy") if use_numpy else None)
+    rows = make_rows(1000, huge=huge)
+    sink = generate_data.TransactionSink(buffer_rows=buffer_rows)
+    for row in rows:
+        sink.append(row)
+    try:
+        assert len(sink) == len(rows)
+        assert list(sink.sorted_rows()) == sorted(rows, key=lambda row: [generate_data.sort_key(value) for value in row])
+    finally:
+        sink.close()
+
+def test_ranks (generate_data):
+    dictionary = generate_data.CodeDictionary()
+    for value in ["b", "c", None]:
+        dictionary.encode(value)
+    assert dictionary.ranks() == ([1, 2, 0], [None, "b", "c"])
+    assert dictionary.ranks() is dictionary.ranks()
+    dictionary.encode("b")
+    assert dictionary.ranks() == ([1, 2, 0], [None, "b", "c"])
+    dictionary.encode("a")
+    assert dictionary.ranks() == ([2, 3, 0, 1], [None, "a", "b", "c"])
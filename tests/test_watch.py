@@ -0,0 +1,47 @@
+""" Tests for reusing results between runs in generate-data.py (--watch and --cache-dir) """
+
+import json, os, shutil, pytest
+from conftest import make_args
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "parity.xml")
+
+@pytest.fixture
+def work_dir (generate_data, reference_dir, tmp_path, monkeypatch):
+    """ Run in a temporary directory with a copy of the reference data, and forget it afterwards """
+    shutil.copytree(os.path.join(reference_dir, "data"), tmp_path / "data")
+    monkeypatch.chdir(tmp_path)
+    generate_data.unload_reference_data()
+    yield tmp_path
+    generate_data.unload_reference_data()
+
+def generate (generate_data, output_dir, cache_dir=None, memo=None):
+    """ Run generate() over the fixture, and return the transactions it wrote """
+    output_dir.mkdir(exist_ok=True)
+    generate_data.generate(make_args(output_dir, cache_dir=cache_dir), [FIXTURE], memo)
+    return json.loads((output_dir / generate_data.TRANSACTIONS_JSON).read_text())
+
+def rename_country (path, code, name):
+    """ Change a country's name in a copy of data/countries.json """
+    info = json.loads(path.read_text())
+    for country in info["data"]:
+        if country["iso2"] == code:
+            country["label"]["default"] = name
+    path.write_text(json.dumps(info))
+
+def test_reference_data_change (generate_data, work_dir):
+    memo = {}
+    cache_dir = str(work_dir / "cache")
+    before = generate(generate_data, work_dir / "watch", cache_dir, memo)
+    assert "Kenya" in [row[4] for row in before]
+
+    # The long-running process picks up the change
+    rename_country(work_dir / "data" / "countries.json", "KE", "Kenya (renamed)")
+    after = generate(generate_data, work_dir / "watch", cache_dir, memo)
+    countries = [row[4] for row in after]
+    assert "Kenya" not in countries and "Kenya (renamed)" in countries
+
+    # The results it cached are the same as a fresh run's, in a new process and without the cache
+    generate_data.unload_reference_data()
+    assert generate(generate_data, work_dir / "cached", cache_dir) == after
+    generate_data.unload_reference_data()
+    assert generate(generate_data, work_dir / "fresh") == after